@@ -9,4 +9,7 @@ else
      python manage.py migrate --noinput
 fi
 
+python manage.py schedule_scratch_org_pool_refills
+python manage.py schedule_github_hook_delivery_pruning
+
 echo "Done."
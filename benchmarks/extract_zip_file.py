@@ -0,0 +1,97 @@
+"""
+Compare single-pass zipball extraction against the previous
+extract-then-move implementation.
+
+Run from the project root:
+
+    python benchmarks/extract_zip_file.py [--files 20000] [--repeat 3]
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+from glob import glob
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from metecho.api.gh import ZIP_FILE_NAME, extract_zip_file  # noqa: E402
+
+OWNER = "owner"
+REPO_NAME = "repo"
+ROOT = f"{OWNER}-{REPO_NAME}-0123456"
+
+
+def legacy_extract_zip_file(zip_file, owner, repo_name):
+    zip_file.extractall()
+    zipball_root = glob(f"{owner}-{repo_name}-*")[0]
+    shutil.move(zipball_root, "zipball_root")
+    for path in itertools.chain(glob("zipball_root/*"), glob("zipball_root/.*")):
+        shutil.move(path, ".")
+    shutil.rmtree("zipball_root")
+    os.remove(ZIP_FILE_NAME)
+
+
+def build_archive(path, files):
+    """
+    Lay the files out roughly like a Salesforce project: many small
+    metadata files spread over a few hundred directories.
+    """
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(f"{ROOT}/", "")
+        zip_file.writestr(f"{ROOT}/cumulusci.yml", "project:\n  name: Benchmark\n")
+        for i in range(files):
+            directory = f"force-app/main/default/objects/Object{i // 50}/fields"
+            zip_file.writestr(
+                f"{ROOT}/{directory}/Field{i}__c.field-meta.xml",
+                f"<CustomField><fullName>Field{i}__c</fullName></CustomField>\n" * 8,
+            )
+
+
+@contextmanager
+def in_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def time_extraction(extract, archive, repeat):
+    timings = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp_dir, in_directory(tmp_dir):
+            shutil.copyfile(archive, ZIP_FILE_NAME)
+            start = time.perf_counter()
+            with zipfile.ZipFile(ZIP_FILE_NAME) as zip_file:
+                extract(zip_file, OWNER, REPO_NAME)
+            timings.append(time.perf_counter() - start)
+            assert Path("cumulusci.yml").exists()
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive = Path(tmp_dir, "benchmark.zip")
+        build_archive(archive, args.files)
+        print(f"Archive with {args.files} files, best of {args.repeat}:")
+        legacy = time_extraction(legacy_extract_zip_file, archive, args.repeat)
+        print(f"  extract then move: {legacy:.2f}s")
+        single_pass = time_extraction(extract_zip_file, archive, args.repeat)
+        print(f"  single pass:       {single_pass:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
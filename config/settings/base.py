@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 from ipaddress import IPv4Network
 from os import environ
 from pathlib import Path
+from tempfile import gettempdir
 from typing import List
 
 import dj_database_url
@@ -157,6 +158,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "metecho.api.gh_memo.memoize_github_middleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -229,12 +231,27 @@ ADMIN_API_ALLOWED_SUBNETS = env(
 GITHUB_HOOK_SECRET = env(
     "GITHUB_HOOK_SECRET", default="", type_=lambda x: bytes(x, encoding="utf-8")
 )
+# How long processed webhook payloads are kept, for troubleshooting:
+GITHUB_HOOK_DELIVERY_RETENTION_DAYS = env(
+    "GITHUB_HOOK_DELIVERY_RETENTION_DAYS", default=7, type_=int
+)
 # The username of the user that GitHub webhook actions should authenticate as:
 GITHUB_USER_NAME = env("GITHUB_USER_NAME", default="GitHub user")
 GITHUB_APP_ID = env("GITHUB_APP_ID", default=0, type_=int)
 # Ugly hack to fix https://github.com/moby/moby/issues/12997
 DOCKER_GITHUB_APP_KEY = env("DOCKER_GITHUB_APP_KEY", default="").replace("\\n", "\n")
 GITHUB_APP_KEY = bytes(env("GITHUB_APP_KEY", default=DOCKER_GITHUB_APP_KEY), "utf-8")
+# Repository archives are cached on each worker's disk, keyed by repository and
+# commit SHA. The size is in bytes; set it to 0 to disable the cache:
+GITHUB_ARCHIVE_CACHE_DIR = env(
+    "GITHUB_ARCHIVE_CACHE_DIR", default=str(Path(gettempdir(), "metecho-archives"))
+)
+GITHUB_ARCHIVE_CACHE_SIZE = env(
+    "GITHUB_ARCHIVE_CACHE_SIZE", default=1024 * 1024 * 1024, type_=int
+)
+# Low-priority jobs (issue and collaborator refreshes) are deferred until the
+# GitHub App's rate limit resets when fewer requests than this are left:
+GITHUB_RATE_LIMIT_RESERVE = env("GITHUB_RATE_LIMIT_RESERVE", default=500, type_=int)
 
 
 # Salesforce Devhub settings:
@@ -310,6 +327,11 @@ DAYS_BEFORE_ORG_EXPIRY_TO_ALERT = env(
     "DAYS_BEFORE_ORG_EXPIRY_TO_ALERT", default=3, type_=int
 )
 ORG_RECHECK_MINUTES = env("ORG_RECHECK_MINUTES", default=5, type_=int)
+# Logging in doesn't re-sync a user's GitHub repositories if they were synced
+# more recently than this:
+GITHUB_REPOS_RECHECK_MINUTES = env(
+    "GITHUB_REPOS_RECHECK_MINUTES", default=10, type_=int
+)
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
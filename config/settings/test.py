@@ -5,3 +5,5 @@ CHANNEL_LAYERS = {
 }
 
 DEVHUB_USERNAME = None
+
+GITHUB_ARCHIVE_CACHE_SIZE = 0
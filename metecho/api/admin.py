@@ -11,11 +11,14 @@ from . import gh
 from .models import (
     Epic,
     EpicSlug,
+    GitHubHookDelivery,
     GitHubIssue,
     GitHubRepository,
     Project,
     ProjectSlug,
     ScratchOrg,
+    ScratchOrgPool,
+    ScratchOrgSnapshot,
     SiteProfile,
     Task,
     TaskSlug,
@@ -126,6 +129,21 @@ class GitHubIssueAdmin(admin.ModelAdmin):
     search_fields = ("number", "title")
 
 
+@admin.register(GitHubHookDelivery)
+class GitHubHookDeliveryAdmin(admin.ModelAdmin):
+    date_hierarchy = "received_at"
+    list_display = ("delivery_id", "event", "ref", "received_at", "processed_at")
+    list_filter = ("event", ("processed_at", admin.EmptyFieldListFilter))
+    search_fields = ("delivery_id", "ref")
+    actions = ("process",)
+
+    @admin.action(description="Process selected deliveries again")
+    def process(self, request, queryset):
+        # Deliveries are put back unprocessed if processing them failed:
+        for delivery in queryset.filter(processed_at__isnull=True):
+            delivery.queue_process()
+
+
 @admin.register(Epic)
 class EpicAdmin(admin.ModelAdmin):
     list_display = ("name", "status", "project", "created_at", "deleted_at")
@@ -193,11 +211,31 @@ class ScratchOrgAdmin(admin.ModelAdmin):
         "created_at",
         "deleted_at",
     )
-    list_filter = (SoftDeletedListFilter, "owner", "org_type")
+    list_filter = (SoftDeletedListFilter, "owner", "org_type", "pool")
     search_fields = ("project__name", "epic__name", "task__name")
     formfield_overrides = {JSONField: {"widget": JSONWidget}}
 
 
+@admin.register(ScratchOrgPool)
+class ScratchOrgPoolAdmin(admin.ModelAdmin):
+    list_display = ("project", "org_config_name", "size", "owner")
+    list_select_related = ("project", "owner")
+
+
+@admin.register(ScratchOrgSnapshot)
+class ScratchOrgSnapshotAdmin(admin.ModelAdmin):
+    list_display = (
+        "snapshot_name",
+        "project",
+        "org_config_name",
+        "devhub_username",
+        "status",
+        "created_at",
+    )
+    list_filter = ("status",)
+    list_select_related = ("project",)
+
+
 class SiteAdminForm(forms.ModelForm):
     class Meta:
         model = Site
@@ -4,27 +4,65 @@ GitHub utilities
 
 import contextlib
 import hmac
-import itertools
 import logging
 import os
 import pathlib
 import shutil
 import zipfile
-from glob import glob
+from datetime import timedelta
 
 from cumulusci.utils import temporary_dir
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.utils import timezone
 from github3 import GitHub, login, users
 from github3.exceptions import NotFoundError, UnprocessableEntity
 
 from .custom_cci_configs import MetechoUniversalConfig, ProjectConfig
+from .gh_archives import fetch_archive, resolve_commit_sha
+from .gh_memo import get_memoized_repository
+from .gh_rate_limit import get_deferral_time, installation_budget, user_budget
+from .gh_transport import mount_github_adapter
 
 logger = logging.getLogger(__name__)
 
 
 ZIP_FILE_NAME = "archive.zip"
+# Stop handing out a cached installation token this long before it expires, so
+# jobs using it don't fail halfway through:
+INSTALLATION_TOKEN_EXPIRY_MARGIN = timedelta(minutes=10)
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+# GitHub caps a GraphQL query at 500,000 nodes and counts each aliased user as
+# one, but keeping queries small keeps them well below the timeout:
+USERS_PER_GRAPHQL_QUERY = 100
+# Comparing branches walks their history, so these are costlier than users:
+COMPARISONS_PER_GRAPHQL_QUERY = 50
+# All the fields needed to make a REST-shaped user dict:
+GRAPHQL_USER_FRAGMENT = """
+fragment userFields on User {
+  id
+  databaseId
+  login
+  name
+  avatarUrl
+  url
+  isSiteAdmin
+  company
+  websiteUrl
+  location
+  email
+  isHireable
+  bio
+  repositories(privacy: PUBLIC, ownerAffiliations: OWNER) { totalCount }
+  gists(privacy: PUBLIC) { totalCount }
+  followers { totalCount }
+  following { totalCount }
+  createdAt
+  updatedAt
+}
+"""
 
 
 class UnsafeZipfileError(Exception):
@@ -42,19 +80,67 @@ def gh_given_user(user):
         )
     except (ObjectDoesNotExist, MultipleObjectsReturned):
         raise NoGitHubTokenError
-    return login(token=token)
+    return mount_github_adapter(login(token=token), budget=user_budget(user))
 
 
-def gh_as_app(repo_owner, repo_name):
-    app_id = settings.GITHUB_APP_ID
-    app_key = settings.GITHUB_APP_KEY
+def get_installation_id(repo_owner, repo_name):
+    """
+    Get the ID of the App installation that covers a repository. Results are
+    cached to stay under API limits.
+    """
+    key = f"gh_installation_id_{repo_owner}/{repo_name}"
+    installation_id = cache.get(key)
+    if installation_id is not None:
+        return installation_id
+
     gh = GitHub()
-    gh.login_as_app(app_key, app_id, expire_in=120)
-    installation = gh.app_installation_for_repository(repo_owner, repo_name)
-    gh.login_as_app_installation(app_key, app_id, installation.id)
+    gh.login_as_app(settings.GITHUB_APP_KEY, settings.GITHUB_APP_ID, expire_in=120)
+    installation_id = gh.app_installation_for_repository(repo_owner, repo_name).id
+    # Short enough that a reinstalled App is picked up again the same hour:
+    cache.set(key, installation_id, timeout=60 * 60)  # 1 hour
+    return installation_id
+
+
+def gh_as_app(repo_owner, repo_name):
+    """
+    Log in as the App installation for a repository. Installation tokens are
+    valid for an hour, so they are cached and shared between processes until
+    shortly before they expire.
+    """
+    installation_id = get_installation_id(repo_owner, repo_name)
+    key = f"gh_installation_token_{installation_id}"
+    gh = mount_github_adapter(GitHub(), budget=installation_budget(installation_id))
+    token = cache.get(key)
+    if token is not None:
+        gh.session.app_installation_token_auth(token)
+        return gh
+
+    gh.login_as_app_installation(
+        settings.GITHUB_APP_KEY, settings.GITHUB_APP_ID, installation_id, expire_in=120
+    )
+    auth = gh.session.auth
+    timeout = (
+        auth.expires_at - timezone.now() - INSTALLATION_TOKEN_EXPIRY_MARGIN
+    ).total_seconds()
+    if timeout > 0:
+        cache.set(
+            key,
+            {"token": auth.token, "expires_at": auth.expires_at_str},
+            timeout=timeout,
+        )
     return gh
 
 
+def get_app_deferral_time(repo_owner, repo_name):
+    """
+    If the App's budget for a repository is running low, return when it
+    resets, so low-priority work can wait until then.
+    """
+    return get_deferral_time(
+        installation_budget(get_installation_id(repo_owner, repo_name))
+    )
+
+
 def get_all_org_repos(user):
     gh = gh_given_user(user)
     return set(gh.repositories())
@@ -71,10 +157,15 @@ def zip_file_is_safe(zip_file):
 def get_repo_info(user, repo_id=None, repo_owner=None, repo_name=None):
     if user is None and (repo_owner is None or repo_name is None):
         raise TypeError("If user=None, you must call with repo_owner and repo_name")
-    gh = gh_given_user(user) if user else gh_as_app(repo_owner, repo_name)
-    if repo_id is None:
-        return gh.repository(repo_owner, repo_name)
-    return gh.repository_with_id(repo_id)
+
+    def get_repository():
+        gh = gh_given_user(user) if user else gh_as_app(repo_owner, repo_name)
+        if repo_id is None:
+            return gh.repository(repo_owner, repo_name)
+        return gh.repository_with_id(repo_id)
+
+    key = (user.id if user else None, repo_id, repo_owner, repo_name)
+    return get_memoized_repository(key, get_repository)
 
 
 def get_cached_user(gh: GitHub, username: str) -> users.User:
@@ -91,8 +182,166 @@ def get_cached_user(gh: GitHub, username: str) -> users.User:
     return user
 
 
+def get_cached_users(gh: GitHub, usernames) -> dict:
+    """
+    Get many GitHub users by username, like `get_cached_user`. Users that
+    aren't cached yet are fetched in batches through the GraphQL API. Returns a
+    dict of username to user, leaving out users that couldn't be fetched.
+    """
+    keys = {username: f"gh_user_{username}" for username in usernames}
+    user_dicts = {}
+    cached = cache.get_many(keys.values())
+    for username, key in keys.items():
+        if key in cached:
+            user_dicts[username] = cached[key]
+
+    missing = [username for username in keys if username not in user_dicts]
+    for i in range(0, len(missing), USERS_PER_GRAPHQL_QUERY):
+        fetched = fetch_users(gh, missing[i : i + USERS_PER_GRAPHQL_QUERY])
+        cache.set_many(
+            {keys[username]: user_dict for username, user_dict in fetched.items()},
+            timeout=60 * 60 * 24,  # 1 day
+        )
+        user_dicts.update(fetched)
+
+    result = {
+        username: users.User.from_dict(user_dict, gh.session)
+        for username, user_dict in user_dicts.items()
+    }
+    # GraphQL can't look up bots, so fall back to REST for the few left:
+    for username in missing:
+        if username not in result:
+            try:
+                result[username] = get_cached_user(gh, username)
+            except Exception:
+                logger.exception(f"Failed to fetch GitHub user {username}")
+    return result
+
+
+def fetch_users(gh: GitHub, usernames) -> dict:
+    """
+    Fetch users in a single GraphQL query, returning a dict of username to
+    user dicts shaped like the REST API's, so they can share cache entries with
+    `get_cached_user`. Logins that aren't users (e.g. bots) are left out.
+    """
+    variables = {f"login{i}": username for i, username in enumerate(usernames)}
+    query = "query({}) {{ {} }} {}".format(
+        ", ".join(f"${name}: String!" for name in variables),
+        " ".join(
+            f"user{i}: user(login: ${name}) {{ ...userFields }}"
+            for i, name in enumerate(variables)
+        ),
+        GRAPHQL_USER_FRAGMENT,
+    )
+    response = gh.session.post(
+        GITHUB_GRAPHQL_URL, json={"query": query, "variables": variables}
+    )
+    response.raise_for_status()
+    data = response.json().get("data")
+    if data is None:
+        raise Exception(f"GitHub GraphQL query failed: {response.json()}")
+    return {
+        username: graphql_user_to_rest(data[f"user{i}"])
+        for i, username in enumerate(usernames)
+        if data.get(f"user{i}")
+    }
+
+
+def graphql_user_to_rest(node):
+    login = node["login"]
+    api_url = f"https://api.github.com/users/{login}"
+    return {
+        "login": login,
+        "id": node["databaseId"],
+        "node_id": node["id"],
+        "avatar_url": node["avatarUrl"],
+        "gravatar_id": "",
+        "url": api_url,
+        "html_url": node["url"],
+        "followers_url": f"{api_url}/followers",
+        "following_url": f"{api_url}/following{{/other_user}}",
+        "gists_url": f"{api_url}/gists{{/gist_id}}",
+        "starred_url": f"{api_url}/starred{{/owner}}{{/repo}}",
+        "subscriptions_url": f"{api_url}/subscriptions",
+        "organizations_url": f"{api_url}/orgs",
+        "repos_url": f"{api_url}/repos",
+        "events_url": f"{api_url}/events{{/privacy}}",
+        "received_events_url": f"{api_url}/received_events",
+        "type": "User",
+        "site_admin": node["isSiteAdmin"],
+        "name": node["name"],
+        "company": node["company"],
+        "blog": node["websiteUrl"] or "",
+        "location": node["location"],
+        # GraphQL returns empty strings and false where REST returns null:
+        "email": node["email"] or None,
+        "hireable": node["isHireable"] or None,
+        "bio": node["bio"],
+        "public_repos": node["repositories"]["totalCount"],
+        "public_gists": node["gists"]["totalCount"],
+        "followers": node["followers"]["totalCount"],
+        "following": node["following"]["totalCount"],
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+    }
+
+
+def get_ahead_by(repo, comparisons) -> dict:
+    """
+    Count the commits on each head branch that aren't on its base, for many
+    (base, head) pairs of branch names, in as few GraphQL queries as possible.
+    Returns a dict of each pair to its count, or to None if it couldn't be
+    compared (e.g. one of the branches is gone).
+    """
+    comparisons = list(dict.fromkeys(comparisons))
+    ahead_by = {}
+    for i in range(0, len(comparisons), COMPARISONS_PER_GRAPHQL_QUERY):
+        ahead_by.update(
+            fetch_ahead_by(repo, comparisons[i : i + COMPARISONS_PER_GRAPHQL_QUERY])
+        )
+    return ahead_by
+
+
+def fetch_ahead_by(repo, comparisons) -> dict:
+    # Each distinct base is resolved once, and compared to all its heads:
+    bases = list(dict.fromkeys(base for base, _ in comparisons))
+    variables = {"owner": repo.owner.login, "name": repo.name}
+    selections = []
+    for i, base in enumerate(bases):
+        variables[f"base{i}"] = f"refs/heads/{base}"
+        compares = []
+        for j, (base_name, head) in enumerate(comparisons):
+            if base_name == base:
+                variables[f"head{j}"] = head
+                compares.append(f"head{j}: compare(headRef: $head{j}) {{ aheadBy }}")
+        selections.append(
+            f"base{i}: ref(qualifiedName: $base{i}) {{ {' '.join(compares)} }}"
+        )
+    query = "query({}) {{ repository(owner: $owner, name: $name) {{ {} }} }}".format(
+        ", ".join(f"${name}: String!" for name in variables), " ".join(selections)
+    )
+    response = repo.session.post(
+        GITHUB_GRAPHQL_URL, json={"query": query, "variables": variables}
+    )
+    response.raise_for_status()
+    data = response.json().get("data")
+    if data is None:
+        raise Exception(f"GitHub GraphQL query failed: {response.json()}")
+    repository = data.get("repository") or {}
+    ahead_by = {}
+    for j, (base, head) in enumerate(comparisons):
+        ref = repository.get(f"base{bases.index(base)}") or {}
+        comparison = ref.get(f"head{j}")
+        ahead_by[(base, head)] = comparison["aheadBy"] if comparison else None
+    return ahead_by
+
+
 def get_zip_file(repo, commit_ish):
-    repo.archive("zipball", path=ZIP_FILE_NAME, ref=commit_ish)
+    if settings.GITHUB_ARCHIVE_CACHE_SIZE:
+        commit_sha = resolve_commit_sha(repo, commit_ish)
+        fetch_archive(repo, commit_sha, ZIP_FILE_NAME)
+    else:
+        repo.archive("zipball", path=ZIP_FILE_NAME, ref=commit_ish)
     return zipfile.ZipFile(ZIP_FILE_NAME)
 
 
@@ -106,18 +355,40 @@ def log_unsafe_zipfile_error(repo_url, commit_ish):
 
 
 def extract_zip_file(zip_file, owner, repo_name):
-    zip_file.extractall()
-    # We know that the zipball contains a root directory named something
-    # like this by GitHub's convention. If that ever breaks, this will
-    # break:
-    zipball_root = glob(f"{owner}-{repo_name}-*")[0]
-    # It's not unlikely that the zipball root contains a directory with
-    # the same name, so we pre-emptively rename it to probably avoid
-    # collisions:
-    shutil.move(zipball_root, "zipball_root")
-    for path in itertools.chain(glob("zipball_root/*"), glob("zipball_root/.*")):
-        shutil.move(path, ".")
-    shutil.rmtree("zipball_root")
+    """
+    Extract a zipball into the current directory in a single pass.
+
+    GitHub puts everything in the zipball under a root directory named
+    something like `{owner}-{repo_name}-{sha}/`, so we strip that prefix
+    from each member as we write it out, rather than extracting and then
+    moving the whole tree up a level.
+    """
+    root_prefix = f"{owner}-{repo_name}-"
+    created_dirs = {""}
+    for info in zip_file.infolist():
+        root, _, path = info.filename.partition("/")
+        # We know that the zipball contains a root directory named like
+        # this by GitHub's convention. If that ever breaks, this will
+        # break:
+        if not root.startswith(root_prefix):
+            raise UnsafeZipfileError
+        if not path:
+            continue
+        if not is_safe_path(path):
+            raise UnsafeZipfileError
+
+        if info.is_dir():
+            dirname = path.rstrip("/")
+        else:
+            dirname = os.path.dirname(path)
+        if dirname not in created_dirs:
+            os.makedirs(dirname, exist_ok=True)
+            created_dirs.add(dirname)
+        if info.is_dir():
+            continue
+
+        with zip_file.open(info) as source, open(path, "wb") as target:
+            shutil.copyfileobj(source, target)
     os.remove(ZIP_FILE_NAME)
 
 
@@ -140,25 +411,86 @@ def local_github_checkout(user, repo_id, commit_ish=None):
             # present in the filesystem at cwd, things that are in the
             # repo (we hope):
             extract_zip_file(zip_file, repo.owner.login, repo.name)
+            copy_cumulusci_yml_from_default_branch(repo)
+            yield repo_root
 
-            # Ensure the CumulusCI config is always up to date with the default branch
-            # (even if the current branch has an old version)
-            try:
-                text = repo.file_contents(
-                    "cumulusci.yml", ref=repo.default_branch
-                ).decoded.decode("utf-8")
-                pathlib.Path("cumulusci.yml").write_text(text)
-            except (NotFoundError, IOError) as error:
-                raise Exception(
-                    "Failed to copy cumulusci.yml from default branch"
-                ) from error
 
-            yield repo_root
+def copy_cumulusci_yml_from_default_branch(repo):
+    # Ensure the CumulusCI config is always up to date with the default branch
+    # (even if the current branch has an old version)
+    try:
+        text = repo.file_contents(
+            "cumulusci.yml", ref=repo.default_branch
+        ).decoded.decode("utf-8")
+        pathlib.Path("cumulusci.yml").write_text(text)
+    except (NotFoundError, IOError) as error:
+        raise Exception("Failed to copy cumulusci.yml from default branch") from error
+
+
+def get_subtree(repo, tree, name):
+    """
+    Return the entries of the directory `name` in `tree`, or an empty list if
+    there is no such directory.
+    """
+    for entry in tree:
+        if entry.path == name and entry.type == "tree":
+            return repo.tree(entry.sha).tree
+    return []
+
+
+def write_blob(repo, entry, path):
+    pathlib.Path(path).write_text(repo.blob(entry.sha).decode_content())
+
+
+@contextlib.contextmanager
+def local_github_metadata_checkout(user, repo_id, commit_ish=None):
+    """
+    A stand-in for `local_github_checkout` for jobs that only need the
+    project's configuration, not its metadata.
+
+    Rather than downloading the whole repository, this fetches the config
+    files (`cumulusci.yml`, `sfdx-project.json` and `orgs/*.json`) and the
+    directory layout of `unpackaged/` through the Git trees API, which is
+    enough for `get_project_config`, `get_source_format` and
+    `get_valid_target_directories`.
+    """
+    with temporary_dir() as repo_root:
+        # pretend it's a git clone to satisfy cci
+        os.mkdir(".git")
+
+        repo = get_repo_info(user, repo_id=repo_id)
+        if commit_ish is None:
+            commit_ish = repo.default_branch
+        # The trees API resolves branch names and commit SHAs to their trees:
+        root = repo.tree(commit_ish).tree
+
+        for entry in root:
+            if entry.path == "sfdx-project.json" and entry.type == "blob":
+                write_blob(repo, entry, entry.path)
+
+        org_configs = [
+            entry
+            for entry in get_subtree(repo, root, "orgs")
+            if entry.type == "blob" and entry.path.endswith(".json")
+        ]
+        if org_configs:
+            os.mkdir("orgs")
+        for entry in org_configs:
+            write_blob(repo, entry, f"orgs/{entry.path}")
+
+        unpackaged = get_subtree(repo, root, "unpackaged")
+        for name in ("pre", "post", "config"):
+            for entry in get_subtree(repo, unpackaged, name):
+                if entry.type == "tree":
+                    os.makedirs(f"unpackaged/{name}/{entry.path}")
+
+        copy_cumulusci_yml_from_default_branch(repo)
+        yield repo_root
 
 
 def get_project_config(**kwargs):
     """
-    Expects to be in a local_github_checkout.
+    Expects to be in a local_github_checkout or local_github_metadata_checkout.
     """
     universal_config = MetechoUniversalConfig()
     return ProjectConfig(universal_config, **kwargs)
@@ -0,0 +1,117 @@
+"""
+On-disk cache of GitHub repository archives
+
+Archives are addressed by repository ID and commit SHA, so a cached archive
+never goes stale; the cache only has to bound its size. Each worker keeps its
+own cache directory, evicting the least-recently-used archives first.
+"""
+
+import contextlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from github3.exceptions import NotFoundError
+
+logger = logging.getLogger(__name__)
+
+COMMIT_SHA_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def resolve_commit_sha(repo, commit_ish):
+    """
+    Resolve a branch name, tag or SHA to the SHA of the commit it points to.
+    """
+    if COMMIT_SHA_RE.match(commit_ish):
+        return commit_ish
+    try:
+        return repo.branch(commit_ish).commit.sha
+    except NotFoundError:
+        # Not a branch, so let GitHub resolve it as a tag or short SHA:
+        return repo.commit(commit_ish).sha
+
+
+def get_cache_dir():
+    cache_dir = Path(settings.GITHUB_ARCHIVE_CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_cache_path(repo_id, commit_sha):
+    return get_cache_dir() / f"{repo_id}-{commit_sha}.zip"
+
+
+def materialize(cache_path, path):
+    """
+    Place a cached archive at `path` without copying it if we can.
+
+    Archives are never written to once cached, so a hard link is safe; we
+    only fall back to copying when the job directory is on another
+    filesystem.
+    """
+    try:
+        os.link(cache_path, path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(cache_path, path)
+    # Mark the archive as recently used:
+    with contextlib.suppress(FileNotFoundError):
+        os.utime(cache_path)
+
+
+def evict(max_size=None):
+    """
+    Remove the least-recently-used archives until the cache fits in
+    `max_size` bytes.
+    """
+    if max_size is None:
+        max_size = settings.GITHUB_ARCHIVE_CACHE_SIZE
+    entries = []
+    for entry in get_cache_dir().glob("*.zip"):
+        with contextlib.suppress(FileNotFoundError):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_size:
+            break
+        # Another job on this worker may have evicted it already:
+        with contextlib.suppress(FileNotFoundError):
+            entry.unlink()
+        total -= size
+
+
+def fetch_archive(repo, commit_sha, path):
+    """
+    Put the zipball of `repo` at `commit_sha` at `path`, downloading it from
+    GitHub only if it isn't cached yet.
+    """
+    cache_path = get_cache_path(repo.id, commit_sha)
+    try:
+        materialize(cache_path, path)
+    except FileNotFoundError:
+        pass
+    else:
+        logger.info(f"Using cached archive of {repo.id} at {commit_sha}")
+        return
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".part")
+    os.close(fd)
+    try:
+        if not repo.archive("zipball", path=tmp_path, ref=commit_sha):
+            return
+        # Other jobs on this worker may be fetching the same archive, so we
+        # publish it atomically:
+        os.replace(tmp_path, cache_path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+
+    materialize(cache_path, path)
+    evict()
@@ -0,0 +1,55 @@
+"""
+Index of the branches of each Project's repository
+
+Listing a repository's branches takes one request per hundred branches, so the
+names are kept in the cache instead, sorted so they can be searched by prefix.
+Push webhooks for created and deleted refs drop the index, to be read again
+in full (see `PushHookSerializer`); the timeout only matters if a webhook goes
+missing.
+"""
+
+import bisect
+
+from django.core.cache import cache
+
+from . import gh
+
+BRANCH_INDEX_TIMEOUT = 60 * 60 * 24  # 1 day
+
+
+def get_cache_key(project):
+    return f"gh_branch_index_{project.repo_id}"
+
+
+def get_branch_index(project):
+    """
+    Return `{"default_branch": str, "names": [str]}` for a Project's repository,
+    with the names sorted.
+    """
+    key = get_cache_key(project)
+    index = cache.get(key)
+    if index is None:
+        repo = gh.get_repo_info(
+            None, repo_owner=project.repo_owner, repo_name=project.repo_name
+        )
+        index = {
+            "default_branch": repo.default_branch,
+            "names": sorted(branch.name for branch in repo.branches()),
+        }
+        cache.set(key, index, timeout=BRANCH_INDEX_TIMEOUT)
+    return index
+
+
+def search_branch_names(names, prefix=""):
+    """Return the names, from a sorted list, that start with `prefix`."""
+    start = bisect.bisect_left(names, prefix)
+    end = start
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return names[start:end]
+
+
+def forget_branch_index(project):
+    # Rather than change the index in place, which concurrent webhooks could do
+    # at the same time, losing each other's changes, drop it to be read again:
+    cache.delete(get_cache_key(project))
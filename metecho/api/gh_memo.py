@@ -0,0 +1,104 @@
+"""
+Memoization of GitHub lookups within a unit of work
+
+A single job or request (see `ConnectionClosingWorkerMixin` and
+`memoize_github_middleware`) tends to look up the same repository and the same
+branches over and over. Inside `memoize_github()`, `get_repo_info` hands out
+one `MemoizingRepository` per repository and credentials, which remembers the
+branches it has fetched and their heads.
+
+Creating a branch through the facade forgets that branch; anything else that
+moves a branch (e.g. committing with `CommitDir`) must call
+`forget_repositories()` afterwards.
+"""
+
+import contextlib
+import contextvars
+
+_repositories = contextvars.ContextVar("memoized_github_repositories", default=None)
+
+
+@contextlib.contextmanager
+def memoize_github():
+    token = _repositories.set({})
+    try:
+        yield
+    finally:
+        _repositories.reset(token)
+
+
+def get_memoized_repository(key, get_repository):
+    """
+    Return the repository memoized under `key`, calling `get_repository` to
+    fetch it the first time. Outside `memoize_github()` nothing is memoized.
+    """
+    repositories = _repositories.get()
+    if repositories is None:
+        return get_repository()
+    if key not in repositories:
+        repositories[key] = MemoizingRepository(get_repository())
+    return repositories[key]
+
+
+def forget_repositories():
+    repositories = _repositories.get()
+    if repositories is None:
+        return
+    # Callers may still hold on to repositories they got before:
+    for repository in repositories.values():
+        repository.forget_branches()
+    repositories.clear()
+
+
+class MemoizingRepository:
+    """
+    Wraps a github3 `Repository`, remembering the branches looked up through
+    it.
+    """
+
+    def __init__(self, repository):
+        self._repository = repository
+        self._branches = {}
+
+    def __getattr__(self, name):
+        return getattr(self._repository, name)
+
+    def branch(self, name):
+        if name not in self._branches:
+            self._branches[name] = MemoizingBranch(self._repository.branch(name))
+        return self._branches[name]
+
+    def create_branch_ref(self, name, sha=None):
+        self._branches.pop(name, None)
+        return self._repository.create_branch_ref(name, sha)
+
+    def forget_branches(self):
+        self._branches.clear()
+
+
+class MemoizingBranch:
+    """
+    Wraps a github3 `Branch`, remembering its head.
+    """
+
+    def __init__(self, branch):
+        self._branch = branch
+        self._latest_sha = None
+
+    def __getattr__(self, name):
+        return getattr(self._branch, name)
+
+    def latest_sha(self, differs_from=""):
+        if differs_from:
+            return self._branch.latest_sha(differs_from=differs_from)
+        if self._latest_sha is None:
+            self._latest_sha = self._branch.latest_sha()
+        return self._latest_sha
+
+
+def memoize_github_middleware(get_response):
+    def middleware(request):
+        with memoize_github():
+            return get_response(request)
+
+    return middleware
@@ -0,0 +1,83 @@
+"""
+Tracking of GitHub rate-limit budgets
+
+Every response made through `metecho.api.gh` reports how much of its
+credentials' hourly budget is left. `GitHubAdapter` records those headers here
+under a budget name (one per App installation and one per user), so that jobs
+can check the budget before spending it and defer low-priority work until it
+resets.
+"""
+
+import logging
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# How often to log each budget's remaining requests as a metric:
+METRIC_INTERVAL = 60  # 1 minute
+
+
+def installation_budget(installation_id):
+    return f"installation_{installation_id}"
+
+
+def user_budget(user):
+    return f"user_{user.id}"
+
+
+def get_cache_key(budget, resource):
+    return f"gh_rate_limit_{budget}_{resource}"
+
+
+def record_rate_limit(budget, headers):
+    try:
+        limit = int(headers["X-RateLimit-Limit"])
+        remaining = int(headers["X-RateLimit-Remaining"])
+        reset = int(headers["X-RateLimit-Reset"])
+    except (KeyError, ValueError):
+        return
+    resource = headers.get("X-RateLimit-Resource", "core")
+    key = get_cache_key(budget, resource)
+
+    # Responses to concurrent requests can arrive out of order, so don't let an
+    # older response raise the remaining count within the same window:
+    current = cache.get(key)
+    if current and current["reset"] == reset:
+        remaining = min(remaining, current["remaining"])
+    rate_limit = {"limit": limit, "remaining": remaining, "reset": reset}
+    timeout = max(reset - int(datetime.now(tz=timezone.utc).timestamp()), 1)
+    cache.set(key, rate_limit, timeout=timeout)
+
+    if cache.add(f"{key}_logged", True, timeout=METRIC_INTERVAL):
+        logger.info(
+            f"GitHub rate limit for {budget}: {remaining}/{limit} {resource}",
+            extra={
+                "tag": "github.rate_limit",
+                "context": {"budget": budget, "resource": resource, **rate_limit},
+            },
+        )
+
+
+def get_rate_limit(budget, resource="core"):
+    """
+    Return the last recorded `{"limit", "remaining", "reset"}` of a budget, or
+    None if nothing has been recorded since it last reset.
+    """
+    return cache.get(get_cache_key(budget, resource))
+
+
+def get_deferral_time(budget, resource="core"):
+    """
+    If fewer than `GITHUB_RATE_LIMIT_RESERVE` requests are left in a budget,
+    return when it resets; otherwise return None.
+    """
+    rate_limit = get_rate_limit(budget, resource)
+    if (
+        rate_limit is None
+        or rate_limit["remaining"] >= settings.GITHUB_RATE_LIMIT_RESERVE
+    ):
+        return None
+    return datetime.fromtimestamp(rate_limit["reset"], tz=timezone.utc)
@@ -0,0 +1,119 @@
+"""
+Transport adapter for the GitHub API
+
+Mounted on the sessions of the GitHub clients we create, so every request
+made through `metecho.api.gh` goes through it, and records the rate limit
+reported by each response (see `metecho.api.gh_rate_limit`).
+
+GET responses that carry an ETag or Last-Modified header are kept in the
+cache, and repeated reads are sent as conditional requests. GitHub answers
+those with a bodyless 304 when nothing has changed, which doesn't count
+against the rate limit, and we hand back the cached response instead.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .gh_rate_limit import record_rate_limit
+
+GITHUB_API_URL = "https://api.github.com/"
+# Long enough to outlive the gap between scheduled refreshes; entries for
+# resources that are never read again will age out:
+CONDITIONAL_CACHE_TIMEOUT = 60 * 60 * 24 * 7  # 1 week
+# Large bodies aren't worth keeping in Redis:
+CONDITIONAL_CACHE_MAX_SIZE = 1024 * 1024
+
+
+def get_conditional_cache_key(request):
+    # Responses differ by credentials and media type, as well as by URL:
+    parts = (
+        request.url,
+        request.headers.get("Authorization", ""),
+        request.headers.get("Accept", ""),
+    )
+    digest = hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+    return f"gh_conditional_{digest}"
+
+
+class GitHubAdapter(HTTPAdapter):
+    def __init__(self, *args, budget=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The name under which to record this session's rate limit:
+        self.budget = budget
+
+    def send(self, request, stream=False, **kwargs):
+        response = self.send_conditionally(request, stream=stream, **kwargs)
+        if self.budget:
+            record_rate_limit(self.budget, response.headers)
+        return response
+
+    def send_conditionally(self, request, stream=False, **kwargs):
+        # Streamed downloads (e.g. archives) are never cached:
+        if request.method != "GET" or stream:
+            return super().send(request, stream=stream, **kwargs)
+
+        key = get_conditional_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            # GitHub sends header names in lower case:
+            cached_headers = CaseInsensitiveDict(cached["headers"])
+            if cached_headers.get("ETag"):
+                request.headers["If-None-Match"] = cached_headers["ETag"]
+            if cached_headers.get("Last-Modified"):
+                request.headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+        response = super().send(request, stream=stream, **kwargs)
+
+        if response.status_code == 304 and cached is not None:
+            return self.build_cached_response(request, response, cached)
+        if self.is_cacheable(response):
+            cache.set(
+                key,
+                {
+                    "status_code": response.status_code,
+                    "headers": dict(response.headers),
+                    "content": response.content,
+                },
+                timeout=CONDITIONAL_CACHE_TIMEOUT,
+            )
+        return response
+
+    def is_cacheable(self, response):
+        return (
+            response.status_code == 200
+            and bool(
+                response.headers.get("ETag") or response.headers.get("Last-Modified")
+            )
+            and response.headers.get("Content-Type", "").startswith("application/json")
+            and len(response.content) <= CONDITIONAL_CACHE_MAX_SIZE
+        )
+
+    def build_cached_response(self, request, not_modified, cached):
+        response = Response()
+        response.status_code = cached["status_code"]
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(cached["headers"])
+        # Take the fresh rate-limit and cache headers from the 304:
+        response.headers.update(
+            {
+                name: value
+                for name, value in not_modified.headers.items()
+                if not name.lower().startswith(("content-", "transfer-"))
+            }
+        )
+        response._content = cached["content"]
+        response.encoding = not_modified.encoding or "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        return response
+
+
+def mount_github_adapter(gh, budget=None):
+    gh.session.mount(GITHUB_API_URL, GitHubAdapter(budget=budget))
+    return gh
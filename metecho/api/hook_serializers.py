@@ -4,6 +4,7 @@ from django.db.models.query_utils import Q
 from rest_framework import serializers
 from rest_framework.exceptions import NotFound
 
+from .gh_branches import forget_branch_index
 from .models import Epic, Project, Task
 
 logger = logging.getLogger(__name__)
@@ -123,6 +124,8 @@ class HookSenderSerializer(serializers.Serializer):
 
 
 class PushHookSerializer(HookSerializerMixin, serializers.Serializer):
+    created = serializers.BooleanField(default=False)
+    deleted = serializers.BooleanField(default=False)
     forced = serializers.BooleanField()
     ref = serializers.CharField()
     sender = HookSenderSerializer()
@@ -133,24 +136,48 @@ class PushHookSerializer(HookSerializerMixin, serializers.Serializer):
     def _is_force_push(self):
         return self.validated_data["forced"]
 
-    def process_hook(self):
-        project = self.get_matching_project()
-        if not project:
-            raise NotFound("No matching project.")
-
+    def get_branch_name(self):
         ref = self.validated_data["ref"]
         branch_prefix = "refs/heads/"
         tag_prefix = "refs/tags/"
         if ref.startswith(tag_prefix):
             logger.info(f"Received a tag ref, aborting: {ref}")
-            return
+            return None
         if not ref.startswith(branch_prefix):
             logger.warn(f"Received an invalid ref: {ref}")
-            return
+            return None
         prefix_len = len(branch_prefix)
-        ref = ref[prefix_len:]
+        return ref[prefix_len:]
 
-        if self._is_force_push():
+    def _update_branch_index(self, project, branch_name):
+        if self.validated_data["deleted"] or self.validated_data["created"]:
+            forget_branch_index(project)
+
+    def update_branch_index(self):
+        """
+        Apply only the branch creation or deletion of this push, for a push that
+        has been superseded by a later one to the same branch.
+        """
+        project = self.get_matching_project()
+        branch_name = self.get_branch_name()
+        if project and branch_name:
+            self._update_branch_index(project, branch_name)
+
+    def process_hook(self, *, reconcile=False):
+        """
+        With `reconcile`, the branch's commits are refreshed from GitHub instead
+        of being taken from the payload, as they are after a force push.
+        """
+        project = self.get_matching_project()
+        if not project:
+            raise NotFound("No matching project.")
+
+        ref = self.get_branch_name()
+        if ref is None:
+            return
+        self._update_branch_index(project, ref)
+
+        if (self._is_force_push() or reconcile) and not self.validated_data["deleted"]:
             project.queue_refresh_commits(ref=ref, originating_user_id=None)
         else:
             sender = self.validated_data["sender"]
@@ -183,3 +210,10 @@ class PrReviewHookSerializer(HookSerializerMixin, serializers.Serializer):
 
         sender = self.validated_data["sender"]
         task.add_reviewer(sender)
+
+
+HOOK_SERIALIZERS = {
+    "push": PushHookSerializer,
+    "pull_request": PrHookSerializer,
+    "pull_request_review": PrReviewHookSerializer,
+}
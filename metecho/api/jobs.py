@@ -3,43 +3,54 @@ import logging
 import string
 import traceback
 from datetime import timedelta
-from pathlib import Path
+from functools import partial
 
 import requests
 from asgiref.sync import async_to_sync
 from bs4 import BeautifulSoup
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Concat
 from django.db.models.query_utils import Q
 from django.template.loader import render_to_string
 from django.utils.text import slugify
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from django_rq import get_scheduler, job
-from github3.exceptions import NotFoundError
+from github3.exceptions import (
+    ConnectionError,
+    NotFoundError,
+    ResponseError,
+    UnprocessableEntity,
+)
 from github3.github import GitHub
 from github3.repos.repo import Repository
 
 from .email_utils import get_user_facing_url
 from .gh import (
     get_all_org_repos,
-    get_cached_user,
+    get_app_deferral_time,
+    get_cached_users,
     get_cumulus_prefix,
     get_project_config,
     get_repo_info,
     local_github_checkout,
+    local_github_metadata_checkout,
     normalize_commit,
     try_to_make_branch,
 )
-from .models import TaskReviewStatus
+from .models import IssueStates, ScratchOrgSnapshotStatus, TaskReviewStatus
 from .push import report_scratch_org_error
 from .sf_org_changes import (
     commit_changes_to_github,
-    compare_revisions,
+    compare_sorted_revisions,
     get_latest_revision_numbers,
     get_valid_target_directories,
 )
-from .sf_run_flow import create_org, delete_org, run_flow
+from .sf_org_snapshots import create_org_snapshot, get_org_snapshot, get_snapshot_key
+from .sf_run_flow import create_org, delete_org, forget_access_token, run_flow
 
 logger = logging.getLogger(__name__)
 
@@ -64,7 +75,7 @@ def creating_gh_branch(instance):
 def get_branch_prefix(user, repository: Repository):
     if settings.BRANCH_PREFIX:
         return settings.BRANCH_PREFIX
-    with local_github_checkout(user, repository.id) as repo_root:
+    with local_github_metadata_checkout(user, repository.id) as repo_root:
         return get_cumulus_prefix(
             repo_root=repo_root,
             repo_name=repository.name,
@@ -159,7 +170,7 @@ def alert_user_about_expiring_org(*, org, days):
         # if it should exceptionally occur, the correct thing to do is
         # bail:
         return
-    if org.deleted_at is not None:
+    if org.deleted_at is not None or org.pool_id is not None:
         return
 
     # and has unsaved changes
@@ -199,8 +210,25 @@ def _create_org_and_run_flow(
     repository = get_repo_info(user, repo_id=repo_id)
     commit = repository.branch(repo_branch).commit
     org_config_name = scratch_org.org_config_name
+    devhub_username = sf_username or user.sf_username
+
+    project = scratch_org.root_project
+    snapshot = snapshot_key = None
+    if project.uses_org_snapshots:
+        try:
+            snapshot_key = get_snapshot_key(project_path, org_config_name)
+            snapshot = get_org_snapshot(
+                project=project,
+                org_config_name=org_config_name,
+                key=snapshot_key,
+                devhub_username=devhub_username,
+            )
+        except Exception:
+            # Snapshots only save time, so set the org up the usual way:
+            logger.warning(traceback.format_exc())
+            snapshot = None
 
-    scratch_org_config, cci, org_config = create_org(
+    create_org_kwargs = dict(
         repo_owner=repository.owner.login,
         repo_name=repository.name,
         repo_url=repository.html_url,
@@ -212,6 +240,21 @@ def _create_org_and_run_flow(
         originating_user_id=originating_user_id,
         sf_username=sf_username,
     )
+    try:
+        scratch_org_config, cci, org_config = create_org(
+            **create_org_kwargs,
+            snapshot_name=snapshot.snapshot_name if snapshot else None,
+        )
+    except Exception:
+        scratch_org.refresh_from_db()
+        if snapshot is None or scratch_org.deleted_at is not None:
+            raise
+        # Fall back to running the setup flow on a new org:
+        logger.warning(traceback.format_exc())
+        snapshot.status = ScratchOrgSnapshotStatus.ERROR
+        snapshot.save()
+        snapshot = None
+        scratch_org_config, cci, org_config = create_org(**create_org_kwargs)
     scratch_org.refresh_from_db()
     # Save these values on org creation so that we have what we need to
     # delete the org later, even if the initial flow run fails.
@@ -224,11 +267,50 @@ def _create_org_and_run_flow(
     scratch_org.latest_commit_url = commit.html_url
     scratch_org.latest_commit_at = commit.commit.author.get("date", None)
     scratch_org.config = scratch_org_config.config
-    scratch_org.owner_sf_username = sf_username or user.sf_username
+    scratch_org.owner_sf_username = devhub_username
     scratch_org.owner_gh_username = user.username
     scratch_org.owner_gh_id = user.github_id
+    # A refreshed org starts a new log:
+    scratch_org.cci_log = ""
     scratch_org.save()
 
+    # An org created from a snapshot has been set up already:
+    if snapshot is None:
+        _run_setup_flow(
+            scratch_org,
+            scratch_org_config=scratch_org_config,
+            cci=cci,
+            org_config=org_config,
+            project_path=project_path,
+            user=user,
+        )
+        if snapshot_key:
+            try:
+                create_org_snapshot(
+                    scratch_org, key=snapshot_key, devhub_username=devhub_username
+                )
+            except Exception:
+                # Not worth failing the org over; the next one will try again.
+                logger.warning(traceback.format_exc())
+    scratch_org.refresh_from_db()
+    # We don't need to explicitly save the following, because this
+    # function is called in a context that will eventually call a
+    # finalize_* method, which will save the model.
+    scratch_org.last_modified_at = now()
+    scratch_org.set_latest_revision_numbers(
+        get_latest_revision_numbers(
+            scratch_org,
+            originating_user_id=originating_user_id,
+            full=True,
+        )
+    )
+    scratch_org.is_created = True
+    _schedule_expiry_alert(scratch_org)
+
+
+def _run_setup_flow(
+    scratch_org, *, scratch_org_config, cci, org_config, project_path, user
+):
     cases = {
         "dev": "dev_org",
         "feature": "dev_org",
@@ -236,7 +318,7 @@ def _create_org_and_run_flow(
         "beta": "install_beta",
         "release": "install_prod",
     }
-    flow_name = scratch_org_config.setup_flow or cases[org_config_name]
+    flow_name = scratch_org_config.setup_flow or cases[scratch_org.org_config_name]
 
     try:
         run_flow(
@@ -245,24 +327,28 @@ def _create_org_and_run_flow(
             flow_name=flow_name,
             project_path=project_path,
             user=user,
+            output_handler=partial(_append_flow_output, scratch_org),
         )
     finally:
-        log_path = Path(project_path, ".cumulusci/logs/cci.log")
-        if log_path.exists():
-            scratch_org.refresh_from_db()
-            scratch_org.cci_log = log_path.read_text()
-            scratch_org.save()
-    scratch_org.refresh_from_db()
-    # We don't need to explicitly save the following, because this
-    # function is called in a context that will eventually call a
-    # finalize_* method, which will save the model.
-    scratch_org.last_modified_at = now()
-    scratch_org.latest_revision_numbers = get_latest_revision_numbers(
-        scratch_org,
-        originating_user_id=originating_user_id,
+        # So that saving this instance later keeps the log written so far:
+        scratch_org.refresh_from_db(fields=["cci_log"])
+
+
+def _append_flow_output(scratch_org, output):
+    from .models import ScratchOrg
+
+    # Append in the database, so the whole log is never loaded while it grows:
+    ScratchOrg.objects.filter(pk=scratch_org.pk).update(
+        cci_log=Concat("cci_log", Value(output))
     )
-    scratch_org.is_created = True
+    scratch_org.notify_changed(
+        type_="SCRATCH_ORG_FLOW_OUTPUT",
+        originating_user_id=None,
+        message={"output": output},
+    )
+
 
+def _schedule_expiry_alert(scratch_org):
     scheduler = get_scheduler("default")
     days = settings.DAYS_BEFORE_ORG_EXPIRY_TO_ALERT
     before_expiry = scratch_org.expires_at - timedelta(days=days)
@@ -274,6 +360,80 @@ def _create_org_and_run_flow(
     ).id
 
 
+# Longer than a refill should ever take, in case a worker dies holding it:
+SCRATCH_ORG_POOL_REFILL_LOCK_TIMEOUT = 60 * 10  # 10 minutes
+# Copied from a pooled org to the org that claims it:
+POOLED_ORG_FIELDS = (
+    "url",
+    "expires_at",
+    "latest_commit",
+    "latest_commit_url",
+    "latest_commit_at",
+    "config",
+    "owner_sf_username",
+    "valid_target_directories",
+    "cci_log",
+    "last_modified_at",
+    "is_created",
+)
+
+
+def _claim_pooled_scratch_org(scratch_org, *, user, repo_id, commit_ish):
+    """
+    Hand a pooled org built from the same commit over to `scratch_org`, if
+    there is one, instead of provisioning a new org. Returns whether it did.
+    """
+    from .models import ScratchOrg
+
+    project = scratch_org.root_project
+    pools = project.scratch_org_pools.filter(
+        org_config_name=scratch_org.org_config_name
+    )
+    if not pools.exists():
+        return False
+
+    sha = get_repo_info(user, repo_id=repo_id).branch(commit_ish).latest_sha()
+    expiring = now() + timedelta(days=settings.DAYS_BEFORE_ORG_EXPIRY_TO_ALERT)
+    with transaction.atomic():
+        pooled = (
+            ScratchOrg.objects.active()
+            .select_for_update(skip_locked=True, of=("self",))
+            .filter(
+                pool__in=pools,
+                is_created=True,
+                delete_queued_at__isnull=True,
+                latest_commit=sha,
+                owner_sf_username=user.sf_username,
+                expires_at__gt=expiring,
+            )
+            .first()
+        )
+        if pooled is None:
+            return False
+
+        scratch_org.refresh_from_db()
+        for field in POOLED_ORG_FIELDS:
+            setattr(scratch_org, field, getattr(pooled, field))
+        scratch_org.owner_gh_username = user.username
+        scratch_org.owner_gh_id = user.github_id
+        scratch_org.save()
+        pooled.revisions.update(scratch_org=scratch_org)
+        pool = pooled.pool
+        expiry_job_id = pooled.expiry_job_id
+        forget_access_token(pooled)
+        pooled.hard_delete()
+
+    get_scheduler("default").cancel(expiry_job_id)
+    _schedule_expiry_alert(scratch_org)
+    # The org's admin user was set up for the pool's owner:
+    org_config = scratch_org.get_refreshed_org_config()
+    org_config.salesforce_client.User.update(
+        f"Username/{org_config.username}", {"Email": user.email}
+    )
+    pool.queue_refill()
+    return True
+
+
 def create_branches_on_github_then_create_scratch_org(
     *, scratch_org, originating_user_id
 ):
@@ -299,15 +459,20 @@ def create_branches_on_github_then_create_scratch_org(
             parent.latest_sha = repository.branch(commit_ish).latest_sha()
             parent.save()
             parent.notify_changed(originating_user_id=originating_user_id)
-        with local_github_checkout(user, repo_id, commit_ish) as repo_root:
-            _create_org_and_run_flow(
-                scratch_org,
-                user=user,
-                repo_id=repo_id,
-                repo_branch=commit_ish,
-                project_path=repo_root,
-                originating_user_id=originating_user_id,
-            )
+        # Pooled orgs are provisioned here too, but mustn't claim each other:
+        claimed = scratch_org.pool_id is None and _claim_pooled_scratch_org(
+            scratch_org, user=user, repo_id=repo_id, commit_ish=commit_ish
+        )
+        if not claimed:
+            with local_github_checkout(user, repo_id, commit_ish) as repo_root:
+                _create_org_and_run_flow(
+                    scratch_org,
+                    user=user,
+                    repo_id=repo_id,
+                    repo_branch=commit_ish,
+                    project_path=repo_root,
+                    originating_user_id=originating_user_id,
+                )
     except Exception as e:
         scratch_org.finalize_provision(error=e, originating_user_id=originating_user_id)
         tb = traceback.format_exc()
@@ -322,6 +487,68 @@ create_branches_on_github_then_create_scratch_org_job = job(
 )
 
 
+def refill_scratch_org_pool(pool):
+    """
+    Recycle a pool's orgs that were built from an old commit or are about to
+    expire, or that it no longer has room for, and provision new ones until
+    the pool is full again.
+    """
+    from .models import ScratchOrg, ScratchOrgType
+
+    # Refills are queued both on a schedule and whenever an org is claimed, and
+    # two at once would both fill the same gap. If one is running already, it or
+    # the next scheduled one will top up the pool:
+    lock_key = f"scratch_org_pool_refill_{pool.pk}"
+    if not cache.add(lock_key, True, timeout=SCRATCH_ORG_POOL_REFILL_LOCK_TIMEOUT):
+        return
+    try:
+        project = pool.project
+        repository = get_repo_info(
+            None, repo_owner=project.repo_owner, repo_name=project.repo_name
+        )
+        sha = repository.branch(
+            project.branch_name or repository.default_branch
+        ).latest_sha()
+        expiring = now() + timedelta(days=settings.DAYS_BEFORE_ORG_EXPIRY_TO_ALERT)
+
+        orgs = pool.orgs.active().filter(delete_queued_at__isnull=True)
+        stale = orgs.filter(is_created=True).filter(
+            ~Q(latest_commit=sha) | Q(expires_at__lte=expiring)
+        )
+        for scratch_org in stale:
+            scratch_org.queue_delete(originating_user_id=None)
+        surplus = orgs.filter(is_created=True).order_by("-created_at")[pool.size :]
+        for scratch_org in surplus:
+            scratch_org.queue_delete(originating_user_id=None)
+        for _i in range(pool.size - orgs.count()):
+            ScratchOrg.objects.create(
+                project=project,
+                pool=pool,
+                org_type=ScratchOrgType.PLAYGROUND,
+                org_config_name=pool.org_config_name,
+                owner=pool.owner,
+            )
+    except Exception:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise
+    finally:
+        cache.delete(lock_key)
+
+
+refill_scratch_org_pool_job = job(refill_scratch_org_pool)
+
+
+def refill_scratch_org_pools():
+    from .models import ScratchOrgPool
+
+    for pool in ScratchOrgPool.objects.all():
+        pool.queue_refill()
+
+
+refill_scratch_org_pools_job = job(refill_scratch_org_pools)
+
+
 def convert_to_dev_org(scratch_org, *, task, originating_user_id=None):
     """
     Convert an Epic playground org into a Task Dev org
@@ -393,15 +620,16 @@ refresh_scratch_org_job = job(refresh_scratch_org)
 def get_unsaved_changes(scratch_org, *, originating_user_id):
     try:
         scratch_org.refresh_from_db()
-        old_revision_numbers = scratch_org.latest_revision_numbers
         new_revision_numbers = get_latest_revision_numbers(
             scratch_org, originating_user_id=originating_user_id
         )
-        unsaved_changes = compare_revisions(old_revision_numbers, new_revision_numbers)
+        unsaved_changes = compare_sorted_revisions(
+            scratch_org.iter_revisions(), new_revision_numbers
+        )
         user = scratch_org.owner
         repo_id = scratch_org.parent.get_repo_id()
         commit_ish = scratch_org.parent.branch_name
-        with local_github_checkout(user, repo_id, commit_ish) as repo_root:
+        with local_github_metadata_checkout(user, repo_id, commit_ish) as repo_root:
             scratch_org.valid_target_directories, _ = get_valid_target_directories(
                 user,
                 scratch_org,
@@ -465,29 +693,24 @@ def commit_changes_from_org(
         scratch_org.latest_commit_url = commit.html_url
         scratch_org.latest_commit_at = commit.commit.author.get("date", None)
 
-        # Update scratch_org.latest_revision_numbers with appropriate
-        # numbers for the values in desired_changes.
+        # Update the org's revisions with appropriate numbers for the
+        # values in desired_changes.
         latest_revision_numbers = get_latest_revision_numbers(
             scratch_org, originating_user_id=originating_user_id
         )
-        for member_type in desired_changes.keys():
-            for member_name in desired_changes[member_type]:
-                try:
-                    member_type_dict = scratch_org.latest_revision_numbers[member_type]
-                except KeyError:
-                    member_type_dict = scratch_org.latest_revision_numbers[
-                        member_type
-                    ] = {}
-
-                # Mutate the scratch_org.latest_revision_numbers dict
-                # in-place:
-                member_type_dict[member_name] = latest_revision_numbers[member_type][
-                    member_name
-                ]
+        scratch_org.update_latest_revision_numbers(
+            {
+                member_type: {
+                    member_name: latest_revision_numbers[member_type][member_name]
+                    for member_name in member_names
+                }
+                for member_type, member_names in desired_changes.items()
+            }
+        )
 
         # Finally, update scratch_org.unsaved_changes
-        scratch_org.unsaved_changes = compare_revisions(
-            scratch_org.latest_revision_numbers, latest_revision_numbers
+        scratch_org.unsaved_changes = compare_sorted_revisions(
+            scratch_org.iter_revisions(), latest_revision_numbers
         )
     except Exception as e:
         scratch_org.refresh_from_db()
@@ -561,15 +784,18 @@ def delete_scratch_org(scratch_org, *, originating_user_id):
         scratch_org.refresh_from_db()
         scratch_org.delete_queued_at = None
         # If the scratch org has no `last_modified_at` or
-        # `latest_revision_numbers`, it was being deleted after an
+        # revisions, it was being deleted after an
         # unsuccessful initial flow run. In that case, fill in those
         # values so it's not in an in-between state.
         if not scratch_org.last_modified_at:
             scratch_org.last_modified_at = now()
-        if not scratch_org.latest_revision_numbers:
-            scratch_org.latest_revision_numbers = get_latest_revision_numbers(
-                scratch_org,
-                originating_user_id=originating_user_id,
+        if not scratch_org.revisions.exists():
+            scratch_org.set_latest_revision_numbers(
+                get_latest_revision_numbers(
+                    scratch_org,
+                    originating_user_id=originating_user_id,
+                    full=True,
+                )
             )
         scratch_org.save()
         async_to_sync(report_scratch_org_error)(
@@ -591,18 +817,40 @@ def refresh_github_repositories_for_user(user):
 
     try:
         repos = get_all_org_repos(user)
-        with transaction.atomic():
-            GitHubRepository.objects.filter(user=user).delete()
-            GitHubRepository.objects.bulk_create(
-                [
+        # Only touch the rows that changed, so concurrent readers never see a
+        # user without their repositories:
+        existing = {
+            repository.repo_id: repository
+            for repository in GitHubRepository.objects.filter(user=user)
+        }
+        to_create = []
+        to_update = []
+        for repo in repos:
+            repository = existing.pop(repo.id, None)
+            if repository is None:
+                to_create.append(
                     GitHubRepository(
                         user=user,
                         repo_id=repo.id,
                         repo_url=repo.html_url,
                         permissions=repo.permissions,
                     )
-                    for repo in repos
-                ]
+                )
+            elif (repository.repo_url, repository.permissions) != (
+                repo.html_url,
+                repo.permissions,
+            ):
+                repository.repo_url = repo.html_url
+                repository.permissions = repo.permissions
+                to_update.append(repository)
+        with transaction.atomic():
+            GitHubRepository.objects.filter(
+                pk__in=[repository.pk for repository in existing.values()]
+            ).delete()
+            GitHubRepository.objects.bulk_create(to_create)
+            GitHubRepository.objects.bulk_update(to_update, ["repo_url", "permissions"])
+            type(user).objects.filter(pk=user.pk).update(
+                repositories_refreshed_at=now()
             )
     except Exception as e:
         user.finalize_refresh_repositories(error=e)
@@ -639,8 +887,49 @@ def get_social_image(*, project):
 get_social_image_job = job(get_social_image)
 
 
-# This avoids partially-applied saving:
-@transaction.atomic
+def _commits_since(repo, head_sha, origin_sha):
+    """
+    Return the commits on `head_sha` since `origin_sha`, newest first, with a
+    single compare call. Returns None if the compare API can't tell us, i.e.
+    if `origin_sha` is gone (after a force push, say), the branch no longer
+    descends from it, or the comparison was truncated.
+    """
+    try:
+        comparison = repo.compare_commits(origin_sha, head_sha)
+    except (NotFoundError, UnprocessableEntity):
+        return None
+    if comparison.status not in ("ahead", "identical"):
+        return None
+    commits = comparison.commits or []
+    if comparison.total_commits > len(commits):
+        return None
+    return list(reversed(commits))
+
+
+class CommitHistory:
+    """
+    The commits on a branch, newest first, fetched lazily and only as far back
+    as needed.
+    """
+
+    def __init__(self, repo, head_sha):
+        # We limit it to 1000 commits to avoid hammering the API, and on the
+        # assumption that we will find the origin of the task branch within
+        # that limit.
+        self.iterator = iter(repo.commits(head_sha, number=1000))
+        self.commits = []
+        self.index = {}
+
+    def commits_since(self, sha):
+        while sha not in self.index:
+            commit = next(self.iterator, None)
+            if commit is None:
+                return None
+            self.index[commit.sha] = len(self.commits)
+            self.commits.append(commit)
+        return self.commits[: self.index[sha]]
+
+
 def refresh_commits(*, project, branch_name, originating_user_id):
     """
     This should only run when we're notified of a force-commit. It's the
@@ -651,46 +940,87 @@ def refresh_commits(*, project, branch_name, originating_user_id):
     repo = get_repo_info(
         None, repo_owner=project.repo_owner, repo_name=project.repo_name
     )
-    # We get this as a GitHubIterator, but we want to slice it later, so
-    # we will convert it to a list.
-    # We limit it to 1000 commits to avoid hammering the API, and on the
-    # assumption that we will find the origin of the task branch within
-    # that limit.
-    commits = list(repo.commits(repo.branch(branch_name).latest_sha(), number=1000))
+    latest_sha = repo.branch(branch_name).latest_sha()
 
     if project.branch_name == branch_name:
-        project.latest_sha = commits[0].sha if commits else ""
+        project.latest_sha = latest_sha
         project.finalize_project_update(originating_user_id=originating_user_id)
 
-    epics = Epic.objects.filter(project=project, branch_name=branch_name)
+    edited_at = now()
+    epics = list(Epic.objects.filter(project=project, branch_name=branch_name))
     for epic in epics:
-        epic.latest_sha = commits[0].sha if commits else ""
-        epic.finalize_epic_update(originating_user_id=originating_user_id)
+        epic.latest_sha = latest_sha
+        epic.edited_at = edited_at
 
-    tasks = Task.objects.filter(
-        Q(project=project, branch_name=branch_name)
-        | Q(epic__project=project, branch_name=branch_name)
+    tasks = list(
+        Task.objects.filter(
+            Q(project=project, branch_name=branch_name)
+            | Q(epic__project=project, branch_name=branch_name)
+        )
     )
+    history = CommitHistory(repo, latest_sha)
+    commits_by_origin = {}
     for task in tasks:
-        origin_sha_index = [commit.sha for commit in commits].index(task.origin_sha)
-        task.commits = [
-            normalize_commit(commit) for commit in commits[:origin_sha_index]
-        ]
-        task.update_has_unmerged_commits()
+        if task.origin_sha not in commits_by_origin:
+            commits = _commits_since(repo, latest_sha, task.origin_sha)
+            if commits is None:
+                commits = history.commits_since(task.origin_sha)
+            commits_by_origin[task.origin_sha] = commits
+        commits = commits_by_origin[task.origin_sha]
+        if commits is None:
+            logger.warning(
+                f"Origin {task.origin_sha} of {task} is not on {branch_name}; "
+                "keeping its commits"
+            )
+        else:
+            task.commits = [normalize_commit(commit) for commit in commits]
         task.update_review_valid()
-        task.finalize_task_update(originating_user_id=originating_user_id)
+        task.edited_at = edited_at
+    Task.update_has_unmerged_commits_in_bulk(tasks)
+
+    # bulk_update() skips save(), which is fine here: changing commits doesn't
+    # change the status of a Task or its Epic.
+    with transaction.atomic():
+        Epic.objects.bulk_update(epics, ["latest_sha", "edited_at"])
+        Task.objects.bulk_update(
+            tasks, ["commits", "has_unmerged_commits", "review_valid", "edited_at"]
+        )
+    for instance in [*epics, *tasks]:
+        instance.notify_changed(originating_user_id=originating_user_id)
 
 
 refresh_commits_job = job(refresh_commits)
 
 
+def defer_if_rate_limited(func, project, **kwargs):
+    """
+    Reschedule a low-priority job for when the App's rate limit resets if the
+    budget is running low, leaving it for user-facing work. Returns whether the
+    job was deferred.
+    """
+    deferral_time = get_app_deferral_time(project.repo_owner, project.repo_name)
+    if deferral_time is None:
+        return False
+    logger.info(f"Deferring {func.__name__} for {project} until {deferral_time}")
+    get_scheduler("default").enqueue_at(deferral_time, func, project, **kwargs)
+    return True
+
+
 def refresh_github_users(project, *, originating_user_id):
     try:
         project.refresh_from_db()
+        if defer_if_rate_limited(
+            refresh_github_users, project, originating_user_id=originating_user_id
+        ):
+            # Don't leave the refresh showing as in progress until the deferred job:
+            project.finalize_refresh_github_users(
+                originating_user_id=originating_user_id, changed=False
+            )
+            return
         repo = get_repo_info(
             None, repo_owner=project.repo_owner, repo_name=project.repo_name
         )
-        project.github_users = list(
+        github_users = list(
             sorted(
                 [
                     {
@@ -706,16 +1036,21 @@ def refresh_github_users(project, *, originating_user_id):
         )
 
         # Retrieve additional information for each user by querying GitHub
-        gh = GitHub(repo)
+        gh = GitHub(session=repo.session)
+        try:
+            full_users = get_cached_users(gh, [user["login"] for user in github_users])
+        except Exception:
+            logger.exception("Failed to expand GitHub users")
+            full_users = {}
         expanded_users = []
-        for user in project.github_users:
-            try:
-                full_user = get_cached_user(gh, user["login"])
-                expanded = {**user, "name": full_user.name}
-            except Exception:
-                logger.exception(f"Failed to expand GitHub user {user['login']}")
+        for user in github_users:
+            if user["login"] in full_users:
+                expanded = {**user, "name": full_users[user["login"]].name}
+            else:
+                logger.warning(f"Failed to expand GitHub user {user['login']}")
                 expanded = user
             expanded_users.append(expanded)
+        changed = expanded_users != project.github_users
         project.github_users = expanded_users
 
     except Exception as e:
@@ -726,45 +1061,211 @@ def refresh_github_users(project, *, originating_user_id):
         logger.error(tb)
         raise
     else:
-        project.finalize_refresh_github_users(originating_user_id=originating_user_id)
+        project.finalize_refresh_github_users(
+            originating_user_id=originating_user_id, changed=changed
+        )
 
 
 refresh_github_users_job = job(refresh_github_users)
 
 
-def refresh_github_issues(project, *, originating_user_id):
+# Projects whose repository can't be found (e.g. the GitHub App isn't installed
+# on it yet) are retried after a delay that doubles with each failure:
+REPO_ID_BACKOFF_BASE = 60  # 1 minute
+REPO_ID_BACKOFF_MAX = 60 * 60 * 24  # 1 day
+
+
+def get_repo_id_backoff_key(project):
+    return f"project_repo_id_backoff_{project.pk}"
+
+
+def populate_project_repo_ids():
+    from .models import Project
+
+    for project in Project.objects.filter(repo_id__isnull=True):
+        key = get_repo_id_backoff_key(project)
+        backoff = cache.get(key, {"failures": 0, "retry_at": None})
+        if backoff["retry_at"] and now() < backoff["retry_at"]:
+            continue
+        try:
+            project.get_repo_id()
+        except (ResponseError, ConnectionError) as e:
+            failures = backoff["failures"] + 1
+            delay = min(REPO_ID_BACKOFF_BASE * 2 ** (failures - 1), REPO_ID_BACKOFF_MAX)
+            logger.warning(
+                f"Failed to get the repo ID of {project} ({failures} times), "
+                f"retrying in {delay}s: {e}"
+            )
+            cache.set(
+                key,
+                {"failures": failures, "retry_at": now() + timedelta(seconds=delay)},
+                timeout=REPO_ID_BACKOFF_MAX * 2,
+            )
+        else:
+            cache.delete(key)
+
+
+populate_project_repo_ids_job = job(populate_project_repo_ids)
+
+
+def _upsert_github_issues(project, gh_issues):
+    """
+    Create or update many issues in a few queries. Only open issues are
+    created; closed ones are only of interest if we already list them.
+    """
+    fields = ("title", "number", "state", "html_url", "created_at", "updated_at")
+    existing = {
+        issue.github_id: issue
+        for issue in project.issues.filter(
+            github_id__in=[gh_issue.id for gh_issue in gh_issues]
+        )
+    }
+    to_create = []
+    to_update = []
+    for gh_issue in gh_issues:
+        issue = existing.get(gh_issue.id)
+        if issue is None:
+            if gh_issue.state != IssueStates.OPEN:
+                continue
+            issue = project.issues.model(project=project, github_id=gh_issue.id)
+            to_create.append(issue)
+        else:
+            to_update.append(issue)
+        for field in fields:
+            setattr(issue, field, getattr(gh_issue, field))
+    with transaction.atomic():
+        project.issues.model.objects.bulk_create(to_create)
+        project.issues.model.objects.bulk_update(to_update, fields)
+
+
+def process_github_hook_delivery(delivery):
+    """
+    Process a webhook payload. Pushes to the same branch that are still
+    waiting to be processed are coalesced into one refresh of its commits.
+    """
+    from .hook_serializers import HOOK_SERIALIZERS
+    from .models import GitHubHookDelivery
+
+    # Claim the deliveries to process, so that the jobs of any coalesced with
+    # this one find nothing left to do:
+    with transaction.atomic():
+        pending = GitHubHookDelivery.objects.select_for_update().filter(
+            processed_at__isnull=True
+        )
+        if delivery.event == "push":
+            claimed = list(
+                pending.filter(event="push", repo_id=delivery.repo_id, ref=delivery.ref)
+            )
+        else:
+            claimed = list(pending.filter(pk=delivery.pk))
+        GitHubHookDelivery.objects.filter(pk__in=[d.pk for d in claimed]).update(
+            processed_at=now()
+        )
+    if not claimed:
+        return
+
+    serializers = {}
+    for claimed_delivery in claimed:
+        serializer = HOOK_SERIALIZERS[claimed_delivery.event](
+            data=claimed_delivery.payload
+        )
+        if serializer.is_valid():
+            serializers[claimed_delivery.pk] = serializer
+        else:
+            # No retry would do any better, so it stays processed:
+            logger.error(f"Invalid {claimed_delivery}: {serializer.errors}")
+    if not serializers:
+        return
+
+    try:
+        *superseded, latest = serializers.values()
+        if superseded:
+            for serializer in superseded:
+                serializer.update_branch_index()
+            latest.process_hook(reconcile=True)
+        else:
+            latest.process_hook()
+    except Exception:
+        # Put the deliveries back, for the next push to the same branch (or an
+        # admin) to process again:
+        GitHubHookDelivery.objects.filter(pk__in=serializers).update(processed_at=None)
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise
+
+
+process_github_hook_delivery_job = job(process_github_hook_delivery)
+
+
+def prune_github_hook_deliveries():
+    """Delete processed webhook deliveries past their retention period."""
+    from .models import GitHubHookDelivery
+
+    cutoff = now() - timedelta(days=settings.GITHUB_HOOK_DELIVERY_RETENTION_DAYS)
+    GitHubHookDelivery.objects.filter(processed_at__lt=cutoff).delete()
+
+
+prune_github_hook_deliveries_job = job(prune_github_hook_deliveries)
+
+
+def refresh_github_issues(project, *, originating_user_id, full=False):
+    """
+    Sync a Project's issues with GitHub. Once a full refresh has succeeded,
+    later refreshes only ask for the issues updated since the last one, unless
+    `full` is set.
+    """
     try:
         project.refresh_from_db()
+        if defer_if_rate_limited(
+            refresh_github_issues,
+            project,
+            originating_user_id=originating_user_id,
+            full=full,
+        ):
+            # Don't leave the refresh showing as in progress until the deferred job:
+            project.finalize_refresh_github_issues(
+                originating_user_id=originating_user_id
+            )
+            return
         repo = get_repo_info(
             None, repo_owner=project.repo_owner, repo_name=project.repo_name
         )
 
+        since = None if full else project.issues_refreshed_at
+        if since is None:
+            issues = repo.issues()
+        else:
+            # Oldest first, so a run that hits the limit can pick up where it
+            # left off. This includes issues closed since, to update their state:
+            issues = repo.issues(
+                state="all", sort="updated", direction="asc", since=since
+            )
+
         # Unfortunately the GitHub API includes pull requests when querying for issues,
         # and we can't filter them out in the request. Instead we manually filter out
         # pull requests until we have enough issues.
-        project.has_truncated_issues = True
-        issues = repo.issues()
-        count = 0
-        while count < settings.GITHUB_ISSUE_LIMIT:
+        truncated = True
+        gh_issues = []
+        while len(gh_issues) < settings.GITHUB_ISSUE_LIMIT:
             try:
                 issue = next(issues)
             except StopIteration:
-                project.has_truncated_issues = False
+                truncated = False
                 break
             if issue.pull_request_urls is not None:
                 continue  # Issue is actually a pull request, skip
-            project.issues.update_or_create(
-                github_id=issue.id,
-                defaults={
-                    "title": issue.title,
-                    "number": issue.number,
-                    "state": issue.state,
-                    "html_url": issue.html_url,
-                    "created_at": issue.created_at,
-                    "updated_at": issue.updated_at,
-                },
+            gh_issues.append(issue)
+
+        _upsert_github_issues(project, gh_issues)
+        if since is None:
+            project.has_truncated_issues = truncated
+            project.issues_refreshed_at = max(
+                (issue.updated_at for issue in gh_issues), default=now()
+            )
+        elif gh_issues:
+            project.issues_refreshed_at = max(
+                since, *(issue.updated_at for issue in gh_issues)
             )
-            count += 1
 
     except Exception as e:
         project.finalize_refresh_github_issues(
@@ -932,7 +1433,7 @@ def available_org_config_names(project, *, user):
             repo_owner=project.repo_owner,
             repo_name=project.repo_name,
         )
-        with local_github_checkout(user, repo_id) as repo_root:
+        with local_github_metadata_checkout(user, repo_id) as repo_root:
             config = get_project_config(
                 repo_root=repo_root,
                 repo_name=repo.name,
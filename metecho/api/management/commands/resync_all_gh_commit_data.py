@@ -1,39 +1,133 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
 from django.core.management.base import BaseCommand
+from django.db import connections
 from django.db.models import Q
-from github3.exceptions import ResponseError
 
+from ...gh_memo import memoize_github
 from ...jobs import refresh_commits
 from ...models import Epic, Project, Task
 
 
+def get_branches():
+    """
+    Return the distinct branches to refresh as a dict of (project ID, branch name)
+    to project. `refresh_commits` updates everything on a branch, so each is
+    only refreshed once, however many Epics and Tasks share it.
+    """
+    branches = {}
+    for project in Project.objects.exclude(branch_name=""):
+        branches.setdefault((project.id, project.branch_name), project)
+    for epic in Epic.objects.exclude(branch_name="").select_related("project"):
+        branches.setdefault((epic.project.id, epic.branch_name), epic.project)
+    tasks = Task.objects.exclude(Q(branch_name="") | Q(origin_sha="")).select_related(
+        "project", "epic__project"
+    )
+    for task in tasks:
+        project = task.root_project
+        branches.setdefault((project.id, task.branch_name), project)
+    return branches
+
+
 class Command(BaseCommand):
     help = "Remove and resync all stored commits from GitHub."
 
-    def handle(self, *args, **options):
-        for project in Project.objects.exclude(branch_name=""):
-            try:
-                refresh_commits(
-                    project=project,
-                    branch_name=project.branch_name,
-                    originating_user_id=None,
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of branches to refresh at once.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default="resync_all_gh_commit_data.checkpoint",
+            help="File recording the branches that have been refreshed.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Skip the branches recorded in the checkpoint file.",
+        )
+
+    def handle(self, *args, workers, checkpoint, resume, **options):
+        checkpoint = Path(checkpoint)
+        done = set()
+        if resume and checkpoint.exists():
+            done = set(checkpoint.read_text().splitlines())
+        elif checkpoint.exists():
+            checkpoint.unlink()
+
+        branches = {
+            key: project
+            for key, project in get_branches().items()
+            if self.checkpoint_line(key) not in done
+        }
+        self.total = len(branches)
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.stdout.write(
+            f"Refreshing {self.total} branches ({len(done)} already done) "
+            f"with {workers} workers"
+        )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor, checkpoint.open(
+            "a"
+        ) as checkpoint_file:
+            futures = {
+                executor.submit(self.refresh_branch, project, branch_name): (
+                    project,
+                    branch_name,
                 )
-            except ResponseError:  # pragma: nocover
-                pass
-        for epic in Epic.objects.exclude(branch_name=""):
-            try:
+                for (_, branch_name), project in branches.items()
+            }
+            for future in as_completed(futures):
+                project, branch_name = futures[future]
+                self.report(future, project, branch_name, checkpoint_file)
+
+        elapsed = time.monotonic() - self.started_at
+        self.stdout.write(
+            f"Refreshed {self.completed} branches in {elapsed:.1f}s, "
+            f"{self.failed} failed"
+        )
+
+    def checkpoint_line(self, key):
+        project_id, branch_name = key
+        return f"{project_id} {branch_name}"
+
+    def refresh_branch(self, project, branch_name):
+        try:
+            with memoize_github():
                 refresh_commits(
-                    project=epic.project,
-                    branch_name=epic.branch_name,
+                    project=project,
+                    branch_name=branch_name,
                     originating_user_id=None,
                 )
-            except ResponseError:  # pragma: nocover
-                pass
-        for task in Task.objects.exclude(Q(branch_name="") | Q(origin_sha="")):
+        finally:
+            # Each thread has its own database connection:
+            connections.close_all()
+
+    def report(self, future, project, branch_name, checkpoint_file):
+        with self.lock:
             try:
-                refresh_commits(
-                    project=task.root_project,
-                    branch_name=task.branch_name,
-                    originating_user_id=None,
-                )
-            except ResponseError:  # pragma: nocover
-                pass
+                future.result()
+            except Exception as e:
+                # Not checkpointed, so --resume will retry it:
+                self.failed += 1
+                self.stderr.write(f"Failed to refresh {project} {branch_name}: {e}")
+                return
+            self.completed += 1
+            checkpoint_file.write(
+                self.checkpoint_line((project.id, branch_name)) + "\n"
+            )
+            checkpoint_file.flush()
+            elapsed = time.monotonic() - self.started_at
+            self.stdout.write(
+                f"[{self.completed + self.failed}/{self.total}] {project} "
+                f"{branch_name} ({self.completed / elapsed:.1f} branches/s)"
+            )
@@ -1,5 +1,12 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from django.core.management.base import BaseCommand
+from django.db import connections
 
+from ...gh import get_installation_id
 from ...jobs import refresh_github_users
 from ...models import Project
 
@@ -7,6 +14,68 @@ from ...models import Project
 class Command(BaseCommand):
     help = "Reset and resync all stored collaborator lists from GitHub."
 
-    def handle(self, *args, **options):
-        for project in Project.objects.all():
-            refresh_github_users(project, originating_user_id=None)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of projects to refresh at once.",
+        )
+        parser.add_argument(
+            "--per-installation",
+            type=int,
+            default=2,
+            help="Number of projects to refresh at once per GitHub App installation.",
+        )
+
+    def handle(self, *args, workers, per_installation, **options):
+        projects = list(Project.objects.all())
+        # GitHub's secondary rate limits apply to concurrent requests made with
+        # the same credentials, so each installation gets its own smaller limit:
+        self.installation_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(per_installation)
+        )
+        self.slots_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.stdout.write(
+            f"Refreshing collaborators of {len(projects)} projects "
+            f"with {workers} workers"
+        )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self.refresh_project, project): project
+                for project in projects
+            }
+            for future in as_completed(futures):
+                project = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.failed += 1
+                    self.stderr.write(f"Failed to refresh {project}: {e}")
+                else:
+                    self.completed += 1
+
+        elapsed = time.monotonic() - self.started_at
+        self.stdout.write(
+            f"Refreshed {self.completed} projects in {elapsed:.1f}s, "
+            f"{self.failed} failed"
+        )
+
+    def get_installation_slot(self, project):
+        installation_id = get_installation_id(project.repo_owner, project.repo_name)
+        with self.slots_lock:
+            return self.installation_slots[installation_id]
+
+    def refresh_project(self, project):
+        try:
+            # refresh_github_users itself defers the project if the
+            # installation's rate-limit budget is running low:
+            with self.get_installation_slot(project):
+                refresh_github_users(project, originating_user_id=None)
+        finally:
+            # Each thread has its own database connection:
+            connections.close_all()
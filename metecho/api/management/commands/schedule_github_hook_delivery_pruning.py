@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from django_rq import get_scheduler
+
+from ...jobs import prune_github_hook_deliveries
+
+
+class Command(BaseCommand):
+    help = "Schedule the periodic deletion of old processed GitHub webhooks."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=60 * 60 * 24,
+            help="Seconds between prunings.",
+        )
+
+    def handle(self, *args, interval, **options):
+        scheduler = get_scheduler("default")
+        # Replace any schedule left by an earlier release:
+        func_name = (
+            f"{prune_github_hook_deliveries.__module__}.prune_github_hook_deliveries"
+        )
+        for job in scheduler.get_jobs():
+            if job.func_name == func_name:
+                scheduler.cancel(job)
+        scheduler.schedule(
+            scheduled_time=now(),
+            func=prune_github_hook_deliveries,
+            interval=interval,
+            repeat=None,
+        )
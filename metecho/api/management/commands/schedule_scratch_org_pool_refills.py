@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from django_rq import get_scheduler
+
+from ...jobs import refill_scratch_org_pools
+
+
+class Command(BaseCommand):
+    help = "Schedule the periodic refill of all scratch org pools."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=600,
+            help="Seconds between refills.",
+        )
+
+    def handle(self, *args, interval, **options):
+        scheduler = get_scheduler("default")
+        # Replace any schedule left by an earlier release:
+        func_name = f"{refill_scratch_org_pools.__module__}.refill_scratch_org_pools"
+        for job in scheduler.get_jobs():
+            if job.func_name == func_name:
+                scheduler.cancel(job)
+        scheduler.schedule(
+            scheduled_time=now(),
+            func=refill_scratch_org_pools,
+            interval=interval,
+            repeat=None,
+        )
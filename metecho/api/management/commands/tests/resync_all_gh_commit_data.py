@@ -1,14 +1,17 @@
 from contextlib import ExitStack
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from django.core.management import call_command
+from github3.exceptions import NotFoundError
 
+module_name = "metecho.api.management.commands.resync_all_gh_commit_data"
 
-@pytest.mark.django_db
-def test_resync_all_gh_commit_data(project_factory, epic_factory, task_factory):
-    module_name = "metecho.api.management.commands.resync_all_gh_commit_data"
 
+@pytest.mark.django_db
+def test_resync_all_gh_commit_data(
+    tmp_path, project_factory, epic_factory, task_factory
+):
     with ExitStack() as stack:
         refresh_commits = stack.enter_context(patch(f"{module_name}.refresh_commits"))
         project_factory()
@@ -18,6 +21,55 @@ def test_resync_all_gh_commit_data(project_factory, epic_factory, task_factory):
             origin_sha="1234567sha",
             epic__project__repo_id=1234,
         )
-        call_command("resync_all_gh_commit_data")
+        call_command(
+            "resync_all_gh_commit_data", checkpoint=str(tmp_path / "checkpoint")
+        )
 
         assert refresh_commits.called
+
+
+@pytest.mark.django_db
+def test_resync_all_gh_commit_data__shared_branch(
+    tmp_path, project_factory, epic_factory, task_factory
+):
+    project = project_factory(branch_name="main")
+    epic = epic_factory(project=project, branch_name="feature")
+    task_factory(epic=epic, branch_name="feature", origin_sha="1234567sha")
+
+    with patch(f"{module_name}.refresh_commits") as refresh_commits:
+        call_command(
+            "resync_all_gh_commit_data", checkpoint=str(tmp_path / "checkpoint")
+        )
+
+    branch_names = sorted(
+        call.kwargs["branch_name"] for call in refresh_commits.call_args_list
+    )
+    assert branch_names == ["feature", "main"]
+
+
+@pytest.mark.django_db
+def test_resync_all_gh_commit_data__resume(tmp_path, project_factory, epic_factory):
+    checkpoint = tmp_path / "checkpoint"
+    project = project_factory(branch_name="main")
+    epic_factory(project=project, branch_name="feature")
+
+    with patch(f"{module_name}.refresh_commits") as refresh_commits:
+
+        def fail_feature(*, branch_name, **kwargs):
+            if branch_name == "feature":
+                raise NotFoundError(MagicMock(status_code=404))
+
+        refresh_commits.side_effect = fail_feature
+        call_command("resync_all_gh_commit_data", checkpoint=str(checkpoint))
+
+        assert checkpoint.read_text() == f"{project.id} main\n"
+
+        refresh_commits.reset_mock(side_effect=True)
+        call_command(
+            "resync_all_gh_commit_data", checkpoint=str(checkpoint), resume=True
+        )
+
+    refresh_commits.assert_called_once_with(
+        project=project, branch_name="feature", originating_user_id=None
+    )
+    assert checkpoint.read_text() == f"{project.id} main\n{project.id} feature\n"
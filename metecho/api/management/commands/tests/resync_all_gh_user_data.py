@@ -4,17 +4,34 @@ from unittest.mock import patch
 import pytest
 from django.core.management import call_command
 
+module_name = "metecho.api.management.commands.resync_all_gh_user_data"
+
 
 @pytest.mark.django_db
 def test_resync_all_gh_user_data(project_factory):
-    module_name = "metecho.api.management.commands.resync_all_gh_user_data"
-
     with ExitStack() as stack:
         project_factory(repo_id=1234)
 
+        stack.enter_context(patch(f"{module_name}.get_installation_id"))
         refresh_github_users = stack.enter_context(
             patch(f"{module_name}.refresh_github_users")
         )
         call_command("resync_all_gh_user_data")
 
         assert refresh_github_users.called
+
+
+@pytest.mark.django_db
+def test_resync_all_gh_user_data__failure(project_factory):
+    with ExitStack() as stack:
+        project_factory(repo_id=1234)
+        project_factory(repo_id=5678)
+
+        stack.enter_context(patch(f"{module_name}.get_installation_id"))
+        refresh_github_users = stack.enter_context(
+            patch(f"{module_name}.refresh_github_users")
+        )
+        refresh_github_users.side_effect = [Exception("Oops"), None]
+        call_command("resync_all_gh_user_data", workers=1)
+
+        assert refresh_github_users.call_count == 2
@@ -0,0 +1,21 @@
+from unittest.mock import MagicMock
+
+from django.core.management import call_command
+
+from ....jobs import prune_github_hook_deliveries
+
+
+def test_schedule_github_hook_delivery_pruning(mocker):
+    scheduler = mocker.patch(
+        "metecho.api.management.commands.schedule_github_hook_delivery_pruning."
+        "get_scheduler"
+    ).return_value
+    old_job = MagicMock(func_name="metecho.api.jobs.prune_github_hook_deliveries")
+    other_job = MagicMock(func_name="metecho.api.jobs.refill_scratch_org_pools")
+    scheduler.get_jobs.return_value = [old_job, other_job]
+
+    call_command("schedule_github_hook_delivery_pruning", interval=60)
+
+    scheduler.cancel.assert_called_once_with(old_job)
+    assert scheduler.schedule.call_args.kwargs["func"] == prune_github_hook_deliveries
+    assert scheduler.schedule.call_args.kwargs["interval"] == 60
@@ -0,0 +1,21 @@
+from unittest.mock import MagicMock
+
+from django.core.management import call_command
+
+from ....jobs import refill_scratch_org_pools
+
+
+def test_schedule_scratch_org_pool_refills(mocker):
+    scheduler = mocker.patch(
+        "metecho.api.management.commands.schedule_scratch_org_pool_refills."
+        "get_scheduler"
+    ).return_value
+    old_job = MagicMock(func_name="metecho.api.jobs.refill_scratch_org_pools")
+    other_job = MagicMock(func_name="metecho.api.jobs.alert_user_about_expiring_org")
+    scheduler.get_jobs.return_value = [old_job, other_job]
+
+    call_command("schedule_scratch_org_pool_refills", interval=60)
+
+    scheduler.cancel.assert_called_once_with(old_job)
+    assert scheduler.schedule.call_args.kwargs["func"] == refill_scratch_org_pools
+    assert scheduler.schedule.call_args.kwargs["interval"] == 60
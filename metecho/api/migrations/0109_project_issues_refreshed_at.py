@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2022-03-01 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0108_project_has_truncated_issues"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="issues_refreshed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.0.2 on 2022-03-01 12:00
+
+import hashid_field.field
+import sfdo_template_helpers.fields.string
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0110_user_repositories_refreshed_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GitHubHookDelivery",
+            fields=[
+                (
+                    "id",
+                    hashid_field.field.HashidAutoField(
+                        alphabet="abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890",  # noqa
+                        min_length=7,
+                        prefix="",
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("delivery_id", models.CharField(max_length=64, unique=True)),
+                ("event", models.CharField(max_length=64)),
+                ("payload", models.JSONField()),
+                (
+                    "repo_id",
+                    models.IntegerField(blank=True, db_index=True, null=True),
+                ),
+                (
+                    "ref",
+                    sfdo_template_helpers.fields.string.StringField(blank=True),
+                ),
+                ("received_at", models.DateTimeField(auto_now_add=True)),
+                ("processed_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "GitHub hook delivery",
+                "verbose_name_plural": "GitHub hook deliveries",
+                "ordering": ("received_at",),
+            },
+        ),
+    ]
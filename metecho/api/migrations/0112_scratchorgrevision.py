@@ -0,0 +1,89 @@
+# Generated by Django 4.0.2 on 2022-03-08 12:00
+
+import django.db.models.deletion
+import sfdo_template_helpers.fields.string
+from django.db import migrations, models
+
+
+def normalize_revision_numbers(apps, schema_editor):
+    """
+    Move each ScratchOrg's `latest_revision_numbers` into ScratchOrgRevisions.
+    """
+    ScratchOrg = apps.get_model("api", "ScratchOrg")
+    ScratchOrgRevision = apps.get_model("api", "ScratchOrgRevision")
+
+    for scratch_org in ScratchOrg.objects.exclude(latest_revision_numbers={}):
+        ScratchOrgRevision.objects.bulk_create(
+            (
+                ScratchOrgRevision(
+                    scratch_org=scratch_org,
+                    member_type=member_type,
+                    member_name=member_name,
+                    revision=revision,
+                )
+                for member_type, members in scratch_org.latest_revision_numbers.items()
+                for member_name, revision in members.items()
+            ),
+            batch_size=1000,
+        )
+
+
+def denormalize_revision_numbers(apps, schema_editor):
+    """
+    Copy ScratchOrgRevisions back into each ScratchOrg's `latest_revision_numbers`.
+    """
+    ScratchOrg = apps.get_model("api", "ScratchOrg")
+
+    for scratch_org in ScratchOrg.objects.filter(revisions__isnull=False).distinct():
+        latest_revision_numbers = {}
+        for revision in scratch_org.revisions.all():
+            latest_revision_numbers.setdefault(revision.member_type, {})[
+                revision.member_name
+            ] = revision.revision
+        scratch_org.latest_revision_numbers = latest_revision_numbers
+        scratch_org.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0111_githubhookdelivery"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScratchOrgRevision",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("member_type", sfdo_template_helpers.fields.string.StringField()),
+                ("member_name", sfdo_template_helpers.fields.string.StringField()),
+                ("revision", models.IntegerField()),
+                (
+                    "scratch_org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="revisions",
+                        to="api.scratchorg",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("scratch_org", "member_type", "member_name")},
+            },
+        ),
+        migrations.RunPython(
+            normalize_revision_numbers, reverse_code=denormalize_revision_numbers
+        ),
+        migrations.RemoveField(
+            model_name="scratchorg",
+            name="latest_revision_numbers",
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.0.2 on 2022-03-10 12:00
+
+import django.db.models.deletion
+import hashid_field.field
+import sfdo_template_helpers.fields.string
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("api", "0112_scratchorgrevision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScratchOrgPool",
+            fields=[
+                (
+                    "id",
+                    hashid_field.field.HashidAutoField(
+                        alphabet="abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890",  # noqa
+                        min_length=7,
+                        prefix="",
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("org_config_name", sfdo_template_helpers.fields.string.StringField()),
+                ("size", models.PositiveSmallIntegerField(default=1)),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="scratch_org_pools",
+                        to="api.project",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("project", "org_config_name")},
+            },
+        ),
+        migrations.AddField(
+            model_name="scratchorg",
+            name="pool",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="orgs",
+                to="api.scratchorgpool",
+            ),
+        ),
+    ]
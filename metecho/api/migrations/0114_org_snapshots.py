@@ -0,0 +1,68 @@
+# Generated by Django 4.0.2 on 2022-03-14 12:00
+
+import django.db.models.deletion
+import hashid_field.field
+import sfdo_template_helpers.fields.string
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0113_scratchorgpool"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="uses_org_snapshots",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="ScratchOrgSnapshot",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("edited_at", models.DateTimeField(auto_now=True)),
+                (
+                    "id",
+                    hashid_field.field.HashidAutoField(
+                        alphabet="abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890",  # noqa
+                        min_length=7,
+                        prefix="",
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("org_config_name", sfdo_template_helpers.fields.string.StringField()),
+                ("key", models.CharField(max_length=64)),
+                ("devhub_username", sfdo_template_helpers.fields.string.StringField()),
+                ("snapshot_id", models.CharField(max_length=18)),
+                ("snapshot_name", models.CharField(max_length=15)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("In Progress", "In Progress"),
+                            ("Active", "Active"),
+                            ("Error", "Error"),
+                        ],
+                        default="In Progress",
+                        max_length=32,
+                    ),
+                ),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="org_snapshots",
+                        to="api.project",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {
+                    ("project", "org_config_name", "key", "devhub_username")
+                },
+            },
+        ),
+    ]
@@ -2,6 +2,7 @@ import html
 import logging
 from contextlib import suppress
 from datetime import timedelta
+from functools import partial
 from typing import Dict, Optional, Tuple
 
 from allauth.account.signals import user_logged_in
@@ -12,10 +13,12 @@ from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import UserManager as BaseUserManager
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models, transaction
+from django.db.models.functions import Collate
 from django.db.models.query_utils import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -56,6 +59,12 @@ class OrgType(models.TextChoices):
     DEVELOPER = "Developer"
 
 
+class ScratchOrgSnapshotStatus(models.TextChoices):
+    IN_PROGRESS = "In Progress"
+    ACTIVE = "Active"
+    ERROR = "Error"
+
+
 class ScratchOrgType(models.TextChoices):
     DEV = "Dev"
     QA = ("QA", "QA")
@@ -107,6 +116,7 @@ class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
 class User(HashIdMixin, AbstractUser):
     objects = UserManager()
     currently_fetching_repos = models.BooleanField(default=False)
+    repositories_refreshed_at = models.DateTimeField(null=True, blank=True)
     devhub_username = StringField(blank=True, default="")
     allow_devhub_override = models.BooleanField(default=False)
     agreed_to_tos_at = models.DateTimeField(null=True, blank=True)
@@ -134,9 +144,19 @@ class User(HashIdMixin, AbstractUser):
             fail_silently=False,
         )
 
-    def queue_refresh_repositories(self):
+    def queue_refresh_repositories(self, *, force=False):
+        """
+        Unless `force` is set, repositories synced within the last
+        `GITHUB_REPOS_RECHECK_MINUTES` aren't fetched again.
+        """
         from .jobs import refresh_github_repositories_for_user_job
 
+        is_fresh = self.repositories_refreshed_at and (
+            timezone.now() - self.repositories_refreshed_at
+            < timedelta(minutes=settings.GITHUB_REPOS_RECHECK_MINUTES)
+        )
+        if is_fresh and not force:
+            return
         if not self.currently_fetching_repos:
             self.currently_fetching_repos = True
             self.save()
@@ -318,6 +338,9 @@ class Project(
     repo_id = models.IntegerField(null=True, blank=True, unique=True)
     repo_image_url = models.URLField(blank=True)
     include_repo_image_url = models.BooleanField(default=True)
+    # Create scratch orgs from snapshots of orgs whose setup flow has run, for
+    # as long as the files the flow could depend on are unchanged:
+    uses_org_snapshots = models.BooleanField(default=False)
     branch_name = models.CharField(
         max_length=100,
         blank=True,
@@ -347,6 +370,8 @@ class Project(
     currently_fetching_github_users = models.BooleanField(default=False)
     latest_sha = StringField(blank=True)
     currently_fetching_issues = models.BooleanField(default=False)
+    # Watermark for incremental issue refreshes, in GitHub's `updated_at` time:
+    issues_refreshed_at = models.DateTimeField(null=True, blank=True)
 
     slug_class = ProjectSlug
     tracker = FieldTracker(fields=["name"])
@@ -398,6 +423,19 @@ class Project(
         self.save()
         self.notify_changed(originating_user_id=None)
 
+    @classmethod
+    def queue_populate_repo_ids(cls):
+        """
+        Queue a job to look up missing repo IDs, at most once a minute however
+        often it's called.
+        """
+        from .jobs import populate_project_repo_ids_job
+
+        if cls.objects.filter(repo_id__isnull=True).exists() and cache.add(
+            "populate_project_repo_ids_queued", True, timeout=60
+        ):
+            populate_project_repo_ids_job.delay()
+
     def queue_refresh_github_users(self, *, originating_user_id):
         from .jobs import refresh_github_users_job
 
@@ -408,7 +446,13 @@ class Project(
                 self, originating_user_id=originating_user_id
             )
 
-    def finalize_refresh_github_users(self, *, error=None, originating_user_id):
+    def finalize_refresh_github_users(
+        self, *, error=None, originating_user_id, changed=True
+    ):
+        # Nobody is waiting on an unchanged scheduled refresh, so don't save it
+        # or notify every client subscribed to the project:
+        if error is None and not changed and not self.currently_fetching_github_users:
+            return
         self.currently_fetching_github_users = False
         self.save()
         if error is None:
@@ -416,7 +460,7 @@ class Project(
         else:
             self.notify_error(error, originating_user_id=originating_user_id)
 
-    def queue_refresh_github_issues(self, *, originating_user_id):
+    def queue_refresh_github_issues(self, *, originating_user_id, full=False):
         from .jobs import refresh_github_issues_job
 
         if not self.currently_fetching_issues:
@@ -424,7 +468,7 @@ class Project(
             self.save()
             self.notify_changed(originating_user_id=originating_user_id)
             refresh_github_issues_job.delay(
-                self, originating_user_id=originating_user_id
+                self, originating_user_id=originating_user_id, full=full
             )
 
     def finalize_refresh_github_issues(self, *, error=None, originating_user_id):
@@ -459,21 +503,62 @@ class Project(
         self.save()
         self.notify_changed(originating_user_id=originating_user_id)
 
-    @transaction.atomic
     def add_commits(self, *, commits, ref, sender):
-        if self.branch_name == ref:
-            self.latest_sha = commits[0].get("id") if commits else ""
-            self.finalize_project_update()
-
-        matching_epics = Epic.objects.filter(branch_name=ref, project=self)
-        for epic in matching_epics:
-            epic.add_commits(commits)
-
-        matching_tasks = Task.objects.filter(
-            Q(branch_name=ref, project=self) | Q(branch_name=ref, epic__project=self)
+        """
+        Add the commits of a push to everything on its branch, in a few bulk
+        queries, and notify each changed instance once they are committed.
+        """
+        latest_sha = commits[0].get("id") if commits else ""
+        edited_at = timezone.now()
+
+        epics = list(Epic.objects.filter(branch_name=ref, project=self))
+        for epic in epics:
+            epic.latest_sha = latest_sha
+            epic.update_status()
+            epic.edited_at = edited_at
+
+        tasks = list(
+            Task.objects.filter(
+                Q(branch_name=ref, project=self)
+                | Q(branch_name=ref, epic__project=self)
+            ).select_related("project", "epic__project")
         )
-        for task in matching_tasks:
-            task.add_commits(commits, sender)
+        Task.update_has_unmerged_commits_in_bulk(tasks)
+        new_commits = [gh.normalize_commit(c, sender=sender) for c in commits]
+        parent_epics = {}
+        for task in tasks:
+            task.commits = new_commits + task.commits
+            task.update_review_valid()
+            task.edited_at = edited_at
+            if task.epic and task.epic.branch_name != ref:
+                parent_epics[task.epic.pk] = task.epic
+
+        # As Task.save() would, bring the status of their Epics up to date:
+        stale_epics = [
+            epic for epic in parent_epics.values() if epic.should_update_status()
+        ]
+        for epic in stale_epics:
+            epic.update_status()
+            epic.edited_at = edited_at
+
+        changed = [*epics, *stale_epics, *tasks]
+        with transaction.atomic():
+            if self.branch_name == ref:
+                self.latest_sha = latest_sha
+                self.save()
+                changed.insert(0, self)
+            # bulk_update() skips save(), so the fields it would set are set above:
+            Epic.objects.bulk_update(
+                [*epics, *stale_epics], ["latest_sha", "status", "edited_at"]
+            )
+            Task.objects.bulk_update(
+                tasks, ["commits", "has_unmerged_commits", "review_valid", "edited_at"]
+            )
+            for instance in changed:
+                # This comes from the GitHub hook, and so has no originating user:
+                transaction.on_commit(
+                    partial(instance.notify_changed, originating_user_id=None)
+                )
 
     def has_push_permission(self, user):
         return GitHubRepository.objects.filter(
@@ -528,6 +613,35 @@ class GitHubIssue(HashIdMixin):
         return self.title
 
 
+class GitHubHookDelivery(HashIdMixin):
+    """
+    A webhook payload received from GitHub, stored so it can be acknowledged
+    right away and processed by a worker.
+    """
+
+    delivery_id = models.CharField(max_length=64, unique=True)
+    event = models.CharField(max_length=64)
+    payload = models.JSONField()
+    # Used to coalesce pushes to the same branch:
+    repo_id = models.IntegerField(null=True, blank=True, db_index=True)
+    ref = StringField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("received_at",)
+        verbose_name = "GitHub hook delivery"
+        verbose_name_plural = "GitHub hook deliveries"
+
+    def __str__(self):
+        return f"{self.event} {self.delivery_id}"
+
+    def queue_process(self):
+        from .jobs import process_github_hook_delivery_job
+
+        process_github_hook_delivery_job.delay(self)
+
+
 class EpicSlug(AbstractSlug):
     parent = models.ForeignKey("Epic", on_delete=models.CASCADE, related_name="slugs")
 
@@ -705,10 +819,6 @@ class Epic(
         self.save()
         self.notify_changed(originating_user_id=originating_user_id)
 
-    def add_commits(self, commits):
-        self.latest_sha = commits[0].get("id") if commits else ""
-        self.finalize_epic_update()
-
     class Meta:
         ordering = ("-created_at", "name")
         # We enforce this in business logic, not in the database, as we
@@ -920,20 +1030,28 @@ class Task(
         )
         self.review_valid = review_valid
 
-    def update_has_unmerged_commits(self):
-        base = self.get_base()
-        head = self.get_head()
-        if head and base:
-            repo = gh.get_repo_info(
-                None,
-                repo_owner=self.root_project.repo_owner,
-                repo_name=self.root_project.repo_name,
-            )
-            base_sha = repo.branch(base).commit.sha
-            head_sha = repo.branch(head).commit.sha
-            self.has_unmerged_commits = (
-                repo.compare_commits(base_sha, head_sha).ahead_by > 0
-            )
+    @staticmethod
+    def update_has_unmerged_commits_in_bulk(tasks):
+        """
+        Set whether each of these Tasks of the same Project has commits not on
+        its base branch, comparing all their branches in as few GitHub requests
+        as possible.
+        """
+        comparisons = [
+            (task, (task.get_base(), task.get_head()))
+            for task in tasks
+            if task.get_base() and task.get_head()
+        ]
+        if not comparisons:
+            return
+        project = comparisons[0][0].root_project
+        repo = gh.get_repo_info(
+            None, repo_owner=project.repo_owner, repo_name=project.repo_name
+        )
+        ahead_by = gh.get_ahead_by(repo, [comparison for _, comparison in comparisons])
+        for task, comparison in comparisons:
+            if ahead_by.get(comparison) is not None:
+                task.has_unmerged_commits = ahead_by[comparison] > 0
 
     def notify_created(self, originating_user_id=None):
         # Notify all users about the new task
@@ -989,16 +1107,6 @@ class Task(
             self.save()
             self.notify_changed(originating_user_id=originating_user_id)
 
-    def add_commits(self, commits, sender):
-        self.commits = [
-            gh.normalize_commit(c, sender=sender) for c in commits
-        ] + self.commits
-        self.update_has_unmerged_commits()
-        self.update_review_valid()
-        self.save()
-        # This comes from the GitHub hook, and so has no originating user:
-        self.notify_changed(originating_user_id=None)
-
     def add_metecho_git_sha(self, sha):
         self.metecho_commits.append(sha)
 
@@ -1047,6 +1155,66 @@ class Task(
                 org.queue_delete(originating_user_id=originating_user_id)
 
 
+class ScratchOrgPool(HashIdMixin):
+    """
+    Scratch orgs provisioned ahead of time from a Project's default branch, to
+    be handed over when someone asks for an org with the same
+    `org_config_name` and the same starting commit.
+
+    Pooled orgs are built as `owner`, and can only be handed to users of the
+    same Dev Hub, so the owner should normally use the global Dev Hub.
+
+    To remove a pool, set its size to 0, and delete it once the next refill has
+    recycled its orgs.
+    """
+
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, related_name="scratch_org_pools"
+    )
+    org_config_name = StringField()
+    size = models.PositiveSmallIntegerField(default=1)
+    owner = models.ForeignKey(User, on_delete=models.PROTECT, related_name="+")
+
+    class Meta:
+        unique_together = (("project", "org_config_name"),)
+
+    def __str__(self):
+        return f"{self.project} {self.org_config_name}"
+
+    def queue_refill(self):
+        from .jobs import refill_scratch_org_pool_job
+
+        refill_scratch_org_pool_job.delay(self)
+
+
+class ScratchOrgSnapshot(HashIdMixin, TimestampsMixin):
+    """
+    A Dev Hub OrgSnapshot of a scratch org taken just after its setup flow ran.
+    Orgs with the same config are created from it rather than running the flow
+    again, for as long as the repository files that `key` hashes are the same.
+    """
+
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, related_name="org_snapshots"
+    )
+    org_config_name = StringField()
+    key = models.CharField(max_length=64)
+    devhub_username = StringField()
+    snapshot_id = models.CharField(max_length=18)
+    snapshot_name = models.CharField(max_length=15)
+    status = models.CharField(
+        choices=ScratchOrgSnapshotStatus.choices,
+        default=ScratchOrgSnapshotStatus.IN_PROGRESS,
+        max_length=32,
+    )
+
+    class Meta:
+        unique_together = (("project", "org_config_name", "key", "devhub_username"),)
+
+    def __str__(self):
+        return self.snapshot_name
+
+
 class ScratchOrg(
     SoftDeleteMixin, PushMixin, HashIdMixin, TimestampsMixin, models.Model
 ):
@@ -1088,9 +1256,6 @@ class ScratchOrg(
     ignored_changes = models.JSONField(
         default=dict, encoder=DjangoJSONEncoder, blank=True
     )
-    latest_revision_numbers = models.JSONField(
-        default=dict, encoder=DjangoJSONEncoder, blank=True
-    )
     currently_refreshing_changes = models.BooleanField(default=False)
     currently_capturing_changes = models.BooleanField(default=False)
     currently_refreshing_org = models.BooleanField(default=False)
@@ -1107,6 +1272,14 @@ class ScratchOrg(
         default=dict, encoder=DjangoJSONEncoder, blank=True
     )
     cci_log = models.TextField(blank=True)
+    # Set until the org is handed over to someone:
+    pool = models.ForeignKey(
+        ScratchOrgPool,
+        on_delete=models.PROTECT,
+        related_name="orgs",
+        null=True,
+        blank=True,
+    )
 
     def _build_message_extras(self):
         return {
@@ -1122,6 +1295,15 @@ class ScratchOrg(
     def subscribable_by(self, user):  # pragma: nocover
         return True
 
+    def _push_message(self, *args, **kwargs):
+        # Nobody is shown pooled orgs:
+        if self.pool_id is None:
+            super()._push_message(*args, **kwargs)
+
+    def notify_scratch_org_error(self, **kwargs):
+        if self.pool_id is None:
+            super().notify_scratch_org_error(**kwargs)
+
     @property
     def parent(self):
         return self.project or self.epic or self.task
@@ -1162,6 +1344,46 @@ class ScratchOrg(
         banned_keys = {"email", "access_token", "refresh_token"}
         self.config = {k: v for (k, v) in self.config.items() if k not in banned_keys}
 
+    def iter_revisions(self):
+        """
+        Yield `(member_type, member_name, revision)` for the org's revisions,
+        sorted by code point like Python sorts strings.
+        """
+        return (
+            self.revisions.order_by(
+                Collate("member_type", "C"), Collate("member_name", "C")
+            )
+            .values_list("member_type", "member_name", "revision")
+            .iterator()
+        )
+
+    def set_latest_revision_numbers(self, revision_numbers):
+        """Replace all of the org's revisions, e.g. once it has been set up."""
+        with transaction.atomic():
+            self.revisions.all().delete()
+            self.update_latest_revision_numbers(revision_numbers)
+
+    def update_latest_revision_numbers(self, revision_numbers):
+        """Record the revisions of some members, e.g. once they're committed."""
+        with transaction.atomic():
+            for member_type, members in revision_numbers.items():
+                self.revisions.filter(
+                    member_type=member_type, member_name__in=list(members)
+                ).delete()
+            ScratchOrgRevision.objects.bulk_create(
+                (
+                    ScratchOrgRevision(
+                        scratch_org=self,
+                        member_type=member_type,
+                        member_name=member_name,
+                        revision=revision,
+                    )
+                    for member_type, members in revision_numbers.items()
+                    for member_name, revision in members.items()
+                ),
+                batch_size=1000,
+            )
+
     def mark_visited(self, *, originating_user_id):
         self.has_been_visited = True
         self.save()
@@ -1223,7 +1445,13 @@ class ScratchOrg(
         # the initial flow run.
         if self.last_modified_at and should_finalize:
             self.finalize_delete(originating_user_id=originating_user_id)
+        # Scratch orgs are only soft-deleted, but their revisions are no use:
+        self.revisions.all().delete()
         super().delete(*args, **kwargs)
+        if self.pool_id is not None:
+            # Nor should a deleted org keep its pool from being deleted. Only
+            # the row is updated, so that this instance still isn't announced:
+            ScratchOrg.objects.filter(pk=self.pk).update(pool=None)
 
     def queue_provision(self, *, originating_user_id):
         from .jobs import create_branches_on_github_then_create_scratch_org_job
@@ -1438,6 +1666,27 @@ class ScratchOrg(
             )
 
 
+class ScratchOrgRevision(models.Model):
+    """
+    The RevisionCounter of a SourceMember in a ScratchOrg as of the org's
+    setup, or of the member's last commit. Members with a higher revision in
+    the org are unsaved changes.
+    """
+
+    scratch_org = models.ForeignKey(
+        ScratchOrg, on_delete=models.CASCADE, related_name="revisions"
+    )
+    member_type = StringField()
+    member_name = StringField()
+    revision = models.IntegerField()
+
+    class Meta:
+        unique_together = (("scratch_org", "member_type", "member_name"),)
+
+    def __str__(self):
+        return f"{self.member_type} {self.member_name}: {self.revision}"
+
+
 @receiver(user_logged_in)
 def user_logged_in_handler(sender, *, user, **kwargs):
     user.queue_refresh_repositories()
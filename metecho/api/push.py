@@ -34,6 +34,7 @@ Websocket notifications you can subscribe to:
         SCRATCH_ORG_PROVISION_FAILED
         SCRATCH_ORG_UPDATE
         SCRATCH_ORG_ERROR
+        SCRATCH_ORG_FLOW_OUTPUT
         SCRATCH_ORG_FETCH_CHANGES_FAILED
         SCRATCH_ORG_DELETE
         SCRATCH_ORG_DELETE_FAILED
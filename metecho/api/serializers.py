@@ -953,7 +953,9 @@ class ScratchOrgSerializer(HashIdModelSerializer):
 
     def validate(self, data):
         if not self.instance:
-            orgs = ScratchOrg.objects.active().filter(org_type=data["org_type"])
+            orgs = ScratchOrg.objects.active().filter(
+                org_type=data["org_type"], pool__isnull=True
+            )
             if data["org_type"] == ScratchOrgType.PLAYGROUND:
                 orgs = orgs.filter(
                     owner=data.get("owner", self.context["request"].user)
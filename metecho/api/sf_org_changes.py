@@ -2,16 +2,24 @@ import json
 import os
 import pathlib
 from collections import defaultdict
+from datetime import timedelta
 
 import simple_salesforce
 from cumulusci.core.runtime import BaseCumulusCI
 from cumulusci.tasks.github.util import CommitDir
 from cumulusci.tasks.salesforce.sourcetracking import retrieve_components
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from simple_salesforce.exceptions import SalesforceExpiredSession
 
 from .custom_cci_configs import MetechoUniversalConfig
 from .gh import get_repo_info, get_source_format, local_github_checkout
-from .sf_run_flow import refresh_access_token
+from .gh_memo import forget_repositories
+from .sf_run_flow import forget_access_token, refresh_access_token
+
+SOURCE_MEMBER_CACHE_TIMEOUT = 60 * 60 * 24  # 1 day
+SOURCE_MEMBER_RECONCILE_INTERVAL = timedelta(hours=1)
 
 
 def get_valid_target_directories(user, scratch_org, repo_root):
@@ -172,6 +180,26 @@ def commit_changes_to_github(
         CommitDir(repo, author=author)(
             local_dir, branch, repo_dir=target_directory, commit_message=commit_message
         )
+        # The branch has moved on, so don't hand out its old head:
+        forget_repositories()
+
+
+class ScratchOrgSalesforce(simple_salesforce.Salesforce):
+    """
+    A Salesforce client that forgets the scratch org's cached access token if
+    Salesforce rejects it, so that the next connection refreshes it.
+    """
+
+    def __init__(self, *args, scratch_org, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scratch_org = scratch_org
+
+    def _call_salesforce(self, *args, **kwargs):
+        try:
+            return super()._call_salesforce(*args, **kwargs)
+        except SalesforceExpiredSession:
+            forget_access_token(self.scratch_org)
+            raise
 
 
 def get_salesforce_connection(*, scratch_org, originating_user_id, base_url=""):
@@ -183,7 +211,8 @@ def get_salesforce_connection(*, scratch_org, originating_user_id, base_url=""):
         originating_user_id=originating_user_id,
     )
 
-    conn = simple_salesforce.Salesforce(
+    conn = ScratchOrgSalesforce(
+        scratch_org=scratch_org,
         instance_url=org_config.instance_url,
         session_id=org_config.access_token,
         version=MetechoUniversalConfig().project__package__api_version,
@@ -196,34 +225,83 @@ def get_salesforce_connection(*, scratch_org, originating_user_id, base_url=""):
     return conn
 
 
-def get_latest_revision_numbers(scratch_org, *, originating_user_id):
+def get_source_members_cache_key(scratch_org):
+    return f"sf_source_members_{scratch_org.pk}"
+
+
+def get_latest_revision_numbers(scratch_org, *, originating_user_id, full=False):
+    """
+    Return `{member_type: {member_name: revision_counter}}` for the
+    SourceMembers in a scratch org.
+
+    The result is cached with the highest RevisionCounter seen, so that later
+    calls only ask Salesforce for the SourceMembers changed since, including
+    deleted ones. Every `SOURCE_MEMBER_RECONCILE_INTERVAL`, or if `full` is
+    set, all SourceMembers are fetched again instead, in case anything was
+    missed.
+    """
     conn = get_salesforce_connection(
         scratch_org=scratch_org,
         base_url="tooling/",
         originating_user_id=originating_user_id,
     )
+    key = get_source_members_cache_key(scratch_org)
+    state = cache.get(key)
+    reconcile = (
+        full
+        or state is None
+        or now() - state["reconciled_at"] > SOURCE_MEMBER_RECONCILE_INTERVAL
+    )
 
     # Store the results here on the org, and if any of these are > number than earlier
     # version, there are changes.
     # We need to run this right after the setup flow and store that as initial state.
-    records = conn.query_all(
-        "SELECT MemberName, MemberType, RevisionCounter FROM SourceMember "
-        "WHERE IsNameObsolete=false"
-    ).get("records", [])
+    if reconcile:
+        state = {"reconciled_at": now(), "watermark": 0, "members": {}}
+        records = conn.query_all(
+            "SELECT MemberName, MemberType, RevisionCounter, IsNameObsolete "
+            "FROM SourceMember WHERE IsNameObsolete=false"
+        ).get("records", [])
+    else:
+        records = conn.query_all(
+            "SELECT MemberName, MemberType, RevisionCounter, IsNameObsolete "
+            f"FROM SourceMember WHERE RevisionCounter > {int(state['watermark'])}"
+        ).get("records", [])
 
-    record_dict = defaultdict(lambda: defaultdict(dict))
+    record_dict = defaultdict(dict, state["members"])
     for record in records:
-        record_dict[record["MemberType"]][record["MemberName"]] = record[
-            "RevisionCounter"
-        ]
+        state["watermark"] = max(state["watermark"], record["RevisionCounter"])
+        if record.get("IsNameObsolete"):
+            record_dict[record["MemberType"]].pop(record["MemberName"], None)
+        else:
+            record_dict[record["MemberType"]][record["MemberName"]] = record[
+                "RevisionCounter"
+            ]
 
-    return {k: dict(v) for k, v in record_dict.items()}
+    state["members"] = {k: v for k, v in record_dict.items() if v}
+    cache.set(key, state, timeout=SOURCE_MEMBER_CACHE_TIMEOUT)
+    return state["members"]
 
 
-def compare_revisions(old_revision, new_revision):
+def compare_sorted_revisions(old_rows, new_revision):
+    """
+    Return `{member_type: [member_name]}` for the members of `new_revision`
+    that are newer than in `old_rows`, or missing from it.
+
+    `old_rows` are `(member_type, member_name, revision)` tuples in sorted
+    order, such as `ScratchOrg.iter_revisions()`, and are merged with the
+    sorted members of `new_revision` rather than loaded into a dict.
+    """
     ret = defaultdict(list)
-    for mt in new_revision.keys():
-        for mn in new_revision[mt].keys():
-            if new_revision[mt][mn] > old_revision.get(mt, {}).get(mn, -1):
-                ret[mt].append(mn)
+    old_rows = iter(old_rows)
+    old = next(old_rows, None)
+    for mt, mn, revision in sorted(
+        (mt, mn, revision)
+        for mt, members in new_revision.items()
+        for mn, revision in members.items()
+    ):
+        while old is not None and old[:2] < (mt, mn):
+            old = next(old_rows, None)
+        if old is None or old[:2] != (mt, mn) or revision > old[2]:
+            ret[mt].append(mn)
     return ret
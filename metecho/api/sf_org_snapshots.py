@@ -0,0 +1,149 @@
+"""
+Scratch org creation from Dev Hub org snapshots
+
+A snapshot is taken of an org as soon as its setup flow has run, and orgs with
+the same config are then created from it instead of running the flow again.
+Snapshots are keyed by a hash of the repository files the flow could depend
+on, so they're replaced when those change.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+
+from simple_salesforce.exceptions import SalesforceError
+
+from .models import ScratchOrgSnapshot, ScratchOrgSnapshotStatus
+from .sf_run_flow import get_devhub_api
+
+logger = logging.getLogger(__name__)
+
+# Top-level paths and file types that no setup flow deploys:
+SNAPSHOT_IGNORED_DIRECTORIES = {".git", ".github", ".cumulusci", "docs", "robot"}
+SNAPSHOT_IGNORED_SUFFIXES = (".md", ".rst")
+# Orgs for different branches need snapshots of their own, but the Dev Hub only
+# allows so many, so only the most recently used are kept for each org config:
+SNAPSHOTS_PER_CONFIG = 3
+
+
+def get_snapshot_key(project_path, org_config_name):
+    """Hash the files in a checkout that a setup flow could depend on."""
+    digest = hashlib.sha256(org_config_name.encode())
+    for root, dirs, files in os.walk(project_path):
+        if root == project_path:
+            dirs[:] = [d for d in dirs if d not in SNAPSHOT_IGNORED_DIRECTORIES]
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(SNAPSHOT_IGNORED_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, project_path).encode() + b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_snapshot_name(project, org_config_name, key):
+    # Snapshot names are unique per Dev Hub, and at most 15 alphanumerics:
+    digest = hashlib.sha256(f"{project.id} {org_config_name} {key}".encode())
+    return "M" + digest.hexdigest()[:14]
+
+
+def _refresh_status(devhub_api, snapshot):
+    try:
+        record = devhub_api.OrgSnapshot.get(snapshot.snapshot_id)
+    except SalesforceError:
+        # It has been deleted or has expired, or the Dev Hub can't tell us:
+        logger.warning(f"Could not get status of snapshot {snapshot}")
+        record = {"Status": ScratchOrgSnapshotStatus.ERROR}
+    if record["Status"] in ScratchOrgSnapshotStatus.values:
+        snapshot.status = record["Status"]
+    else:
+        snapshot.status = ScratchOrgSnapshotStatus.ERROR
+    snapshot.save()
+
+    if snapshot.status == ScratchOrgSnapshotStatus.ACTIVE:
+        _retire_snapshots(devhub_api, snapshot)
+
+
+def _retire_snapshots(devhub_api, snapshot):
+    """Delete the least recently used snapshots beyond SNAPSHOTS_PER_CONFIG."""
+    others = (
+        ScratchOrgSnapshot.objects.filter(
+            project=snapshot.project,
+            org_config_name=snapshot.org_config_name,
+            devhub_username=snapshot.devhub_username,
+        )
+        .exclude(pk=snapshot.pk)
+        .exclude(status=ScratchOrgSnapshotStatus.IN_PROGRESS)
+        .order_by("-edited_at")
+    )
+    for old_snapshot in others[SNAPSHOTS_PER_CONFIG - 1 :]:
+        try:
+            devhub_api.OrgSnapshot.delete(old_snapshot.snapshot_id)
+        except SalesforceError:
+            logger.warning(f"Could not delete snapshot {old_snapshot}")
+        old_snapshot.delete()
+
+
+def get_org_snapshot(*, project, org_config_name, key, devhub_username):
+    """Return the active snapshot to create an org from, or None."""
+    snapshot = ScratchOrgSnapshot.objects.filter(
+        project=project,
+        org_config_name=org_config_name,
+        key=key,
+        devhub_username=devhub_username,
+    ).first()
+    if snapshot is None:
+        return None
+    if snapshot.status == ScratchOrgSnapshotStatus.IN_PROGRESS:
+        _refresh_status(get_devhub_api(devhub_username=devhub_username), snapshot)
+    if snapshot.status == ScratchOrgSnapshotStatus.ACTIVE:
+        # Keep track of when it was last used:
+        snapshot.save(update_fields=["edited_at"])
+        return snapshot
+    return None
+
+
+def create_org_snapshot(scratch_org, *, key, devhub_username):
+    """
+    Ask the Dev Hub to snapshot a scratch org whose setup flow has just run,
+    unless there is a snapshot for the same key already. Salesforce builds it
+    in the background; `get_org_snapshot` checks whether it's ready.
+    """
+    project = scratch_org.root_project
+    org_config_name = scratch_org.org_config_name
+    existing = ScratchOrgSnapshot.objects.filter(
+        project=project,
+        org_config_name=org_config_name,
+        key=key,
+        devhub_username=devhub_username,
+    )
+    if existing.exclude(status=ScratchOrgSnapshotStatus.ERROR).exists():
+        return None
+
+    devhub_api = get_devhub_api(devhub_username=devhub_username)
+    # Make way for a new snapshot with the same name:
+    for failed_snapshot in existing:
+        with contextlib.suppress(SalesforceError):
+            devhub_api.OrgSnapshot.delete(failed_snapshot.snapshot_id)
+        failed_snapshot.delete()
+    snapshot_name = get_snapshot_name(project, org_config_name, key)
+    response = devhub_api.OrgSnapshot.create(
+        {
+            "SnapshotName": snapshot_name,
+            "SourceOrg": scratch_org.config["org_id"][:15],
+            "Description": f"Metecho {project.repo_owner}/{project.repo_name} "
+            f"{org_config_name}",
+        }
+    )
+    return ScratchOrgSnapshot.objects.create(
+        project=project,
+        org_config_name=org_config_name,
+        key=key,
+        devhub_username=devhub_username,
+        snapshot_id=response["id"],
+        snapshot_name=snapshot_name,
+    )
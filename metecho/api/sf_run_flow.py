@@ -1,20 +1,28 @@
+import codecs
 import contextlib
 import json
 import logging
 import os
+import selectors
 import shutil
 import subprocess
+import time
 from datetime import datetime
+from functools import partial
 
+from cryptography.fernet import InvalidToken
 from cumulusci.core.config import OrgConfig, TaskConfig
 from cumulusci.core.runtime import BaseCumulusCI
 from cumulusci.oauth.client import OAuth2Client, OAuth2ClientConfig
 from cumulusci.oauth.salesforce import jwt_session
 from cumulusci.tasks.salesforce.org_settings import DeployOrgSettings
 from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils.translation import gettext_lazy as _
 from django_rq import get_scheduler
 from rq import get_current_job
+from sfdo_template_helpers.crypto import fernet_decrypt, fernet_encrypt
 from simple_salesforce import Salesforce as SimpleSalesforce
 
 logger = logging.getLogger(__name__)
@@ -28,6 +36,16 @@ SF_CLIENT_SECRET = settings.SFDX_CLIENT_SECRET
 SFDX_SIGNUP_INSTANCE = settings.SFDX_SIGNUP_INSTANCE
 
 DURATION_DAYS = 30
+# Salesforce sessions last for at least 15 minutes without activity, however
+# the org is configured, so an access token is good for that long after it is
+# issued (unless revoked, see `forget_access_token`):
+ACCESS_TOKEN_CACHE_TIMEOUT = 60 * 15  # 15 minutes
+# Dev Hub clients log in again if their session has expired early:
+DEVHUB_SESSION_CACHE_TIMEOUT = 60 * 60  # 1 hour
+# Flow output is passed on once this much has built up, or once the first of it
+# has waited this long, whichever is first:
+FLOW_OUTPUT_CHUNK_SIZE = 64 * 1024  # 64 KiB
+FLOW_OUTPUT_FLUSH_INTERVAL = 5  # seconds
 
 # Deploy org settings metadata -- this should get moved into CumulusCI
 SETTINGS_XML_t = """<?xml version="1.0" encoding="UTF-8"?>
@@ -107,6 +125,15 @@ def is_org_good(org):
         return False
 
 
+def get_access_token_cache_key(scratch_org, config):
+    # A refreshed ScratchOrg keeps its pk but gets a new org, so key by both:
+    return f"sf_access_token_{scratch_org.pk}_{config.get('org_id')}"
+
+
+def forget_access_token(scratch_org):
+    cache.delete(get_access_token_cache_key(scratch_org, scratch_org.config or {}))
+
+
 def refresh_access_token(
     *, scratch_org, config, org_name, keychain=None, originating_user_id=None
 ):
@@ -114,13 +141,79 @@ def refresh_access_token(
     Construct a new OrgConfig because ScratchOrgConfig tries to use sfdx
     which we don't want now -- this is a total hack which I'll try to
     smooth over with some improvements in CumulusCI
+
+    What a refresh adds to the config (the access token, and the user and org
+    info fetched with it) is cached, encrypted, for a while, so that repeated
+    operations on the same org don't each refresh it again.
     """
+    key = get_access_token_cache_key(scratch_org, config) if scratch_org else None
+    cached = cache.get(key) if key else None
+    if cached is not None:
+        with contextlib.suppress(InvalidToken):
+            refreshed = json.loads(fernet_decrypt(cached))
+            return OrgConfig({**config, **refreshed}, org_name, keychain=keychain)
+
+    original_config = dict(config)
     with delete_org_on_error(
         scratch_org=scratch_org, originating_user_id=originating_user_id
     ):
         org_config = OrgConfig(config, org_name, keychain=keychain)
         org_config.refresh_oauth_token(keychain)
-        return org_config
+
+    refreshed = {
+        name: value
+        for name, value in org_config.config.items()
+        if original_config.get(name) != value
+    }
+    if key and refreshed:
+        cache.set(
+            key,
+            fernet_encrypt(json.dumps(refreshed, cls=DjangoJSONEncoder)),
+            timeout=ACCESS_TOKEN_CACHE_TIMEOUT,
+        )
+    return org_config
+
+
+def get_devhub_session_cache_key(devhub_username):
+    return f"sf_devhub_session_{devhub_username}"
+
+
+def start_devhub_session(devhub_username):
+    """
+    Log in to a Dev Hub with the JWT bearer flow, and keep the session in the
+    cache for other jobs and requests to use.
+    """
+    jwt = jwt_session(SF_CLIENT_ID, SF_CLIENT_KEY, devhub_username)
+    session = {"instance_url": jwt["instance_url"], "access_token": jwt["access_token"]}
+    cache.set(
+        get_devhub_session_cache_key(devhub_username),
+        fernet_encrypt(json.dumps(session)),
+        timeout=DEVHUB_SESSION_CACHE_TIMEOUT,
+    )
+    return session
+
+
+def get_devhub_session(devhub_username):
+    cached = cache.get(get_devhub_session_cache_key(devhub_username))
+    if cached is not None:
+        with contextlib.suppress(InvalidToken):
+            return json.loads(fernet_decrypt(cached))
+    return start_devhub_session(devhub_username)
+
+
+def renew_expired_devhub_session(client, devhub_username, response, **kwargs):
+    """
+    Response hook for Dev Hub clients: if Salesforce says the session has
+    expired, log in again and retry the request with the new session.
+    """
+    if response.status_code != 401:
+        return response
+    session = start_devhub_session(devhub_username)
+    client.session_id = session["access_token"]
+    client.headers["Authorization"] = f"Bearer {client.session_id}"
+    request = response.request.copy()
+    request.headers["Authorization"] = client.headers["Authorization"]
+    return response.connection.send(request, **kwargs)
 
 
 def get_devhub_api(*, devhub_username, scratch_org=None):
@@ -128,15 +221,22 @@ def get_devhub_api(*, devhub_username, scratch_org=None):
     Get an access token (session) for the specified dev hub username.
     This only works if the user has already authorized the connected app
     via an interactive login flow, such as the django-allauth login.
+
+    Sessions are shared through the cache, so that a burst of org creations
+    or deletions doesn't log in to the Dev Hub for each one.
     """
     with delete_org_on_error(scratch_org=scratch_org):
-        jwt = jwt_session(SF_CLIENT_ID, SF_CLIENT_KEY, devhub_username)
-        return SimpleSalesforce(
-            instance_url=jwt["instance_url"],
-            session_id=jwt["access_token"],
+        session = get_devhub_session(devhub_username)
+        client = SimpleSalesforce(
+            instance_url=session["instance_url"],
+            session_id=session["access_token"],
             client_id="Metecho",
             version="49.0",
         )
+    client.session.hooks["response"].append(
+        partial(renew_expired_devhub_session, client, devhub_username)
+    )
+    return client
 
 
 def get_org_details(*, cci, org_name, project_path):
@@ -167,6 +267,7 @@ def get_org_result(
     scratch_org_definition,
     cci,
     devhub_api,
+    snapshot_name=None,
 ):
     """Create a new scratch org using the ScratchOrgInfo object in the Dev Hub org,
     and get the result."""
@@ -193,6 +294,11 @@ def get_org_result(
         # optional fields from the scratch org definition file,
         # but this will work for a start
     }
+    if snapshot_name:
+        # The org's shape comes from the snapshot:
+        create_args["Snapshot"] = snapshot_name
+        for key in ("Edition", "Features", "HasSampleData"):
+            del create_args[key]
     if SFDX_SIGNUP_INSTANCE:  # pragma: nocover
         create_args["Instance"] = SFDX_SIGNUP_INSTANCE
     response = devhub_api.ScratchOrgInfo.create(create_args)
@@ -277,8 +383,9 @@ def create_org(
     org_name,
     originating_user_id,
     sf_username=None,
+    snapshot_name=None,
 ):
-    """Create a new scratch org"""
+    """Create a new scratch org, from an org snapshot if one is named"""
     devhub_username = sf_username or user.sf_username
     email = user.email  # TODO: check that this is reliably right.
 
@@ -306,24 +413,39 @@ def create_org(
         scratch_org_definition=scratch_org_definition,
         cci=cci,
         devhub_api=devhub_api,
+        snapshot_name=snapshot_name,
     )
-    mutate_scratch_org(
-        scratch_org_config=scratch_org_config, org_result=org_result, email=email
-    )
-    get_access_token(org_result=org_result, scratch_org_config=scratch_org_config)
-    org_config = deploy_org_settings(
-        cci=cci,
-        org_name=org_name,
-        scratch_org_config=scratch_org_config,
-        scratch_org=scratch_org,
-        originating_user_id=originating_user_id,
-    )
+    try:
+        mutate_scratch_org(
+            scratch_org_config=scratch_org_config, org_result=org_result, email=email
+        )
+        get_access_token(org_result=org_result, scratch_org_config=scratch_org_config)
+        org_config = deploy_org_settings(
+            cci=cci,
+            org_name=org_name,
+            scratch_org_config=scratch_org_config,
+            scratch_org=scratch_org,
+            originating_user_id=originating_user_id,
+        )
+    except Exception:
+        # Nothing will know to delete the org later, and it counts against the
+        # Dev Hub's limit on active scratch orgs until it expires:
+        try:
+            org_id = devhub_api.ScratchOrgInfo.get(org_result["Id"])["ScratchOrg"]
+            if org_id:
+                delete_active_scratch_org(devhub_api, org_id)
+        except Exception:
+            logger.warning("Could not delete failed scratch org", exc_info=True)
+        raise
 
     return (scratch_org_config, cci, org_config)
 
 
-def run_flow(*, cci, org_config, flow_name, project_path, user):
-    """Run a flow on a scratch org"""
+def run_flow(*, cci, org_config, flow_name, project_path, user, output_handler=None):
+    """
+    Run a flow on a scratch org, passing its output to `output_handler` in
+    chunks as it runs, if given.
+    """
     # Run flow in a subprocess so we can control the environment
     gh_token = user.gh_token
     command = shutil.which("cci")
@@ -352,32 +474,53 @@ def run_flow(*, cci, org_config, flow_name, project_path, user):
         args,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        stdin=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
         close_fds=True,
         env=env,
         cwd=project_path,
+        # Unbuffered, so that reads return whatever output there is so far:
+        bufsize=0,
     )
-    orig_stdout, _ = p.communicate()
+    # Flows can run for hours, so only hold on to the output not yet passed on,
+    # and enough of the end of it to report an error:
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    chunk = []
+    chunk_size = 0
+    flush_at = None
+    with selectors.DefaultSelector() as selector:
+        selector.register(p.stdout, selectors.EVENT_READ)
+        done = False
+        while not done:
+            timeout = None if flush_at is None else max(flush_at - time.monotonic(), 0)
+            # An empty result means output has been waiting for long enough:
+            ready = selector.select(timeout)
+            if ready:
+                data = p.stdout.read(FLOW_OUTPUT_CHUNK_SIZE)
+                done = not data
+                text = decoder.decode(data, final=done)
+                tail = (tail + text)[-FLOW_OUTPUT_CHUNK_SIZE:]
+                if text and output_handler is not None:
+                    chunk.append(text)
+                    chunk_size += len(text)
+                    if flush_at is None:
+                        flush_at = time.monotonic() + FLOW_OUTPUT_FLUSH_INTERVAL
+            if chunk and (done or not ready or chunk_size >= FLOW_OUTPUT_CHUNK_SIZE):
+                output_handler("".join(chunk))
+                chunk = []
+                chunk_size = 0
+                flush_at = None
+    p.wait()
     if p.returncode:
         p = subprocess.run(
             [command, "error", "info"], capture_output=True, env={"HOME": project_path}
         )
         traceback = p.stdout.decode("utf-8")
         logger.warning(traceback)
-        raise Exception(
-            _last_line(traceback) or _last_line(orig_stdout.decode("utf-8"))
-        )
+        raise Exception(_last_line(traceback) or _last_line(tail))
 
 
-def delete_org(scratch_org):
-    """Delete a scratch org by deleting its ActiveScratchOrg record
-    in the Dev Hub org."""
-    devhub_username = scratch_org.owner_sf_username
-    org_id = scratch_org.config["org_id"]
-    devhub_api = get_devhub_api(
-        devhub_username=devhub_username, scratch_org=scratch_org
-    )
-
+def delete_active_scratch_org(devhub_api, org_id):
     records = (
         devhub_api.query(
             f"SELECT Id FROM ActiveScratchOrg WHERE ScratchOrg='{org_id}'"
@@ -389,9 +532,21 @@ def delete_org(scratch_org):
     if active_scratch_org_id:
         devhub_api.ActiveScratchOrg.delete(active_scratch_org_id)
 
+
+def delete_org(scratch_org):
+    """Delete a scratch org by deleting its ActiveScratchOrg record
+    in the Dev Hub org."""
+    devhub_username = scratch_org.owner_sf_username
+    org_id = scratch_org.config["org_id"]
+    devhub_api = get_devhub_api(
+        devhub_username=devhub_username, scratch_org=scratch_org
+    )
+    delete_active_scratch_org(devhub_api, org_id)
+
     if scratch_org.expiry_job_id:
         scheduler = get_scheduler("default")
         scheduler.cancel(scratch_org.expiry_job_id)
+    forget_access_token(scratch_org)
 
 
 def _last_line(s: str) -> str:
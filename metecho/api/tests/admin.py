@@ -8,7 +8,7 @@ from django.utils.translation import gettext_lazy as _
 from github3.exceptions import NotFoundError
 
 from ..admin import JSONWidget, ProjectForm, SiteAdminForm, SoftDeletedListFilter
-from ..models import Epic
+from ..models import Epic, GitHubHookDelivery
 
 
 @pytest.mark.django_db
@@ -119,6 +119,32 @@ class TestProjectAdmin:
         assert get_social_image_job.delay.called == should_fetch
 
 
+@pytest.mark.django_db
+class TestGitHubHookDeliveryAdmin:
+    def test_process(self, admin_client, mocker):
+        process_github_hook_delivery_job = mocker.patch(
+            "metecho.api.jobs.process_github_hook_delivery_job"
+        )
+        pending = GitHubHookDelivery.objects.create(
+            delivery_id="abc", event="push", payload={}
+        )
+        GitHubHookDelivery.objects.create(
+            delivery_id="def", event="push", payload={}, processed_at=now()
+        )
+
+        admin_client.post(
+            reverse("admin:api_githubhookdelivery_changelist"),
+            data={
+                "action": "process",
+                "_selected_action": [
+                    delivery.pk for delivery in GitHubHookDelivery.objects.all()
+                ],
+            },
+        )
+
+        process_github_hook_delivery_job.delay.assert_called_once_with(pending)
+
+
 def test_json_widget():
     assert JSONWidget().value_from_datadict({"test": ""}, None, "test") == "{}"
 
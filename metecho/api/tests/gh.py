@@ -1,23 +1,30 @@
+import zipfile
 from contextlib import ExitStack
+from datetime import timedelta
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
 import pytest
 from django.core.cache import cache
+from django.utils import timezone
 from github3.exceptions import NotFoundError, UnprocessableEntity
 
 from ..gh import (
     NoGitHubTokenError,
     UnsafeZipfileError,
     extract_zip_file,
+    get_ahead_by,
     get_all_org_repos,
     get_cached_user,
+    get_cached_users,
     get_repo_info,
     get_source_format,
     get_zip_file,
     gh_as_app,
+    graphql_user_to_rest,
     is_safe_path,
     local_github_checkout,
+    local_github_metadata_checkout,
     log_unsafe_zipfile_error,
     normalize_commit,
     try_to_make_branch,
@@ -45,10 +52,49 @@ class TestGetAllOrgRepos:
             get_all_org_repos(user)
 
 
-def test_gh_as_app():
-    with patch("metecho.api.gh.GitHub"):
+class TestGhAsApp:
+    def setup_method(self):
+        cache.delete("gh_installation_id_TestOrg/TestRepo")
+        cache.delete("gh_installation_token_123")
+
+    def test_gh_as_app(self, mocker):
+        GitHub = mocker.patch(f"{PATCH_ROOT}.GitHub")
+        gh = GitHub.return_value
+        gh.app_installation_for_repository.return_value.id = 123
+        gh.session.auth.token = "token"
+        gh.session.auth.expires_at = timezone.now() + timedelta(hours=1)
+        gh.session.auth.expires_at_str = "2022-01-01T01:00:00Z"
+
         assert gh_as_app("TestOrg", "TestRepo") is not None
 
+    def test_cached(self, mocker):
+        GitHub = mocker.patch(f"{PATCH_ROOT}.GitHub")
+        gh = GitHub.return_value
+        gh.app_installation_for_repository.return_value.id = 123
+        gh.session.auth.token = "token"
+        gh.session.auth.expires_at = timezone.now() + timedelta(hours=1)
+        gh.session.auth.expires_at_str = "2022-01-01T01:00:00Z"
+
+        gh_as_app("TestOrg", "TestRepo")
+        gh_as_app("TestOrg", "TestRepo")
+
+        assert gh.app_installation_for_repository.call_count == 1
+        assert gh.login_as_app_installation.call_count == 1
+        gh.session.app_installation_token_auth.assert_called_once_with(
+            {"token": "token", "expires_at": "2022-01-01T01:00:00Z"}
+        )
+
+    def test_expiring_token_not_cached(self, mocker):
+        GitHub = mocker.patch(f"{PATCH_ROOT}.GitHub")
+        gh = GitHub.return_value
+        gh.app_installation_for_repository.return_value.id = 123
+        gh.session.auth.expires_at = timezone.now() + timedelta(minutes=1)
+
+        gh_as_app("TestOrg", "TestRepo")
+        gh_as_app("TestOrg", "TestRepo")
+
+        assert gh.login_as_app_installation.call_count == 2
+
 
 def test_is_safe_path():
     assert not is_safe_path("/foo")
@@ -114,6 +160,121 @@ def test_get_cached_user(mocker):
     assert gh.user.call_count == 1  # No new calls
 
 
+class TestGetAheadBy:
+    def test_get_ahead_by(self):
+        repo = MagicMock()
+        repo.name = "repo"
+        repo.session.post.return_value.json.return_value = {
+            "data": {
+                "repository": {
+                    "base0": {"head0": {"aheadBy": 2}, "head1": None},
+                    "base1": {"head2": {"aheadBy": 0}},
+                }
+            }
+        }
+
+        ahead_by = get_ahead_by(
+            repo,
+            [
+                ("epic", "task-1"),
+                ("epic", "gone"),
+                ("main", "epic"),
+                ("epic", "task-1"),
+            ],
+        )
+
+        assert ahead_by == {
+            ("epic", "task-1"): 2,
+            ("epic", "gone"): None,
+            ("main", "epic"): 0,
+        }
+        repo.session.post.assert_called_once()
+        variables = repo.session.post.call_args.kwargs["json"]["variables"]
+        assert variables["base0"] == "refs/heads/epic"
+        assert variables["base1"] == "refs/heads/main"
+        assert "base2" not in variables
+
+    def test_missing_repository(self):
+        repo = MagicMock()
+        repo.session.post.return_value.json.return_value = {
+            "data": {"repository": None}
+        }
+
+        assert get_ahead_by(repo, [("main", "epic")]) == {("main", "epic"): None}
+
+    def test_error(self):
+        repo = MagicMock()
+        repo.session.post.return_value.json.return_value = {"errors": ["Oops"]}
+
+        with pytest.raises(Exception, match="GraphQL"):
+            get_ahead_by(repo, [("main", "epic")])
+
+
+@pytest.mark.django_db
+class TestGetCachedUsers:
+    def make_node(self, login):
+        return {
+            "id": f"node-{login}",
+            "databaseId": 1,
+            "login": login,
+            "name": f"Name of {login}",
+            "avatarUrl": "https://example.com/avatar.png",
+            "url": f"https://github.com/{login}",
+            "isSiteAdmin": False,
+            "company": None,
+            "websiteUrl": None,
+            "location": None,
+            "email": "",
+            "isHireable": False,
+            "bio": None,
+            "repositories": {"totalCount": 1},
+            "gists": {"totalCount": 0},
+            "followers": {"totalCount": 2},
+            "following": {"totalCount": 3},
+            "createdAt": "2011-01-25T18:44:36Z",
+            "updatedAt": "2020-01-25T18:44:36Z",
+        }
+
+    def test_batched(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.USERS_PER_GRAPHQL_QUERY", 2)
+        logins = ["cached", "one", "two", "three"]
+        for login in logins:
+            cache.delete(f"gh_user_{login}")
+        cache.set("gh_user_cached", graphql_user_to_rest(self.make_node("cached")))
+        gh = MagicMock()
+        gh.session.post.return_value.json.side_effect = [
+            {"data": {"user0": self.make_node("one"), "user1": self.make_node("two")}},
+            {"data": {"user0": self.make_node("three")}},
+        ]
+
+        users = get_cached_users(gh, logins)
+
+        assert {login: user.name for login, user in users.items()} == {
+            login: f"Name of {login}" for login in logins
+        }
+        assert gh.session.post.call_count == 2
+        assert get_cached_user(gh, "three").name == "Name of three"
+        assert not gh.user.called
+
+    def test_not_a_user(self, mocker):
+        cache.delete("gh_user_bot")
+        gh = MagicMock()
+        gh.session.post.return_value.json.return_value = {"data": {"user0": None}}
+        gh.user.return_value.as_dict.return_value = {}
+
+        users = get_cached_users(gh, ["bot"])
+
+        assert users == {"bot": gh.user.return_value}
+
+    def test_error(self):
+        cache.delete("gh_user_test")
+        gh = MagicMock()
+        gh.session.post.return_value.json.return_value = {"errors": ["Oh no!"]}
+
+        with pytest.raises(Exception):
+            get_cached_users(gh, ["test"])
+
+
 def test_get_zip_file():
     repo = MagicMock()
     with patch(f"{PATCH_ROOT}.zipfile") as zipfile:
@@ -122,19 +283,61 @@ def test_get_zip_file():
         assert zipfile.ZipFile.called
 
 
-def test_extract_zip_file():
-    zip_file = MagicMock()
-    with ExitStack() as stack:
-        shutil = stack.enter_context(patch(f"{PATCH_ROOT}.shutil"))
-        os = stack.enter_context(patch(f"{PATCH_ROOT}.os"))
-        glob = stack.enter_context(patch(f"{PATCH_ROOT}.glob"))
+def test_get_zip_file__cached(mocker, settings):
+    settings.GITHUB_ARCHIVE_CACHE_SIZE = 1024
+    fetch_archive = mocker.patch(f"{PATCH_ROOT}.fetch_archive")
+    mocker.patch(f"{PATCH_ROOT}.zipfile")
+    repo = MagicMock(**{"branch.return_value.commit.sha": "abc123"})
+
+    get_zip_file(repo, "main")
+
+    fetch_archive.assert_called_once_with(repo, "abc123", "archive.zip")
+
+
+class TestExtractZipFile:
+    def make_zip_file(self, path, members):
+        with zipfile.ZipFile(path, "w") as zip_file:
+            for name, content in members.items():
+                zip_file.writestr(name, content)
+        return zipfile.ZipFile(path)
+
+    def test_strips_root(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        zip_file = self.make_zip_file(
+            "archive.zip",
+            {
+                "owner-repo_name-abc123/": "",
+                "owner-repo_name-abc123/cumulusci.yml": "project:",
+                "owner-repo_name-abc123/.gitignore": "*.pyc",
+                "owner-repo_name-abc123/src/classes/": "",
+                "owner-repo_name-abc123/src/classes/Foo.cls": "class Foo {}",
+                # Often the root contains a directory with the repo's name:
+                "owner-repo_name-abc123/repo_name/README": "Hello",
+            },
+        )
 
-        glob.return_value = ["owner-repo_name-"]
         extract_zip_file(zip_file, "owner", "repo_name")
-        assert zip_file.extractall.called
-        assert shutil.move.called
-        assert shutil.rmtree.called
-        assert os.remove.called
+
+        assert Path("cumulusci.yml").read_text() == "project:"
+        assert Path(".gitignore").read_text() == "*.pyc"
+        assert Path("src/classes/Foo.cls").read_text() == "class Foo {}"
+        assert Path("repo_name/README").read_text() == "Hello"
+        assert not Path("owner-repo_name-abc123").exists()
+        assert not Path("archive.zip").exists()
+
+    @pytest.mark.parametrize(
+        "name",
+        (
+            pytest.param("other-repo-abc123/cumulusci.yml", id="Unexpected root"),
+            pytest.param("owner-repo_name-abc123/../../etc", id="Unsafe path"),
+        ),
+    )
+    def test_unsafe(self, tmp_path, monkeypatch, name):
+        monkeypatch.chdir(tmp_path)
+        zip_file = self.make_zip_file("archive.zip", {name: ""})
+
+        with pytest.raises(UnsafeZipfileError):
+            extract_zip_file(zip_file, "owner", "repo_name")
 
 
 class TestLocalGitHubCheckout:
@@ -145,18 +348,14 @@ class TestLocalGitHubCheckout:
             stack.enter_context(patch(f"{PATCH_ROOT}.zipfile"))
             os = stack.enter_context(patch(f"{PATCH_ROOT}.os"))
             gh_given_user = stack.enter_context(patch(f"{PATCH_ROOT}.gh_given_user"))
-            shutil = stack.enter_context(patch(f"{PATCH_ROOT}.shutil"))
-            glob = stack.enter_context(patch(f"{PATCH_ROOT}.glob"))
             repository = MagicMock(default_branch="main")
             repository.file_contents.return_value.decoded.decode.return_value = "Hello"
             gh = MagicMock()
             gh.repository_with_id.return_value = repository
             gh_given_user.return_value = gh
-            glob.return_value = ["owner-repo_name-"]
 
             with local_github_checkout(user, repo) as repo_root:
                 assert (Path(repo_root) / "cumulusci.yml").read_text() == "Hello"
-                assert shutil.rmtree.called
                 assert os.remove.called
 
     def test_zipfile_unsafe(self):
@@ -165,15 +364,12 @@ class TestLocalGitHubCheckout:
         with ExitStack() as stack:
             stack.enter_context(patch(f"{PATCH_ROOT}.zipfile"))
             gh_given_user = stack.enter_context(patch(f"{PATCH_ROOT}.gh_given_user"))
-            stack.enter_context(patch(f"{PATCH_ROOT}.shutil"))
-            glob = stack.enter_context(patch(f"{PATCH_ROOT}.glob"))
             zip_file_is_safe = stack.enter_context(
                 patch(f"{PATCH_ROOT}.zip_file_is_safe")
             )
             zip_file_is_safe.return_value = False
             gh = MagicMock()
             gh_given_user.return_value = gh
-            glob.return_value = [".."]
 
             with pytest.raises(UnsafeZipfileError):
                 with local_github_checkout(user, repo, "commit-ish"):  # pragma: nocover
@@ -185,20 +381,59 @@ class TestLocalGitHubCheckout:
         mocker.patch(f"{PATCH_ROOT}.zipfile")
         mocker.patch(f"{PATCH_ROOT}.os")
         gh_given_user = mocker.patch(f"{PATCH_ROOT}.gh_given_user")
-        mocker.patch(f"{PATCH_ROOT}.shutil")
-        glob = mocker.patch(f"{PATCH_ROOT}.glob")
         repository = MagicMock(default_branch="main")
         repository.file_contents.side_effect = NotFoundError(MagicMock())
         gh = MagicMock()
         gh.repository_with_id.return_value = repository
         gh_given_user.return_value = gh
-        glob.return_value = ["owner-repo_name-"]
 
         with pytest.raises(Exception):
             with local_github_checkout(user, repo_id):
                 pass  # pragma: nocover
 
 
+class TestLocalGitHubMetadataCheckout:
+    def test_metadata_checkout(self, mocker):
+        def entry(path, type="blob"):
+            return MagicMock(path=path, type=type, sha=f"sha-{path}")
+
+        trees = {
+            "feature/foo": [
+                entry("sfdx-project.json"),
+                entry("README.md"),
+                entry("force-app", "tree"),
+                entry("orgs", "tree"),
+                entry("unpackaged", "tree"),
+            ],
+            "sha-orgs": [entry("dev.json"), entry("notes.txt")],
+            "sha-unpackaged": [entry("pre", "tree"), entry("post", "tree")],
+            "sha-pre": [entry("first", "tree"), entry("README.md")],
+            "sha-post": [entry("second", "tree")],
+        }
+        repository = MagicMock(default_branch="main")
+        repository.tree.side_effect = lambda sha: MagicMock(tree=trees[sha])
+        repository.blob.side_effect = lambda sha: MagicMock(
+            **{"decode_content.return_value": sha}
+        )
+        repository.file_contents.return_value.decoded.decode.return_value = "Hello"
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repository)
+
+        with local_github_metadata_checkout(MagicMock(), 123, "feature/foo"):
+            assert Path(".git").is_dir()
+            assert Path("cumulusci.yml").read_text() == "Hello"
+            assert Path("sfdx-project.json").read_text() == "sha-sfdx-project.json"
+            assert Path("orgs/dev.json").read_text() == "sha-dev.json"
+            assert not Path("orgs/notes.txt").exists()
+            assert not Path("README.md").exists()
+            assert not Path("force-app").exists()
+            assert sorted(Path("unpackaged").glob("*/*")) == [
+                Path("unpackaged/post/second"),
+                Path("unpackaged/pre/first"),
+            ]
+
+        repository.file_contents.assert_called_once_with("cumulusci.yml", ref="main")
+
+
 class TestTryCreateBranch:
     def test_try_to_make_branch__duplicate_name(self):
         repository = MagicMock()
@@ -0,0 +1,93 @@
+import os
+from unittest.mock import MagicMock
+
+import pytest
+from github3.exceptions import NotFoundError
+
+from ..gh_archives import evict, fetch_archive, get_cache_path, resolve_commit_sha
+
+SHA = "0123456789abcdef0123456789abcdef01234567"
+
+
+@pytest.fixture
+def archive_cache(settings, tmp_path):
+    settings.GITHUB_ARCHIVE_CACHE_DIR = str(tmp_path / "cache")
+    settings.GITHUB_ARCHIVE_CACHE_SIZE = 1024
+    return tmp_path / "cache"
+
+
+def make_repo(content=b"zip contents"):
+    def archive(format, path, ref):
+        with open(path, "wb") as f:
+            f.write(content)
+        return True
+
+    return MagicMock(id=123, **{"archive.side_effect": archive})
+
+
+class TestResolveCommitSha:
+    def test_sha(self):
+        repo = MagicMock()
+        assert resolve_commit_sha(repo, SHA) == SHA
+        assert not repo.branch.called
+
+    def test_branch(self):
+        repo = MagicMock(**{"branch.return_value.commit.sha": SHA})
+        assert resolve_commit_sha(repo, "main") == SHA
+
+    def test_tag(self):
+        repo = MagicMock(
+            **{
+                "branch.side_effect": NotFoundError(MagicMock()),
+                "commit.return_value.sha": SHA,
+            }
+        )
+        assert resolve_commit_sha(repo, "v1.0") == SHA
+
+
+class TestFetchArchive:
+    def test_miss_then_hit(self, archive_cache, tmp_path):
+        repo = make_repo()
+
+        fetch_archive(repo, SHA, tmp_path / "first.zip")
+        fetch_archive(repo, SHA, tmp_path / "second.zip")
+
+        assert repo.archive.call_count == 1
+        assert (tmp_path / "second.zip").read_bytes() == b"zip contents"
+        assert get_cache_path(123, SHA).exists()
+
+    def test_removing_materialized_copy_keeps_cache(self, archive_cache, tmp_path):
+        repo = make_repo()
+
+        fetch_archive(repo, SHA, tmp_path / "archive.zip")
+        os.remove(tmp_path / "archive.zip")
+
+        assert get_cache_path(123, SHA).read_bytes() == b"zip contents"
+
+    def test_failed_download_is_not_cached(self, archive_cache, tmp_path):
+        repo = MagicMock(id=123, **{"archive.return_value": False})
+
+        fetch_archive(repo, SHA, tmp_path / "archive.zip")
+
+        assert not (tmp_path / "archive.zip").exists()
+        assert list(archive_cache.iterdir()) == []
+
+    def test_cross_device(self, mocker, archive_cache, tmp_path):
+        mocker.patch("metecho.api.gh_archives.os.link", side_effect=OSError)
+        repo = make_repo()
+
+        fetch_archive(repo, SHA, tmp_path / "archive.zip")
+
+        assert (tmp_path / "archive.zip").read_bytes() == b"zip contents"
+
+
+def test_evict(archive_cache):
+    archive_cache.mkdir()
+    for i in range(3):
+        path = archive_cache / f"{i}.zip"
+        path.write_bytes(b"x" * 10)
+        os.utime(path, (i, i))
+
+    evict(max_size=20)
+
+    assert sorted(p.name for p in archive_cache.iterdir()) == ["1.zip", "2.zip"]
@@ -0,0 +1,62 @@
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.cache import cache
+
+from ..gh_branches import (
+    forget_branch_index,
+    get_branch_index,
+    get_cache_key,
+    search_branch_names,
+)
+
+
+class Branch:
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.fixture
+def project():
+    project = MagicMock(repo_id=123, repo_owner="owner", repo_name="repo")
+    cache.delete(get_cache_key(project))
+    return project
+
+
+@pytest.fixture
+def get_repo_info(mocker):
+    repo = MagicMock(default_branch="main")
+    repo.branches.return_value = [Branch("main"), Branch("b"), Branch("a")]
+    return mocker.patch("metecho.api.gh_branches.gh.get_repo_info", return_value=repo)
+
+
+class TestGetBranchIndex:
+    def test_fetch(self, project, get_repo_info):
+        assert get_branch_index(project) == {
+            "default_branch": "main",
+            "names": ["a", "b", "main"],
+        }
+
+    def test_cached(self, project, get_repo_info):
+        get_branch_index(project)
+        get_branch_index(project)
+
+        get_repo_info.assert_called_once()
+
+
+def test_search_branch_names():
+    names = ["feature/a", "feature/b", "fix", "main"]
+
+    assert search_branch_names(names, "feature/") == ["feature/a", "feature/b"]
+    assert search_branch_names(names, "g") == []
+    assert search_branch_names(names) == names
+
+
+def test_forget_branch_index(project, get_repo_info):
+    get_branch_index(project)
+    get_repo_info.return_value.branches.return_value = [Branch("main"), Branch("c")]
+
+    forget_branch_index(project)
+
+    assert get_branch_index(project)["names"] == ["c", "main"]
+    assert get_repo_info.call_count == 2
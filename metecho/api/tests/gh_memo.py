@@ -0,0 +1,81 @@
+from unittest.mock import MagicMock
+
+from ..gh_memo import (
+    forget_repositories,
+    get_memoized_repository,
+    memoize_github,
+    memoize_github_middleware,
+)
+
+
+def test_not_memoized_outside_scope():
+    get_repository = MagicMock()
+
+    get_memoized_repository("key", get_repository)
+    get_memoized_repository("key", get_repository)
+
+    assert get_repository.call_count == 2
+
+
+def test_memoized_within_scope():
+    get_repository = MagicMock()
+
+    with memoize_github():
+        first = get_memoized_repository("key", get_repository)
+        second = get_memoized_repository("key", get_repository)
+        other = get_memoized_repository("other", get_repository)
+
+    assert first is second
+    assert first is not other
+    assert get_repository.call_count == 2
+
+
+def test_branch_head_memoized():
+    repository = MagicMock(**{"branch.return_value.latest_sha.return_value": "abc"})
+
+    with memoize_github():
+        repo = get_memoized_repository("key", lambda: repository)
+        assert repo.branch("main").latest_sha() == "abc"
+        assert repo.branch("main").latest_sha() == "abc"
+        assert repo.default_branch is repository.default_branch
+
+    assert repository.branch.call_count == 1
+    assert repository.branch.return_value.latest_sha.call_count == 1
+
+
+def test_create_branch_ref_forgets_branch():
+    repository = MagicMock()
+
+    with memoize_github():
+        repo = get_memoized_repository("key", lambda: repository)
+        repo.branch("feature")
+        repo.create_branch_ref("feature", "abc")
+        repo.branch("feature")
+
+    repository.create_branch_ref.assert_called_once_with("feature", "abc")
+    assert repository.branch.call_count == 2
+
+
+def test_forget_repositories():
+    repository = MagicMock()
+
+    with memoize_github():
+        repo = get_memoized_repository("key", lambda: repository)
+        repo.branch("main")
+        forget_repositories()
+        repo.branch("main")
+        assert get_memoized_repository("key", lambda: repository) is not repo
+
+    assert repository.branch.call_count == 2
+
+
+def test_middleware():
+    get_repository = MagicMock()
+
+    def get_response(request):
+        get_memoized_repository("key", get_repository)
+        get_memoized_repository("key", get_repository)
+        return "response"
+
+    assert memoize_github_middleware(get_response)("request") == "response"
+    assert get_repository.call_count == 1
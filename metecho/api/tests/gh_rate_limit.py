@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from django.core.cache import cache
+
+from ..gh_rate_limit import get_cache_key, get_deferral_time, record_rate_limit
+
+
+def make_headers(remaining, reset, limit=5000):
+    return {
+        "X-RateLimit-Limit": str(limit),
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset": str(reset),
+    }
+
+
+@pytest.fixture
+def reset():
+    cache.delete(get_cache_key("installation_1", "core"))
+    cache.delete(get_cache_key("installation_1", "core") + "_logged")
+    return int((datetime.now(tz=timezone.utc) + timedelta(minutes=30)).timestamp())
+
+
+class TestRecordRateLimit:
+    def test_record(self, reset, caplog):
+        caplog.set_level("INFO")
+
+        record_rate_limit("installation_1", make_headers(4000, reset))
+
+        assert cache.get(get_cache_key("installation_1", "core")) == {
+            "limit": 5000,
+            "remaining": 4000,
+            "reset": reset,
+        }
+        assert "installation_1: 4000/5000" in caplog.text
+
+    def test_out_of_order(self, reset):
+        record_rate_limit("installation_1", make_headers(3999, reset))
+        record_rate_limit("installation_1", make_headers(4000, reset))
+
+        assert cache.get(get_cache_key("installation_1", "core"))["remaining"] == 3999
+
+    def test_new_window(self, reset):
+        record_rate_limit("installation_1", make_headers(10, reset))
+        record_rate_limit("installation_1", make_headers(4999, reset + 3600))
+
+        assert cache.get(get_cache_key("installation_1", "core"))["remaining"] == 4999
+
+    def test_no_headers(self, reset):
+        record_rate_limit("installation_1", {})
+
+        assert cache.get(get_cache_key("installation_1", "core")) is None
+
+
+class TestGetDeferralTime:
+    def test_unknown(self, reset):
+        assert get_deferral_time("installation_1") is None
+
+    def test_enough_left(self, settings, reset):
+        settings.GITHUB_RATE_LIMIT_RESERVE = 500
+        record_rate_limit("installation_1", make_headers(500, reset))
+
+        assert get_deferral_time("installation_1") is None
+
+    def test_running_low(self, settings, reset):
+        settings.GITHUB_RATE_LIMIT_RESERVE = 500
+        record_rate_limit("installation_1", make_headers(499, reset))
+
+        assert get_deferral_time("installation_1") == datetime.fromtimestamp(
+            reset, tz=timezone.utc
+        )
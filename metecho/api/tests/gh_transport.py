@@ -0,0 +1,150 @@
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.cache import cache
+from requests import Request, Response
+
+from ..gh_transport import (
+    GitHubAdapter,
+    get_conditional_cache_key,
+    mount_github_adapter,
+)
+
+URL = "https://api.github.com/repos/owner/repo/collaborators"
+
+
+def make_response(status_code, headers=None, content=b""):
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = content
+    return response
+
+
+def make_request(method="GET", url=URL):
+    return Request(
+        method, url, headers={"Authorization": "token abc", "Accept": "json"}
+    ).prepare()
+
+
+@pytest.fixture
+def send(mocker):
+    cache.delete(get_conditional_cache_key(make_request()))
+    return mocker.patch("requests.adapters.HTTPAdapter.send")
+
+
+class TestGitHubAdapter:
+    def test_not_modified(self, send):
+        send.side_effect = [
+            make_response(
+                200,
+                {
+                    "ETag": '"v1"',
+                    "Content-Type": "application/json; charset=utf-8",
+                    "X-RateLimit-Remaining": "10",
+                },
+                b"[1, 2]",
+            ),
+            make_response(304, {"ETag": '"v1"', "X-RateLimit-Remaining": "9"}),
+        ]
+        adapter = GitHubAdapter()
+
+        adapter.send(make_request())
+        response = adapter.send(make_request())
+
+        assert response.status_code == 200
+        assert response.json() == [1, 2]
+        assert response.headers["X-RateLimit-Remaining"] == "9"
+        second_request = send.call_args_list[1][0][0]
+        assert second_request.headers["If-None-Match"] == '"v1"'
+
+    def test_not_modified__lowercase_headers(self, send):
+        send.side_effect = [
+            make_response(
+                200,
+                {
+                    "etag": '"v1"',
+                    "last-modified": "Thu, 01 Jan 2022 00:00:00 GMT",
+                    "content-type": "application/json; charset=utf-8",
+                },
+                b"[1, 2]",
+            ),
+            make_response(304),
+        ]
+        adapter = GitHubAdapter()
+
+        adapter.send(make_request())
+        response = adapter.send(make_request())
+
+        assert response.json() == [1, 2]
+        second_request = send.call_args_list[1][0][0]
+        assert second_request.headers["If-None-Match"] == '"v1"'
+        assert (
+            second_request.headers["If-Modified-Since"]
+            == "Thu, 01 Jan 2022 00:00:00 GMT"
+        )
+
+    def test_modified(self, send):
+        send.side_effect = [
+            make_response(
+                200,
+                {"ETag": '"v1"', "Content-Type": "application/json"},
+                b"[1]",
+            ),
+            make_response(
+                200,
+                {"ETag": '"v2"', "Content-Type": "application/json"},
+                b"[2]",
+            ),
+            make_response(304),
+        ]
+        adapter = GitHubAdapter()
+
+        adapter.send(make_request())
+        assert adapter.send(make_request()).json() == [2]
+        assert adapter.send(make_request()).json() == [2]
+        third_request = send.call_args_list[2][0][0]
+        assert third_request.headers["If-None-Match"] == '"v2"'
+
+    @pytest.mark.parametrize(
+        "request_, kwargs",
+        (
+            pytest.param(make_request("POST"), {}, id="POST"),
+            pytest.param(make_request(), {"stream": True}, id="Streamed"),
+        ),
+    )
+    def test_not_cached(self, send, request_, kwargs):
+        send.return_value = make_response(
+            200, {"ETag": '"v1"', "Content-Type": "application/json"}, b"{}"
+        )
+        adapter = GitHubAdapter()
+
+        adapter.send(request_, **kwargs)
+        adapter.send(request_, **kwargs)
+
+        assert "If-None-Match" not in send.call_args[0][0].headers
+
+    def test_cache_key__varies_by_credentials(self):
+        other = make_request()
+        other.headers["Authorization"] = "token xyz"
+
+        assert get_conditional_cache_key(make_request()) != get_conditional_cache_key(
+            other
+        )
+
+
+def test_mount_github_adapter():
+    gh = MagicMock()
+    assert mount_github_adapter(gh) is gh
+    gh.session.mount.assert_called_once()
+
+
+def test_records_rate_limit(mocker, send):
+    record_rate_limit = mocker.patch("metecho.api.gh_transport.record_rate_limit")
+    send.return_value = make_response(201, {"X-RateLimit-Remaining": "10"})
+
+    GitHubAdapter(budget="installation_1").send(make_request("POST"))
+
+    record_rate_limit.assert_called_once_with(
+        "installation_1", send.return_value.headers
+    )
@@ -45,6 +45,30 @@ class TestPushHookSerializer:
             serializer.process_hook()
             assert logger.info.called
 
+    @pytest.mark.parametrize(
+        "flags",
+        (
+            pytest.param({"created": True}, id="Created"),
+            pytest.param({"deleted": True}, id="Deleted"),
+        ),
+    )
+    def test_process_hook__branch_index(self, project_factory, flags):
+        project = project_factory(repo_id=123)
+        data = {
+            **flags,
+            "forced": False,
+            "ref": "refs/heads/feature",
+            "commits": [],
+            "repository": {"id": 123},
+            "sender": {},
+        }
+        serializer = PushHookSerializer(data=data)
+        assert serializer.is_valid(), serializer.errors
+        with patch("metecho.api.hook_serializers.forget_branch_index") as forget:
+            serializer.process_hook()
+
+        forget.assert_called_once_with(project)
+
 
 @pytest.mark.django_db
 class TestPrHookSerializer:
@@ -1,18 +1,23 @@
 import logging
 from collections import namedtuple
 from contextlib import ExitStack
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
 
 import pytest
+from django.core.cache import cache
 from django.utils.timezone import now
-from github3.exceptions import NotFoundError
+from github3.exceptions import NotFoundError, ResponseError
 from simple_salesforce.exceptions import SalesforceGeneralError
 
 from ..jobs import (
+    CommitHistory,
     TaskReviewIntegrityError,
+    _append_flow_output,
+    _claim_pooled_scratch_org,
     _create_branches_on_github,
     _create_org_and_run_flow,
+    _run_setup_flow,
     alert_user_about_expiring_org,
     available_org_config_names,
     commit_changes_from_org,
@@ -21,8 +26,14 @@ from ..jobs import (
     create_gh_branch_for_new_epic,
     create_pr,
     delete_scratch_org,
+    get_repo_id_backoff_key,
     get_social_image,
     get_unsaved_changes,
+    populate_project_repo_ids,
+    process_github_hook_delivery,
+    prune_github_hook_deliveries,
+    refill_scratch_org_pool,
+    refill_scratch_org_pools,
     refresh_commits,
     refresh_github_issues,
     refresh_github_repositories_for_user,
@@ -31,7 +42,7 @@ from ..jobs import (
     submit_review,
     user_reassign,
 )
-from ..models import ScratchOrgType
+from ..models import GitHubHookDelivery, ScratchOrgSnapshotStatus, ScratchOrgType
 
 Author = namedtuple("Author", ("avatar_url", "login"))
 Commit = namedtuple(
@@ -68,7 +79,7 @@ class TestCreateBranchesOnGitHub:
         task = _task_factory()
 
         with ExitStack() as stack:
-            stack.enter_context(patch(f"{PATCH_ROOT}.local_github_checkout"))
+            stack.enter_context(patch(f"{PATCH_ROOT}.local_github_metadata_checkout"))
             project_config = stack.enter_context(patch("metecho.api.gh.ProjectConfig"))
             project_config_instance = MagicMock(project__git__prefix_feature="feature/")
             project_config.return_value = project_config_instance
@@ -94,7 +105,7 @@ class TestCreateBranchesOnGitHub:
         epic = epic_factory()
 
         with ExitStack() as stack:
-            stack.enter_context(patch(f"{PATCH_ROOT}.local_github_checkout"))
+            stack.enter_context(patch(f"{PATCH_ROOT}.local_github_metadata_checkout"))
             project_config = stack.enter_context(patch("metecho.api.gh.ProjectConfig"))
             project_config_instance = MagicMock(project__git__prefix_feature="feature/")
             project_config.return_value = project_config_instance
@@ -147,8 +158,8 @@ class TestCreateBranchesOnGitHub:
         epic = task.epic
 
         with ExitStack() as stack:
-            local_github_checkout = stack.enter_context(
-                patch(f"{PATCH_ROOT}.local_github_checkout")
+            local_github_metadata_checkout = stack.enter_context(
+                patch(f"{PATCH_ROOT}.local_github_metadata_checkout")
             )
             try_to_make_branch = stack.enter_context(
                 patch(f"{PATCH_ROOT}.try_to_make_branch")
@@ -170,7 +181,7 @@ class TestCreateBranchesOnGitHub:
             )
 
             assert try_to_make_branch.called
-            assert not local_github_checkout.called
+            assert not local_github_metadata_checkout.called
 
     def test_create_branches_on_github__repo_branch_prefix(
         self, user_factory, task_factory
@@ -180,8 +191,8 @@ class TestCreateBranchesOnGitHub:
         epic = task.epic
 
         with ExitStack() as stack:
-            local_github_checkout = stack.enter_context(
-                patch(f"{PATCH_ROOT}.local_github_checkout")
+            local_github_metadata_checkout = stack.enter_context(
+                patch(f"{PATCH_ROOT}.local_github_metadata_checkout")
             )
             try_to_make_branch = stack.enter_context(
                 patch(f"{PATCH_ROOT}.try_to_make_branch")
@@ -203,7 +214,7 @@ class TestCreateBranchesOnGitHub:
             )
 
             assert try_to_make_branch.called
-            assert not local_github_checkout.called
+            assert not local_github_metadata_checkout.called
 
     def test_create_branches_on_github__already_there(
         self, user_factory, epic_factory, task_factory
@@ -253,8 +264,156 @@ class TestCreateBranchesOnGitHub:
             assert not repository.create_branch_ref.called
 
 
+@pytest.mark.django_db
+class TestPopulateProjectRepoIds:
+    def test_success(self, mocker, project_factory):
+        project = project_factory(repo_id=None)
+        cache.set(get_repo_id_backoff_key(project), {"failures": 0, "retry_at": None})
+        mocker.patch(
+            "metecho.api.model_mixins.get_repo_info", return_value=MagicMock(id=789)
+        )
+
+        populate_project_repo_ids()
+
+        project.refresh_from_db()
+        assert project.repo_id == 789
+        assert cache.get(get_repo_id_backoff_key(project)) is None
+
+    def test_backoff(self, mocker, project_factory):
+        project = project_factory(repo_id=None)
+        cache.delete(get_repo_id_backoff_key(project))
+        get_repo_info = mocker.patch(
+            "metecho.api.model_mixins.get_repo_info",
+            side_effect=ResponseError(MagicMock()),
+        )
+
+        populate_project_repo_ids()
+        populate_project_repo_ids()
+
+        assert get_repo_info.call_count == 1
+        backoff = cache.get(get_repo_id_backoff_key(project))
+        assert backoff["failures"] == 1
+        assert backoff["retry_at"] > now()
+
+        cache.set(get_repo_id_backoff_key(project), {**backoff, "retry_at": now()})
+        populate_project_repo_ids()
+
+        assert get_repo_info.call_count == 2
+        assert cache.get(get_repo_id_backoff_key(project))["failures"] == 2
+
+
+@pytest.mark.django_db
+class TestProcessGitHubHookDelivery:
+    def make_push(self, sha, **kwargs):
+        return GitHubHookDelivery.objects.create(
+            delivery_id=sha,
+            event="push",
+            repo_id=123,
+            ref="refs/heads/feature",
+            payload={
+                "ref": "refs/heads/feature",
+                "forced": False,
+                "repository": {"id": 123},
+                "commits": [
+                    {
+                        "id": sha,
+                        "timestamp": "2019-11-20 21:32:53.668260+00:00",
+                        "author": {},
+                        "message": "Message",
+                        "url": "https://github.com/test/user/foo",
+                    }
+                ],
+                "sender": {},
+                **kwargs,
+            },
+        )
+
+    def test_single_push(self, mocker, project_factory):
+        project_factory(repo_id=123)
+        add_commits = mocker.patch("metecho.api.models.Project.add_commits")
+        delivery = self.make_push("abc")
+
+        process_github_hook_delivery(delivery)
+
+        assert add_commits.call_args.kwargs["ref"] == "feature"
+        delivery.refresh_from_db()
+        assert delivery.processed_at is not None
+
+    def test_coalesced(self, mocker, project_factory):
+        project_factory(repo_id=123)
+        add_commits = mocker.patch("metecho.api.models.Project.add_commits")
+        queue_refresh_commits = mocker.patch(
+            "metecho.api.models.Project.queue_refresh_commits"
+        )
+        forget_branch_index = mocker.patch(
+            "metecho.api.hook_serializers.forget_branch_index"
+        )
+        first = self.make_push("abc", created=True)
+        second = self.make_push("def")
+
+        process_github_hook_delivery(first)
+        process_github_hook_delivery(second)
+
+        assert not add_commits.called
+        queue_refresh_commits.assert_called_once_with(
+            ref="feature", originating_user_id=None
+        )
+        assert forget_branch_index.called
+        assert not GitHubHookDelivery.objects.filter(processed_at__isnull=True).exists()
+
+    def test_error(self, mocker, project_factory):
+        project_factory(repo_id=123)
+        mocker.patch(
+            "metecho.api.models.Project.add_commits", side_effect=Exception("Oh no!")
+        )
+        delivery = self.make_push("abc")
+
+        with pytest.raises(Exception, match="Oh no!"):
+            process_github_hook_delivery(delivery)
+
+        delivery.refresh_from_db()
+        assert delivery.processed_at is None
+
+    def test_invalid(self, mocker, caplog):
+        add_commits = mocker.patch("metecho.api.models.Project.add_commits")
+        delivery = self.make_push("abc", ref=None)
+
+        process_github_hook_delivery(delivery)
+
+        assert not add_commits.called
+        assert "Invalid" in caplog.text
+        delivery.refresh_from_db()
+        assert delivery.processed_at is not None
+
+
+@pytest.mark.django_db
+def test_prune_github_hook_deliveries(settings):
+    settings.GITHUB_HOOK_DELIVERY_RETENTION_DAYS = 7
+    old = GitHubHookDelivery.objects.create(
+        delivery_id="old", event="push", payload={}, processed_at=now()
+    )
+    GitHubHookDelivery.objects.filter(pk=old.pk).update(
+        processed_at=now() - timedelta(days=8)
+    )
+    GitHubHookDelivery.objects.create(
+        delivery_id="recent", event="push", payload={}, processed_at=now()
+    )
+    GitHubHookDelivery.objects.create(delivery_id="pending", event="push", payload={})
+
+    prune_github_hook_deliveries()
+
+    assert set(GitHubHookDelivery.objects.values_list("delivery_id", flat=True)) == {
+        "recent",
+        "pending",
+    }
+
+
 @pytest.mark.django_db
 class TestRefreshGitHubIssues:
+    @pytest.fixture(autouse=True)
+    def get_app_deferral_time(self, mocker):
+        return mocker.patch(f"{PATCH_ROOT}.get_app_deferral_time", return_value=None)
+
     def test_filter_pull_requests(
         self, mocker, settings, project_factory, short_issue_factory
     ):
@@ -316,6 +475,83 @@ class TestRefreshGitHubIssues:
         assert not project.currently_fetching_issues
         assert "Oh no!" in caplog.text
 
+    def test_incremental(self, mocker, project_factory, short_issue_factory):
+        since = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        later = datetime(2022, 1, 2, tzinfo=timezone.utc)
+        project = project_factory(
+            currently_fetching_issues=True, issues_refreshed_at=since
+        )
+        closed = project.issues.create(
+            github_id=1,
+            title="Closed",
+            number=1,
+            state="open",
+            html_url="https://example.com/1",
+            created_at=since,
+            updated_at=since,
+        )
+        get_repo_info = mocker.patch(f"{PATCH_ROOT}.get_repo_info", autospec=True)
+        issues = get_repo_info.return_value.issues
+        issues.return_value.__next__.side_effect = (
+            short_issue_factory(
+                id=1, state="closed", updated_at=later, pull_request_urls=None
+            ),
+            short_issue_factory(
+                id=2, state="closed", updated_at=since, pull_request_urls=None
+            ),
+            short_issue_factory(
+                id=3, state="open", updated_at=since, pull_request_urls=None
+            ),
+        )
+
+        refresh_github_issues(project, originating_user_id=None)
+
+        issues.assert_called_once_with(
+            state="all", sort="updated", direction="asc", since=since
+        )
+        project.refresh_from_db()
+        closed.refresh_from_db()
+        assert closed.state == "closed"
+        assert set(project.issues.values_list("github_id", flat=True)) == {1, 3}
+        assert project.issues_refreshed_at == later
+
+    def test_full(self, mocker, project_factory, short_issue_factory):
+        project = project_factory(
+            currently_fetching_issues=True,
+            issues_refreshed_at=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        )
+        get_repo_info = mocker.patch(f"{PATCH_ROOT}.get_repo_info", autospec=True)
+        issues = get_repo_info.return_value.issues
+        issues.return_value.__next__.side_effect = (
+            short_issue_factory(pull_request_urls=None),
+        )
+
+        refresh_github_issues(project, originating_user_id=None, full=True)
+
+        issues.assert_called_once_with()
+        assert project.issues.count() == 1
+
+    def test_deferred(self, mocker, get_app_deferral_time, project_factory):
+        get_app_deferral_time.return_value = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        get_scheduler = mocker.patch(f"{PATCH_ROOT}.get_scheduler")
+        get_repo_info = mocker.patch(f"{PATCH_ROOT}.get_repo_info")
+        async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
+        project = project_factory(currently_fetching_issues=True)
+
+        refresh_github_issues(project, originating_user_id=None)
+
+        get_scheduler.return_value.enqueue_at.assert_called_once_with(
+            datetime(2022, 1, 1, tzinfo=timezone.utc),
+            refresh_github_issues,
+            project,
+            originating_user_id=None,
+            full=False,
+        )
+        assert not get_repo_info.called
+        project.refresh_from_db()
+        assert not project.currently_fetching_issues
+        assert async_to_sync.called
+
 
 @pytest.mark.django_db
 class TestAlertUserAboutExpiringOrg:
@@ -366,9 +602,10 @@ def test_create_org_and_run_flow():
             False,
         )
         stack.enter_context(patch(f"{PATCH_ROOT}.get_scheduler"))
-        Path = stack.enter_context(patch(f"{PATCH_ROOT}.Path"))
-        Path.return_value = MagicMock(**{"read_text.return_value": "test logs"})
-        scratch_org = MagicMock(org_type=ScratchOrgType.DEV)
+        scratch_org = MagicMock(
+            org_type=ScratchOrgType.DEV,
+            **{"root_project.uses_org_snapshots": False},
+        )
         _create_org_and_run_flow(
             scratch_org,
             user=MagicMock(),
@@ -379,8 +616,47 @@ def test_create_org_and_run_flow():
         )
 
         assert create_org.called
-        assert run_flow.called
-        assert isinstance(scratch_org.cci_log, str)
+        assert run_flow.call_args.kwargs["output_handler"].args == (scratch_org,)
+
+
+@pytest.mark.django_db
+def test_run_setup_flow(mocker, scratch_org_factory):
+    mocker.patch("metecho.api.model_mixins.async_to_sync")
+    scratch_org = scratch_org_factory(cci_log="")
+
+    def run_flow(*, output_handler, **kwargs):
+        output_handler("Running flow\n")
+
+    mocker.patch(f"{PATCH_ROOT}.run_flow", side_effect=run_flow)
+
+    _run_setup_flow(
+        scratch_org,
+        scratch_org_config=MagicMock(setup_flow="dev_org"),
+        cci=MagicMock(),
+        org_config=MagicMock(),
+        project_path="",
+        user=MagicMock(),
+    )
+
+    assert scratch_org.cci_log == "Running flow\n"
+
+
+@pytest.mark.django_db
+def test_append_flow_output(mocker, scratch_org_factory):
+    async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
+    scratch_org = scratch_org_factory(cci_log="")
+
+    _append_flow_output(scratch_org, "Running flow\n")
+    _append_flow_output(scratch_org, "Flow complete\n")
+
+    scratch_org.refresh_from_db()
+    assert scratch_org.cci_log == "Running flow\nFlow complete\n"
+    assert async_to_sync.return_value.call_count == 2
+    _, message = async_to_sync.return_value.call_args.args
+    assert message == {
+        "type": "SCRATCH_ORG_FLOW_OUTPUT",
+        "payload": {"originating_user_id": None, "output": "Flow complete\n"},
+    }
 
 
 def test_create_org_and_run_flow__fall_back_to_cases():
@@ -408,10 +684,12 @@ def test_create_org_and_run_flow__fall_back_to_cases():
             False,
         )
         stack.enter_context(patch(f"{PATCH_ROOT}.get_scheduler"))
-        Path = stack.enter_context(patch(f"{PATCH_ROOT}.Path"))
-        Path.return_value = MagicMock(**{"read_text.return_value": "test logs"})
         _create_org_and_run_flow(
-            MagicMock(org_type=ScratchOrgType.DEV, org_config_name="dev"),
+            MagicMock(
+                org_type=ScratchOrgType.DEV,
+                org_config_name="dev",
+                **{"root_project.uses_org_snapshots": False},
+            ),
             user=MagicMock(),
             repo_id=123,
             repo_branch=MagicMock(),
@@ -423,13 +701,115 @@ def test_create_org_and_run_flow__fall_back_to_cases():
         assert run_flow.called
 
 
+class TestCreateOrgAndRunFlowFromSnapshot:
+    @pytest.fixture(autouse=True)
+    def patches(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.get_latest_revision_numbers")
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info")
+        mocker.patch(
+            f"{PATCH_ROOT}.get_valid_target_directories", return_value=({}, False)
+        )
+        mocker.patch(f"{PATCH_ROOT}.get_scheduler")
+        mocker.patch(f"{PATCH_ROOT}.get_snapshot_key", return_value="key")
+        self.create_org = mocker.patch(f"{PATCH_ROOT}.create_org")
+        self.create_org.return_value = (MagicMock(), MagicMock(), MagicMock())
+        self.run_flow = mocker.patch(f"{PATCH_ROOT}.run_flow")
+        self.create_org_snapshot = mocker.patch(f"{PATCH_ROOT}.create_org_snapshot")
+        self.scratch_org = MagicMock(
+            org_config_name="dev",
+            deleted_at=None,
+            **{"root_project.uses_org_snapshots": True},
+        )
+
+    def run(self):
+        _create_org_and_run_flow(
+            self.scratch_org,
+            user=MagicMock(),
+            repo_id=123,
+            repo_branch="main",
+            project_path="",
+            originating_user_id=None,
+        )
+
+    def test_hit(self, mocker):
+        mocker.patch(
+            f"{PATCH_ROOT}.get_org_snapshot",
+            return_value=MagicMock(snapshot_name="M123"),
+        )
+
+        self.run()
+
+        assert self.create_org.call_args.kwargs["snapshot_name"] == "M123"
+        assert not self.run_flow.called
+        assert not self.create_org_snapshot.called
+        assert self.scratch_org.cci_log == ""
+
+    def test_lookup_error(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.get_org_snapshot", side_effect=Exception("Oh no!"))
+        logger = mocker.patch(f"{PATCH_ROOT}.logger")
+
+        self.run()
+
+        assert self.create_org.call_args.kwargs["snapshot_name"] is None
+        assert self.run_flow.called
+        assert logger.warning.called
+
+    def test_miss(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.get_org_snapshot", return_value=None)
+
+        self.run()
+
+        assert self.create_org.call_args.kwargs["snapshot_name"] is None
+        assert self.run_flow.called
+        self.create_org_snapshot.assert_called_once_with(
+            self.scratch_org, key="key", devhub_username=mocker.ANY
+        )
+
+    def test_miss__snapshot_error(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.get_org_snapshot", return_value=None)
+        self.create_org_snapshot.side_effect = Exception("Oh no!")
+        logger = mocker.patch(f"{PATCH_ROOT}.logger")
+
+        self.run()
+
+        assert self.run_flow.called
+        assert logger.warning.called
+
+    def test_fallback(self, mocker):
+        snapshot = MagicMock(snapshot_name="M123")
+        mocker.patch(f"{PATCH_ROOT}.get_org_snapshot", return_value=snapshot)
+        self.create_org.side_effect = [
+            Exception("Oh no!"),
+            self.create_org.return_value,
+        ]
+
+        self.run()
+
+        assert self.create_org.call_count == 2
+        assert "snapshot_name" not in self.create_org.call_args.kwargs
+        assert snapshot.status == ScratchOrgSnapshotStatus.ERROR
+        assert self.run_flow.called
+
+    def test_fallback__org_removed(self, mocker):
+        mocker.patch(
+            f"{PATCH_ROOT}.get_org_snapshot",
+            return_value=MagicMock(snapshot_name="M123"),
+        )
+        self.create_org.side_effect = Exception("Oh no!")
+        self.scratch_org.deleted_at = now()
+
+        with pytest.raises(Exception, match="Oh no!"):
+            self.run()
+
+        assert self.create_org.call_count == 1
+
+
 @pytest.mark.django_db
 def test_get_unsaved_changes(scratch_org_factory):
-    scratch_org = scratch_org_factory(
-        latest_revision_numbers={"TypeOne": {"NameOne": 10}}
-    )
+    scratch_org = scratch_org_factory()
+    scratch_org.set_latest_revision_numbers({"TypeOne": {"NameOne": 10}})
     with ExitStack() as stack:
-        stack.enter_context(patch(f"{PATCH_ROOT}.local_github_checkout"))
+        stack.enter_context(patch(f"{PATCH_ROOT}.local_github_metadata_checkout"))
         stack.enter_context(patch("metecho.api.sf_org_changes.get_repo_info"))
         get_valid_target_directories = stack.enter_context(
             patch(f"{PATCH_ROOT}.get_valid_target_directories")
@@ -453,7 +833,7 @@ def test_get_unsaved_changes(scratch_org_factory):
             "TypeOne": ["NameOne"],
             "TypeTwo": ["NameTwo"],
         }
-        assert scratch_org.latest_revision_numbers == {"TypeOne": {"NameOne": 10}}
+        assert list(scratch_org.iter_revisions()) == [("TypeOne", "NameOne", 10)]
 
 
 def test_create_branches_on_github_then_create_scratch_org():
@@ -517,6 +897,165 @@ class TestRefreshScratchOrg:
             assert logger.error.called
 
 
+@pytest.mark.django_db
+class TestScratchOrgPools:
+    @pytest.fixture
+    def get_repo_info(self, mocker):
+        get_repo_info = mocker.patch(f"{PATCH_ROOT}.get_repo_info")
+        get_repo_info.return_value.branch.return_value.latest_sha.return_value = "abc"
+        return get_repo_info
+
+    @pytest.fixture
+    def pool(self, scratch_org_pool_factory):
+        return scratch_org_pool_factory(size=2, project__branch_name="main")
+
+    def make_pooled_org(self, scratch_org_factory, pool, **kwargs):
+        return scratch_org_factory(
+            pool=pool,
+            project=pool.project,
+            task=None,
+            org_type=ScratchOrgType.PLAYGROUND,
+            owner=pool.owner,
+            **kwargs,
+        )
+
+    def test_refill(self, mocker, get_repo_info, scratch_org_factory, pool):
+        delete_scratch_org_job = mocker.patch("metecho.api.jobs.delete_scratch_org_job")
+        stale = self.make_pooled_org(
+            scratch_org_factory,
+            pool,
+            is_created=True,
+            latest_commit="old",
+            last_modified_at=now(),
+            expires_at=now() + timedelta(days=30),
+        )
+        self.make_pooled_org(scratch_org_factory, pool)
+
+        refill_scratch_org_pool(pool)
+
+        delete_scratch_org_job.delay.assert_called_once_with(
+            stale, originating_user_id=None
+        )
+        assert pool.orgs.filter(delete_queued_at__isnull=True).count() == 2
+
+    def test_refill__surplus(self, mocker, get_repo_info, scratch_org_factory, pool):
+        delete_scratch_org_job = mocker.patch("metecho.api.jobs.delete_scratch_org_job")
+        orgs = [
+            self.make_pooled_org(
+                scratch_org_factory,
+                pool,
+                is_created=True,
+                latest_commit="abc",
+                last_modified_at=now(),
+                expires_at=now() + timedelta(days=30),
+            )
+            for _i in range(3)
+        ]
+
+        refill_scratch_org_pool(pool)
+
+        delete_scratch_org_job.delay.assert_called_once_with(
+            orgs[0], originating_user_id=None
+        )
+        assert pool.orgs.filter(delete_queued_at__isnull=True).count() == 2
+
+    def test_refill__running(self, get_repo_info, pool):
+        lock_key = f"scratch_org_pool_refill_{pool.pk}"
+        cache.set(lock_key, True)
+        try:
+            refill_scratch_org_pool(pool)
+        finally:
+            cache.delete(lock_key)
+
+        assert not get_repo_info.called
+        assert not pool.orgs.exists()
+
+    def test_refill__error(self, mocker, pool):
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", side_effect=Exception("Oh no!"))
+        logger = mocker.patch(f"{PATCH_ROOT}.logger")
+
+        with pytest.raises(Exception, match="Oh no!"):
+            refill_scratch_org_pool(pool)
+
+        assert logger.error.called
+
+    def test_refill_all(self, mocker, pool):
+        refill_scratch_org_pool_job = mocker.patch(
+            f"{PATCH_ROOT}.refill_scratch_org_pool_job"
+        )
+
+        refill_scratch_org_pools()
+
+        refill_scratch_org_pool_job.delay.assert_called_once_with(pool)
+
+    def test_claim(
+        self, mocker, get_repo_info, scratch_org_factory, user_factory, pool
+    ):
+        mocker.patch(f"{PATCH_ROOT}.get_scheduler")
+        refill_scratch_org_pool_job = mocker.patch(
+            f"{PATCH_ROOT}.refill_scratch_org_pool_job"
+        )
+        get_refreshed_org_config = mocker.patch(
+            "metecho.api.models.ScratchOrg.get_refreshed_org_config"
+        )
+        user = user_factory()
+        pooled = self.make_pooled_org(
+            scratch_org_factory,
+            pool,
+            is_created=True,
+            url="https://example.com",
+            latest_commit="abc",
+            owner_sf_username=user.sf_username,
+            expires_at=now() + timedelta(days=30),
+        )
+        pooled.set_latest_revision_numbers({"type": {"name": 1}})
+        scratch_org = scratch_org_factory(
+            task__project=pool.project, task__epic=None, owner=user
+        )
+
+        assert _claim_pooled_scratch_org(
+            scratch_org, user=user, repo_id=123, commit_ish="main"
+        )
+
+        scratch_org.refresh_from_db()
+        assert scratch_org.url == "https://example.com"
+        assert scratch_org.is_created
+        assert list(scratch_org.iter_revisions()) == [("type", "name", 1)]
+        assert not pool.orgs.exists()
+        client = get_refreshed_org_config.return_value.salesforce_client
+        client.User.update.assert_called_once()
+        refill_scratch_org_pool_job.delay.assert_called_once_with(pool)
+
+    def test_claim__other_commit(
+        self, get_repo_info, scratch_org_factory, user_factory, pool
+    ):
+        user = user_factory()
+        self.make_pooled_org(
+            scratch_org_factory,
+            pool,
+            is_created=True,
+            latest_commit="old",
+            owner_sf_username=user.sf_username,
+            expires_at=now() + timedelta(days=30),
+        )
+        scratch_org = scratch_org_factory(
+            task__project=pool.project, task__epic=None, owner=user
+        )
+
+        assert not _claim_pooled_scratch_org(
+            scratch_org, user=user, repo_id=123, commit_ish="main"
+        )
+        assert pool.orgs.count() == 1
+
+    def test_claim__no_pool(self, get_repo_info, scratch_org_factory):
+        scratch_org = scratch_org_factory()
+
+        assert not _claim_pooled_scratch_org(
+            scratch_org, user=scratch_org.owner, repo_id=123, commit_ish="main"
+        )
+        assert not get_repo_info.called
+
+
 @pytest.mark.django_db
 class TestConvertScratchOrg:
     @pytest.mark.parametrize(
@@ -621,6 +1160,36 @@ class TestRefreshGitHubRepositoriesForUser:
         assert user.repositories.count() == 2
         assert async_to_sync.called
 
+    def test_diff(self, mocker, user_factory, git_hub_repository_factory):
+        user = user_factory(currently_fetching_repos=True)
+        unchanged = git_hub_repository_factory(
+            user=user, repo_id=1, repo_url="https://example.com/1", permissions={}
+        )
+        changed = git_hub_repository_factory(
+            user=user, repo_id=2, repo_url="https://example.com/2", permissions={}
+        )
+        git_hub_repository_factory(user=user, repo_id=3)
+        mocker.patch("metecho.api.models.async_to_sync")
+        mocker.patch(
+            "metecho.api.jobs.get_all_org_repos",
+            return_value=[
+                MagicMock(id=1, html_url="https://example.com/1", permissions={}),
+                MagicMock(
+                    id=2, html_url="https://example.com/2", permissions={"push": True}
+                ),
+                MagicMock(id=4, html_url="https://example.com/4", permissions={}),
+            ],
+        )
+
+        refresh_github_repositories_for_user(user)
+        user.refresh_from_db()
+
+        assert sorted(user.repositories.values_list("repo_id", flat=True)) == [1, 2, 4]
+        assert user.repositories.get(repo_id=1).pk == unchanged.pk
+        assert user.repositories.get(repo_id=2).pk == changed.pk
+        assert user.repositories.get(repo_id=2).permissions == {"push": True}
+        assert user.repositories_refreshed_at is not None
+
     def test_error(self, mocker, caplog, user_factory, git_hub_repository_factory):
         user = user_factory(currently_fetching_repos=True)
         git_hub_repository_factory(user=user)
@@ -667,7 +1236,7 @@ def test_commit_changes_from_org(scratch_org_factory, user_factory):
         desired_changes = {"name": ["member"]}
         commit_message = "test message"
         target_directory = "src"
-        assert scratch_org.latest_revision_numbers == {}
+        assert not scratch_org.revisions.exists()
         commit_changes_from_org(
             scratch_org=scratch_org,
             user=user,
@@ -678,7 +1247,7 @@ def test_commit_changes_from_org(scratch_org_factory, user_factory):
         )
 
         assert commit_changes_to_github.called
-        assert scratch_org.latest_revision_numbers == {"name": {"member": 1}}
+        assert list(scratch_org.iter_revisions()) == [("name", "member", 1)]
 
 
 # TODO: this should be bundled with each function, not all error-handling together.
@@ -751,6 +1320,10 @@ class TestErrorHandling:
 
 @pytest.mark.django_db
 class TestRefreshCommits:
+    @pytest.fixture(autouse=True)
+    def get_ahead_by(self, mocker):
+        return mocker.patch("metecho.api.gh.get_ahead_by", return_value={})
+
     def test_refreshes_commits(
         self,
         user_factory,
@@ -791,7 +1364,10 @@ class TestRefreshCommits:
             repo = MagicMock(
                 **{
                     "compare_commits.return_value": MagicMock(ahead_by=0),
-                    "branch.return_value": MagicMock(commit=MagicMock(sha="bleep")),
+                    "branch.return_value": MagicMock(
+                        commit=MagicMock(sha="bleep"),
+                        **{"latest_sha.return_value": "abcd1234"},
+                    ),
                     "commits.return_value": [commit1, commit2],
                 }
             )
@@ -820,6 +1396,128 @@ class TestRefreshCommits:
             project.refresh_from_db()
             assert project.latest_sha == "abcd1234"
 
+    def make_commit(self, sha):
+        return Commit(
+            sha=sha,
+            author=None,
+            message=f"Commit {sha}",
+            commit=Commit(**{"author": {"date": "2019-12-09 13:00"}}),
+            html_url="https://github.com/test/user/foo",
+        )
+
+    def test_compare(self, mocker, task_factory):
+        task = task_factory(branch_name="task", origin_sha="origin")
+        repo = MagicMock(
+            **{
+                "branch.return_value.latest_sha.return_value": "head",
+                "compare_commits.return_value": MagicMock(
+                    status="ahead",
+                    ahead_by=2,
+                    total_commits=2,
+                    commits=[self.make_commit("first"), self.make_commit("head")],
+                ),
+            }
+        )
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
+        mocker.patch("metecho.api.gh.get_repo_info", return_value=repo)
+
+        refresh_commits(
+            project=task.root_project, branch_name="task", originating_user_id=None
+        )
+
+        task.refresh_from_db()
+        assert [commit["id"] for commit in task.commits] == ["head", "first"]
+        repo.compare_commits.assert_any_call("origin", "head")
+        assert not repo.commits.called
+
+    def test_has_unmerged_commits(self, mocker, get_ahead_by, task_factory):
+        task = task_factory(
+            epic__branch_name="epic", branch_name="task", origin_sha="origin"
+        )
+        other_task = task_factory(
+            epic=task.epic, branch_name="task", origin_sha="origin"
+        )
+        get_ahead_by.return_value = {("epic", "task"): 3}
+        repo = MagicMock(
+            **{
+                "branch.return_value.latest_sha.return_value": "head",
+                "compare_commits.return_value": MagicMock(
+                    status="ahead", ahead_by=0, total_commits=0, commits=[]
+                ),
+            }
+        )
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
+        mocker.patch("metecho.api.gh.get_repo_info", return_value=repo)
+
+        refresh_commits(
+            project=task.root_project, branch_name="task", originating_user_id=None
+        )
+
+        get_ahead_by.assert_called_once_with(repo, [("epic", "task"), ("epic", "task")])
+        for instance in (task, other_task):
+            instance.refresh_from_db()
+            assert instance.has_unmerged_commits
+
+    def test_origin_not_on_branch(self, mocker, caplog, task_factory):
+        task = task_factory(
+            branch_name="task", origin_sha="origin", commits=[{"id": "old"}]
+        )
+        repo = MagicMock(
+            **{
+                "branch.return_value.latest_sha.return_value": "head",
+                "compare_commits.return_value": MagicMock(
+                    status="diverged", ahead_by=1
+                ),
+                "commits.return_value": [self.make_commit("head")],
+            }
+        )
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
+        mocker.patch("metecho.api.gh.get_repo_info", return_value=repo)
+
+        refresh_commits(
+            project=task.root_project, branch_name="task", originating_user_id=None
+        )
+
+        task.refresh_from_db()
+        assert task.commits == [{"id": "old"}]
+        assert "is not on task" in caplog.text
+
+    def test_origin_gone(self, mocker, caplog, task_factory):
+        task = task_factory(
+            branch_name="task", origin_sha="origin", commits=[{"id": "old"}]
+        )
+        repo = MagicMock(
+            **{
+                "branch.return_value.latest_sha.return_value": "head",
+                "compare_commits.side_effect": NotFoundError(
+                    MagicMock(status_code=404)
+                ),
+                "commits.return_value": [self.make_commit("head")],
+            }
+        )
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
+        mocker.patch("metecho.api.gh.get_repo_info", return_value=repo)
+
+        refresh_commits(
+            project=task.root_project, branch_name="task", originating_user_id=None
+        )
+
+        task.refresh_from_db()
+        assert task.commits == [{"id": "old"}]
+        assert "is not on task" in caplog.text
+
+
+def test_commit_history():
+    repo = MagicMock(
+        **{"commits.return_value": iter([MagicMock(sha=sha) for sha in "abcdef"])}
+    )
+    history = CommitHistory(repo, "a")
+
+    assert [commit.sha for commit in history.commits_since("c")] == ["a", "b"]
+    assert [commit.sha for commit in history.commits_since("b")] == ["a"]
+    assert len(history.commits) == 3
+    assert history.commits_since("z") is None
+
 
 @pytest.mark.django_db
 def test_create_pr(user_factory, task_factory):
@@ -884,6 +1582,10 @@ def test_create_pr__error(user_factory, task_factory):
 
 @pytest.mark.django_db
 class TestRefreshGitHubUsers:
+    @pytest.fixture(autouse=True)
+    def get_app_deferral_time(self, mocker):
+        return mocker.patch(f"{PATCH_ROOT}.get_app_deferral_time", return_value=None)
+
     def test_success(
         self,
         mocker,
@@ -908,8 +1610,12 @@ class TestRefreshGitHubUsers:
         )
         repo = MagicMock(**{"collaborators.return_value": [collab1, collab2]})
         mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
-        get_cached_user = mocker.patch(f"{PATCH_ROOT}.get_cached_user")
-        get_cached_user.return_value.name = "FULL NAME"
+        full_user = MagicMock()
+        full_user.name = "FULL NAME"
+        mocker.patch(
+            f"{PATCH_ROOT}.get_cached_users",
+            return_value={"test-user-1": full_user, "test-user-2": full_user},
+        )
         async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
 
         refresh_github_users(project, originating_user_id=None)
@@ -934,6 +1640,38 @@ class TestRefreshGitHubUsers:
         assert not project.currently_fetching_github_users
         assert async_to_sync.called
 
+    def test_unchanged(self, mocker, project_factory):
+        github_users = [
+            {
+                "id": "123",
+                "name": "FULL NAME",
+                "login": "test-user-1",
+                "avatar_url": "https://example.com/avatar1.png",
+                "permissions": {"push": False},
+            },
+        ]
+        project = project_factory(repo_id=123, github_users=github_users)
+        collab = MagicMock(
+            id=123,
+            login="test-user-1",
+            avatar_url="https://example.com/avatar1.png",
+            permissions={"push": False},
+        )
+        repo = MagicMock(**{"collaborators.return_value": [collab]})
+        mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
+        full_user = MagicMock()
+        full_user.name = "FULL NAME"
+        mocker.patch(
+            f"{PATCH_ROOT}.get_cached_users", return_value={"test-user-1": full_user}
+        )
+        save = mocker.patch.object(project, "save")
+        async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
+
+        refresh_github_users(project, originating_user_id=None)
+
+        assert not save.called
+        assert not async_to_sync.called
+
     def test_expand_user_error(
         self,
         caplog,
@@ -957,7 +1695,7 @@ class TestRefreshGitHubUsers:
         repo = MagicMock(**{"collaborators.return_value": [collab1]})
         mocker.patch(f"{PATCH_ROOT}.get_repo_info", return_value=repo)
         mocker.patch(
-            f"{PATCH_ROOT}.get_cached_user", side_effect=Exception("GITHUB ERROR")
+            f"{PATCH_ROOT}.get_cached_users", side_effect=Exception("GITHUB ERROR")
         )
         async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
 
@@ -993,6 +1731,21 @@ class TestRefreshGitHubUsers:
         assert async_to_sync.called
         assert "Oh no!" in caplog.text
 
+    def test_deferred(self, mocker, get_app_deferral_time, project_factory):
+        get_app_deferral_time.return_value = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        get_scheduler = mocker.patch(f"{PATCH_ROOT}.get_scheduler")
+        get_repo_info = mocker.patch(f"{PATCH_ROOT}.get_repo_info")
+        async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
+        project = project_factory(currently_fetching_github_users=True)
+
+        refresh_github_users(project, originating_user_id=None)
+
+        assert get_scheduler.return_value.enqueue_at.called
+        assert not get_repo_info.called
+        project.refresh_from_db()
+        assert not project.currently_fetching_github_users
+        assert async_to_sync.called
+
 
 @pytest.mark.django_db
 class TestSubmitReview:
@@ -1192,7 +1945,7 @@ class TestAvailableTaskOrgConfigNames:
         user = user_factory()
         project.finalize_available_org_config_names = MagicMock()
         with ExitStack() as stack:
-            stack.enter_context(patch(f"{PATCH_ROOT}.local_github_checkout"))
+            stack.enter_context(patch(f"{PATCH_ROOT}.local_github_metadata_checkout"))
             get_repo_info = stack.enter_context(patch(f"{PATCH_ROOT}.get_repo_info"))
             get_repo_info.return_value = MagicMock(
                 **{
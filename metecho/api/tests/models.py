@@ -57,6 +57,46 @@ class TestProject:
             project.queue_refresh_commits(ref="some branch", originating_user_id=None)
             assert refresh_commits_job.delay.called
 
+    def test_add_commits(
+        self,
+        mocker,
+        django_capture_on_commit_callbacks,
+        project_factory,
+        epic_factory,
+        task_factory,
+    ):
+        project = project_factory(branch_name="main")
+        epic = epic_factory(project=project, branch_name="feature")
+        task1 = task_factory(epic=epic, branch_name="feature", commits=[{"id": "old"}])
+        task2 = task_factory(
+            epic__project=project, branch_name="feature", review_sha="new"
+        )
+        mocker.patch("metecho.api.gh.get_ahead_by", return_value={})
+        notify_changed = mocker.patch(
+            "metecho.api.model_mixins.PushMixin.notify_changed"
+        )
+        commit = {
+            "id": "new",
+            "timestamp": "2019-11-20 21:32:53.668260+00:00",
+            "author": {"name": "Test", "email": "test@example.com", "username": "t"},
+            "message": "Message",
+            "url": "https://github.com/test/user/foo",
+        }
+
+        with django_capture_on_commit_callbacks(execute=True):
+            project.add_commits(
+                commits=[commit], ref="feature", sender={"login": "t", "avatar_url": ""}
+            )
+
+        epic.refresh_from_db()
+        task1.refresh_from_db()
+        task2.refresh_from_db()
+        assert epic.latest_sha == "new"
+        assert [c["id"] for c in task1.commits] == ["new", "old"]
+        assert task2.review_valid
+        # One notification each for the epic and the two tasks:
+        assert notify_changed.call_count == 3
+
     def test_save__no_branch_name(self, project_factory, git_hub_repository_factory):
         with patch("metecho.api.gh.get_repo_info") as get_repo_info:
             repo_branch = MagicMock()
@@ -446,6 +486,30 @@ class TestTask:
 
 @pytest.mark.django_db
 class TestUser:
+    @pytest.mark.parametrize(
+        "minutes_ago, force, queued",
+        (
+            pytest.param(None, False, True, id="Never synced"),
+            pytest.param(1, False, False, id="Recently synced"),
+            pytest.param(1, True, True, id="Forced"),
+            pytest.param(60, False, True, id="Stale"),
+        ),
+    )
+    def test_queue_refresh_repositories(
+        self, mocker, settings, user_factory, minutes_ago, force, queued
+    ):
+        settings.GITHUB_REPOS_RECHECK_MINUTES = 10
+        job = mocker.patch("metecho.api.jobs.refresh_github_repositories_for_user_job")
+        user = user_factory(
+            repositories_refreshed_at=(
+                now() - timedelta(minutes=minutes_ago) if minutes_ago else None
+            )
+        )
+
+        user.queue_refresh_repositories(force=force)
+
+        assert job.delay.called == queued
+
     def test_org_id(self, user_factory, social_account_factory):
         user = user_factory()
         social_account_factory(user=user, provider="salesforce")
@@ -798,6 +862,62 @@ class TestScratchOrg:
             == task_with_project_scratch_org.task.project
         )
 
+    def test_revisions(self, scratch_org_factory):
+        scratch_org = scratch_org_factory()
+        scratch_org.set_latest_revision_numbers(
+            {"b": {"one": 1}, "a": {"two": 1, "one": 1}}
+        )
+        scratch_org.update_latest_revision_numbers({"a": {"two": 2, "three": 1}})
+
+        assert list(scratch_org.iter_revisions()) == [
+            ("a", "one", 1),
+            ("a", "three", 1),
+            ("a", "two", 2),
+            ("b", "one", 1),
+        ]
+
+        scratch_org.set_latest_revision_numbers({"c": {"one": 3}})
+
+        assert list(scratch_org.iter_revisions()) == [("c", "one", 3)]
+
+    def test_notify_changed__pooled(
+        self, mocker, scratch_org_factory, scratch_org_pool_factory
+    ):
+        pool = scratch_org_pool_factory()
+        scratch_org = scratch_org_factory(
+            pool=pool, project=pool.project, task=None, org_type="Playground"
+        )
+        async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
+
+        scratch_org.notify_changed(originating_user_id=None)
+        scratch_org.notify_scratch_org_error(
+            error=Exception(), type_="ERROR", originating_user_id=None
+        )
+
+        assert not async_to_sync.called
+
+    def test_delete__pooled(
+        self, mocker, scratch_org_factory, scratch_org_pool_factory
+    ):
+        mocker.patch("metecho.api.jobs.delete_scratch_org_job")
+        async_to_sync = mocker.patch("metecho.api.model_mixins.async_to_sync")
+        pool = scratch_org_pool_factory()
+        scratch_org = scratch_org_factory(
+            pool=pool,
+            project=pool.project,
+            task=None,
+            org_type="Playground",
+            last_modified_at=now(),
+        )
+
+        scratch_org.delete()
+
+        scratch_org.refresh_from_db()
+        assert scratch_org.deleted_at is not None
+        assert scratch_org.pool is None
+        assert not async_to_sync.called
+        pool.delete()
+
     def test_notify_changed(self, scratch_org_factory):
         with ExitStack() as stack:
             stack.enter_context(
@@ -2,11 +2,17 @@ from contextlib import ExitStack
 from unittest.mock import MagicMock, patch
 
 import pytest
+from django.core.cache import cache
+from django.utils.timezone import now
+from simple_salesforce.exceptions import SalesforceExpiredSession
 
 from ..sf_org_changes import (
+    SOURCE_MEMBER_RECONCILE_INTERVAL,
+    ScratchOrgSalesforce,
     commit_changes_to_github,
-    compare_revisions,
+    compare_sorted_revisions,
     get_latest_revision_numbers,
+    get_source_members_cache_key,
     get_valid_target_directories,
     run_retrieve_task,
 )
@@ -122,9 +128,7 @@ def test_commit_changes_to_github(user_factory, scratch_org_factory):
 
 def test_get_latest_revision_numbers():
     with ExitStack() as stack:
-        Salesforce = stack.enter_context(
-            patch(f"{PATCH_ROOT}.simple_salesforce.Salesforce")
-        )
+        Salesforce = stack.enter_context(patch(f"{PATCH_ROOT}.ScratchOrgSalesforce"))
         stack.enter_context(patch(f"{PATCH_ROOT}.refresh_access_token"))
 
         conn = MagicMock()
@@ -164,16 +168,112 @@ def test_get_latest_revision_numbers():
         assert conn.query_all.called
 
 
-def test_compare_revisions__true():
-    old = {}
+class TestGetLatestRevisionNumbers:
+    @pytest.fixture(autouse=True)
+    def conn(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.refresh_access_token")
+        conn = mocker.patch(f"{PATCH_ROOT}.ScratchOrgSalesforce").return_value
+        conn.query_all.return_value = {
+            "records": [
+                {"MemberType": "type", "MemberName": "name-1", "RevisionCounter": 3},
+                {"MemberType": "type", "MemberName": "name-2", "RevisionCounter": 4},
+            ]
+        }
+        return conn
+
+    @pytest.fixture
+    def scratch_org(self):
+        scratch_org = MagicMock(pk="abc123")
+        cache.delete(get_source_members_cache_key(scratch_org))
+        return scratch_org
+
+    def test_incremental(self, conn, scratch_org):
+        get_latest_revision_numbers(scratch_org, originating_user_id=None)
+        conn.query_all.return_value = {
+            "records": [
+                {"MemberType": "type", "MemberName": "name-1", "RevisionCounter": 5},
+                {
+                    "MemberType": "type",
+                    "MemberName": "name-2",
+                    "RevisionCounter": 6,
+                    "IsNameObsolete": True,
+                },
+                {"MemberType": "other", "MemberName": "name", "RevisionCounter": 7},
+            ]
+        }
+
+        result = get_latest_revision_numbers(scratch_org, originating_user_id=None)
+
+        assert "RevisionCounter > 4" in conn.query_all.call_args[0][0]
+        assert result == {"type": {"name-1": 5}, "other": {"name": 7}}
+
+    def test_full(self, conn, scratch_org):
+        get_latest_revision_numbers(scratch_org, originating_user_id=None)
+        get_latest_revision_numbers(scratch_org, originating_user_id=None, full=True)
+
+        assert "RevisionCounter >" not in conn.query_all.call_args[0][0]
+
+    def test_reconcile(self, mocker, conn, scratch_org):
+        get_latest_revision_numbers(scratch_org, originating_user_id=None)
+        mocker.patch(
+            f"{PATCH_ROOT}.now",
+            return_value=now() + SOURCE_MEMBER_RECONCILE_INTERVAL * 2,
+        )
+        conn.query_all.return_value = {
+            "records": [
+                {"MemberType": "type", "MemberName": "name-1", "RevisionCounter": 3}
+            ]
+        }
+
+        result = get_latest_revision_numbers(scratch_org, originating_user_id=None)
+
+        assert "RevisionCounter >" not in conn.query_all.call_args[0][0]
+        assert result == {"type": {"name-1": 3}}
+
+
+def test_scratch_org_salesforce__expired_session(mocker):
+    forget_access_token = mocker.patch(f"{PATCH_ROOT}.forget_access_token")
+    scratch_org = MagicMock()
+    conn = ScratchOrgSalesforce(
+        scratch_org=scratch_org, instance_url="https://example.com", session_id="abc"
+    )
+    mocker.patch.object(
+        conn.session,
+        "request",
+        return_value=MagicMock(status_code=401, content=b"[]", url="url"),
+    )
+
+    with pytest.raises(SalesforceExpiredSession):
+        conn.query("SELECT Id FROM Account")
+
+    forget_access_token.assert_called_once_with(scratch_org)
+
+
+def test_compare_sorted_revisions__true():
+    old_rows = []
     new = {"type": {"name": 1}}
-    assert compare_revisions(old, new)
+    assert compare_sorted_revisions(old_rows, new)
 
 
-def test_compare_revisions__false():
-    old = {"type": {"name": 1}}
+def test_compare_sorted_revisions__false():
+    old_rows = [("type", "name", 1)]
     new = {"type": {"name": 1}}
-    assert not compare_revisions(old, new)
+    assert not compare_sorted_revisions(old_rows, new)
+
+
+def test_compare_sorted_revisions():
+    old_rows = [("a", "one", 1), ("a", "two", 2), ("b", "one", 1), ("c", "one", 1)]
+    new = {
+        "a": {"two": 3, "one": 1},
+        "b": {"one": 1, "zero": 1},
+        "d": {"one": 1},
+    }
+
+    assert compare_sorted_revisions(old_rows, new) == {
+        "a": ["two"],
+        "b": ["zero"],
+        "d": ["one"],
+    }
 
 
 @pytest.mark.django_db
@@ -0,0 +1,230 @@
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from django.utils.timezone import now
+from simple_salesforce.exceptions import SalesforceError
+
+from ..models import ScratchOrgSnapshot, ScratchOrgSnapshotStatus
+from ..sf_org_snapshots import (
+    create_org_snapshot,
+    get_org_snapshot,
+    get_snapshot_key,
+    get_snapshot_name,
+)
+
+PATCH_ROOT = "metecho.api.sf_org_snapshots"
+
+
+def test_get_snapshot_key(tmp_path):
+    (tmp_path / "cumulusci.yml").write_text("project: {}")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "package.xml").write_text("<Package/>")
+    key = get_snapshot_key(str(tmp_path), "dev")
+
+    (tmp_path / "README.md").write_text("Read me")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "index.html").write_text("<html/>")
+    assert get_snapshot_key(str(tmp_path), "dev") == key
+
+    (tmp_path / "src" / "package.xml").write_text("<Package></Package>")
+    assert get_snapshot_key(str(tmp_path), "dev") != key
+    assert get_snapshot_key(str(tmp_path), "qa") != get_snapshot_key(
+        str(tmp_path), "dev"
+    )
+
+
+def test_get_snapshot_name():
+    name = get_snapshot_name(MagicMock(id="abc"), "dev", "key")
+
+    assert name.isalnum()
+    assert len(name) == 15
+
+
+@pytest.mark.django_db
+class TestGetOrgSnapshot:
+    def test_none(self, project_factory):
+        assert (
+            get_org_snapshot(
+                project=project_factory(),
+                org_config_name="dev",
+                key="key",
+                devhub_username="devhub",
+            )
+            is None
+        )
+
+    def test_in_progress(self, mocker, project_factory):
+        devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api").return_value
+        devhub_api.OrgSnapshot.get.return_value = {"Status": "In Progress"}
+        snapshot = ScratchOrgSnapshot.objects.create(
+            project=project_factory(),
+            org_config_name="dev",
+            key="key",
+            devhub_username="devhub",
+            snapshot_id="0Oo000000000001",
+            snapshot_name="M1",
+        )
+
+        assert (
+            get_org_snapshot(
+                project=snapshot.project,
+                org_config_name="dev",
+                key="key",
+                devhub_username="devhub",
+            )
+            is None
+        )
+
+    def test_in_progress__gone(self, mocker, project_factory):
+        devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api").return_value
+        devhub_api.OrgSnapshot.get.side_effect = SalesforceError(
+            "url", 404, "OrgSnapshot", {}
+        )
+        snapshot = ScratchOrgSnapshot.objects.create(
+            project=project_factory(),
+            org_config_name="dev",
+            key="key",
+            devhub_username="devhub",
+            snapshot_id="0Oo000000000001",
+            snapshot_name="M1",
+        )
+
+        assert (
+            get_org_snapshot(
+                project=snapshot.project,
+                org_config_name="dev",
+                key="key",
+                devhub_username="devhub",
+            )
+            is None
+        )
+        snapshot.refresh_from_db()
+        assert snapshot.status == ScratchOrgSnapshotStatus.ERROR
+
+    def test_active(self, mocker, project_factory):
+        devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api").return_value
+        devhub_api.OrgSnapshot.get.return_value = {"Status": "Active"}
+        devhub_api.OrgSnapshot.delete.side_effect = SalesforceError(
+            "url", 404, "OrgSnapshot", {}
+        )
+        project = project_factory()
+        old_snapshots = [
+            ScratchOrgSnapshot.objects.create(
+                project=project,
+                org_config_name="dev",
+                key=f"branch{i}",
+                devhub_username="devhub",
+                snapshot_id=f"0Oo00000000000{i}",
+                snapshot_name=f"M{i}",
+                status=ScratchOrgSnapshotStatus.ACTIVE,
+            )
+            for i in range(3)
+        ]
+        for days, old_snapshot in enumerate(old_snapshots):
+            ScratchOrgSnapshot.objects.filter(pk=old_snapshot.pk).update(
+                edited_at=now() - timedelta(days=days + 1)
+            )
+        snapshot = ScratchOrgSnapshot.objects.create(
+            project=project,
+            org_config_name="dev",
+            key="key",
+            devhub_username="devhub",
+            snapshot_id="0Oo000000000009",
+            snapshot_name="M9",
+        )
+
+        assert (
+            get_org_snapshot(
+                project=project,
+                org_config_name="dev",
+                key="key",
+                devhub_username="devhub",
+            )
+            == snapshot
+        )
+        # Only the least recently used is retired:
+        devhub_api.OrgSnapshot.delete.assert_called_once_with(
+            old_snapshots[2].snapshot_id
+        )
+        assert set(ScratchOrgSnapshot.objects.all()) == {
+            snapshot,
+            old_snapshots[0],
+            old_snapshots[1],
+        }
+
+    def test_active__marks_used(self, mocker, project_factory):
+        get_devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api")
+        snapshot = ScratchOrgSnapshot.objects.create(
+            project=project_factory(),
+            org_config_name="dev",
+            key="key",
+            devhub_username="devhub",
+            snapshot_id="0Oo000000000001",
+            snapshot_name="M1",
+            status=ScratchOrgSnapshotStatus.ACTIVE,
+        )
+        last_used = now() - timedelta(days=1)
+        ScratchOrgSnapshot.objects.filter(pk=snapshot.pk).update(edited_at=last_used)
+
+        get_org_snapshot(
+            project=snapshot.project,
+            org_config_name="dev",
+            key="key",
+            devhub_username="devhub",
+        )
+
+        assert not get_devhub_api.called
+        snapshot.refresh_from_db()
+        assert snapshot.edited_at > last_used
+
+
+@pytest.mark.django_db
+class TestCreateOrgSnapshot:
+    def test_create(self, mocker, scratch_org_factory):
+        devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api").return_value
+        devhub_api.OrgSnapshot.create.return_value = {"id": "0Oo000000000001"}
+        scratch_org = scratch_org_factory(config={"org_id": "00D000000000001AAA"})
+
+        snapshot = create_org_snapshot(scratch_org, key="key", devhub_username="hub")
+
+        assert snapshot.snapshot_id == "0Oo000000000001"
+        assert snapshot.status == ScratchOrgSnapshotStatus.IN_PROGRESS
+        create_args = devhub_api.OrgSnapshot.create.call_args[0][0]
+        assert create_args["SourceOrg"] == "00D000000000001"
+
+    def test_existing(self, mocker, scratch_org_factory):
+        get_devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api")
+        scratch_org = scratch_org_factory()
+        ScratchOrgSnapshot.objects.create(
+            project=scratch_org.root_project,
+            org_config_name=scratch_org.org_config_name,
+            key="key",
+            devhub_username="hub",
+            snapshot_id="0Oo000000000001",
+            snapshot_name="M1",
+        )
+
+        assert (
+            create_org_snapshot(scratch_org, key="key", devhub_username="hub") is None
+        )
+        assert not get_devhub_api.called
+
+    def test_replace_failed(self, mocker, scratch_org_factory):
+        devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api").return_value
+        devhub_api.OrgSnapshot.create.return_value = {"id": "0Oo000000000002"}
+        scratch_org = scratch_org_factory(config={"org_id": "00D000000000001AAA"})
+        ScratchOrgSnapshot.objects.create(
+            project=scratch_org.root_project,
+            org_config_name=scratch_org.org_config_name,
+            key="key",
+            devhub_username="hub",
+            snapshot_id="0Oo000000000001",
+            snapshot_name="M1",
+            status=ScratchOrgSnapshotStatus.ERROR,
+        )
+
+        snapshot = create_org_snapshot(scratch_org, key="key", devhub_username="hub")
+
+        devhub_api.OrgSnapshot.delete.assert_called_once_with("0Oo000000000001")
+        assert list(ScratchOrgSnapshot.objects.all()) == [snapshot]
@@ -8,6 +8,7 @@ from contextlib import ExitStack
 from unittest.mock import MagicMock, patch
 
 import pytest
+from django.core.cache import cache
 from requests.exceptions import HTTPError
 
 from ..sf_run_flow import (
@@ -16,13 +17,16 @@ from ..sf_run_flow import (
     create_org,
     delete_org,
     deploy_org_settings,
+    forget_access_token,
     get_access_token,
     get_devhub_api,
+    get_devhub_session_cache_key,
     get_org_details,
     get_org_result,
     is_org_good,
     mutate_scratch_org,
     refresh_access_token,
+    renew_expired_devhub_session,
     run_flow,
 )
 
@@ -94,18 +98,145 @@ class TestRefreshAccessToken:
 
             assert scratch_org.remove_scratch_org.called
 
+    def test_cached(self):
+        scratch_org = MagicMock(pk="abc123", config={"org_id": "00D000000000001"})
+        forget_access_token(scratch_org)
+
+        def refresh_oauth_token(keychain):
+            org_config.config.update(access_token="token", instance_url="url")
+
+        with patch(f"{PATCH_ROOT}.OrgConfig") as OrgConfig:
+            org_config = OrgConfig.return_value
+            org_config.config = {
+                "username": "test@example.com",
+                "org_id": "00D000000000001",
+            }
+            org_config.refresh_oauth_token.side_effect = refresh_oauth_token
+
+            for _ in range(2):
+                refresh_access_token(
+                    config={
+                        "username": "test@example.com",
+                        "org_id": "00D000000000001",
+                    },
+                    org_name="dev",
+                    scratch_org=scratch_org,
+                )
+
+        org_config.refresh_oauth_token.assert_called_once()
+        OrgConfig.assert_called_with(
+            {
+                "username": "test@example.com",
+                "org_id": "00D000000000001",
+                "access_token": "token",
+                "instance_url": "url",
+            },
+            "dev",
+            keychain=None,
+        )
+
+    def test_forgotten(self):
+        config = {"org_id": "00D000000000001"}
+        scratch_org = MagicMock(pk="abc123", config=config)
+
+        def refresh_oauth_token(keychain):
+            org_config.config.update(access_token="token")
+
+        with patch(f"{PATCH_ROOT}.OrgConfig") as OrgConfig:
+            org_config = OrgConfig.return_value
+            org_config.config = dict(config)
+            org_config.refresh_oauth_token.side_effect = refresh_oauth_token
+
+            refresh_access_token(config=config, org_name="dev", scratch_org=scratch_org)
+            forget_access_token(scratch_org)
+            refresh_access_token(config=config, org_name="dev", scratch_org=scratch_org)
+
+        assert org_config.refresh_oauth_token.call_count == 2
+
+    def test_other_org(self):
+        scratch_org = MagicMock(pk="abc123", config={"org_id": "00D000000000001"})
+        forget_access_token(scratch_org)
+        forget_access_token(
+            MagicMock(pk="abc123", config={"org_id": "00D000000000002"})
+        )
+
+        def refresh_oauth_token(keychain):
+            org_config.config.update(access_token="token")
+
+        with patch(f"{PATCH_ROOT}.OrgConfig") as OrgConfig:
+            org_config = OrgConfig.return_value
+            org_config.refresh_oauth_token.side_effect = refresh_oauth_token
+
+            for org_id in ("00D000000000001", "00D000000000002"):
+                org_config.config = {"org_id": org_id}
+                refresh_access_token(
+                    config={"org_id": org_id}, org_name="dev", scratch_org=scratch_org
+                )
+
+        assert org_config.refresh_oauth_token.call_count == 2
+
 
 class TestGetDevhubApi:
+    @pytest.fixture(autouse=True)
+    def clear_session(self):
+        cache.delete(get_devhub_session_cache_key("devhub_username"))
+
     def test_good(self):
         with ExitStack() as stack:
-            stack.enter_context(patch(f"{PATCH_ROOT}.jwt_session"))
+            jwt_session = stack.enter_context(patch(f"{PATCH_ROOT}.jwt_session"))
+            jwt_session.return_value = {"instance_url": "url", "access_token": "token"}
             SimpleSalesforce = stack.enter_context(
                 patch(f"{PATCH_ROOT}.SimpleSalesforce")
             )
 
             get_devhub_api(devhub_username="devhub_username")
 
-            assert SimpleSalesforce.called
+            SimpleSalesforce.assert_called_once_with(
+                instance_url="url",
+                session_id="token",
+                client_id="Metecho",
+                version="49.0",
+            )
+
+    def test_pooled(self):
+        with ExitStack() as stack:
+            jwt_session = stack.enter_context(patch(f"{PATCH_ROOT}.jwt_session"))
+            jwt_session.return_value = {"instance_url": "url", "access_token": "token"}
+            stack.enter_context(patch(f"{PATCH_ROOT}.SimpleSalesforce"))
+
+            get_devhub_api(devhub_username="devhub_username")
+            get_devhub_api(devhub_username="devhub_username")
+
+            jwt_session.assert_called_once()
+
+    def test_renew_expired_session(self):
+        client = MagicMock(headers={"Authorization": "Bearer old"})
+        response = MagicMock(status_code=401)
+        request = response.request.copy.return_value
+        request.headers = {"Authorization": "Bearer old"}
+        with patch(f"{PATCH_ROOT}.jwt_session") as jwt_session:
+            jwt_session.return_value = {"instance_url": "url", "access_token": "new"}
+
+            result = renew_expired_devhub_session(
+                client, "devhub_username", response, timeout=30
+            )
+
+        assert client.session_id == "new"
+        assert client.headers["Authorization"] == "Bearer new"
+        assert request.headers["Authorization"] == "Bearer new"
+        response.connection.send.assert_called_once_with(request, timeout=30)
+        assert result == response.connection.send.return_value
+        assert cache.get(get_devhub_session_cache_key("devhub_username"))
+
+    def test_renew_expired_session__not_expired(self):
+        response = MagicMock(status_code=200)
+        with patch(f"{PATCH_ROOT}.jwt_session") as jwt_session:
+            result = renew_expired_devhub_session(
+                MagicMock(), "devhub_username", response
+            )
+
+        assert result == response
+        assert not jwt_session.called
 
     def test_bad(self):
         with ExitStack() as stack:
@@ -160,6 +291,26 @@ def test_get_org_result(settings):
     assert result
 
 
+def test_get_org_result__snapshot(settings):
+    devhub_api = MagicMock()
+    get_org_result(
+        email="test@example.com",
+        repo_owner="owner",
+        repo_name="repo",
+        repo_branch="main",
+        scratch_org_config=MagicMock(),
+        scratch_org_definition={"edition": "Developer", "features": ["Communities"]},
+        cci=MagicMock(),
+        devhub_api=devhub_api,
+        snapshot_name="M123",
+    )
+
+    create_args = devhub_api.ScratchOrgInfo.create.call_args[0][0]
+    assert create_args["Snapshot"] == "M123"
+    assert "Edition" not in create_args
+    assert "Features" not in create_args
+
+
 def test_mutate_scratch_org():
     scratch_org_config = MagicMock()
     mutate_scratch_org(
@@ -226,8 +377,9 @@ class TestRunFlow:
             stack.enter_context(patch(f"{PATCH_ROOT}.os"))
             subprocess = stack.enter_context(patch(f"{PATCH_ROOT}.subprocess"))
             Popen = MagicMock()
-            Popen.communicate.return_value = (MagicMock(), MagicMock())
+            Popen.stdout.read.side_effect = [b"Error\n", b""]
             subprocess.Popen.return_value = Popen
+            stack.enter_context(patch(f"{PATCH_ROOT}.selectors"))
             stack.enter_context(patch(f"{PATCH_ROOT}.BaseCumulusCI"))
             stack.enter_context(patch(f"{PATCH_ROOT}.get_devhub_api"))
             get_org_details = stack.enter_context(
@@ -259,6 +411,137 @@ class TestRunFlow:
                     user=user,
                 )
 
+    @pytest.fixture
+    def popen(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.os")
+        self.selector = mocker.patch(
+            f"{PATCH_ROOT}.selectors"
+        ).DefaultSelector.return_value.__enter__.return_value
+        self.subprocess = mocker.patch(f"{PATCH_ROOT}.subprocess")
+        popen = self.subprocess.Popen.return_value
+        popen.returncode = 0
+        return popen
+
+    def run_flow(self, user, **kwargs):
+        run_flow(
+            cci=MagicMock(),
+            org_config=MagicMock(
+                org_id="org_id",
+                id="https://test.salesforce.com/id/ORGID/USERID",
+                instance_url="instance_url",
+                access_token="access_token",
+            ),
+            flow_name="dev_org",
+            project_path="/tmp",
+            user=user,
+            **kwargs,
+        )
+
+    def test_run_flow__output(self, user_factory, mocker, popen):
+        mocker.patch(f"{PATCH_ROOT}.FLOW_OUTPUT_CHUNK_SIZE", 10)
+        mocker.patch(f"{PATCH_ROOT}.FLOW_OUTPUT_FLUSH_INTERVAL", 60)
+        popen.stdout.read.side_effect = [b"one\n", b"two\n", b"three\n", b""]
+        output_handler = MagicMock()
+
+        self.run_flow(user_factory(), output_handler=output_handler)
+
+        assert popen.wait.called
+        assert [call.args for call in output_handler.call_args_list] == [
+            ("one\ntwo\nthree\n",),
+        ]
+
+    def test_run_flow__output_waited(self, user_factory, mocker, popen):
+        mocker.patch(f"{PATCH_ROOT}.FLOW_OUTPUT_FLUSH_INTERVAL", 60)
+        # The second select times out with nothing more to read:
+        self.selector.select.side_effect = [["key"], [], ["key"], ["key"]]
+        popen.stdout.read.side_effect = [b"one\n", b"two\n", b""]
+        output_handler = MagicMock()
+
+        self.run_flow(user_factory(), output_handler=output_handler)
+
+        assert [call.args for call in output_handler.call_args_list] == [
+            ("one\n",),
+            ("two\n",),
+        ]
+        first_timeout, second_timeout = (
+            call.args[0] for call in self.selector.select.call_args_list[:2]
+        )
+        assert first_timeout is None
+        assert 0 < second_timeout <= 60
+
+    def test_run_flow__output_multibyte(self, user_factory, popen):
+        popen.stdout.read.side_effect = [b"caf\xc3", b"\xa9\n", b""]
+        output_handler = MagicMock()
+
+        self.run_flow(user_factory(), output_handler=output_handler)
+
+        assert (
+            "".join(call.args[0] for call in output_handler.call_args_list)
+            == "caf\u00e9\n"
+        )
+
+    def test_run_flow__error(self, user_factory, popen):
+        popen.returncode = 1
+        popen.stdout.read.side_effect = [b"Running\nFlow fai", b"led\n\n", b""]
+        self.subprocess.run.return_value.stdout = b""
+
+        with pytest.raises(Exception, match="Flow failed"):
+            self.run_flow(user_factory())
+
+
+class TestCreateOrg:
+    @pytest.fixture(autouse=True)
+    def patches(self, mocker):
+        mocker.patch(f"{PATCH_ROOT}.BaseCumulusCI")
+        mocker.patch(
+            f"{PATCH_ROOT}.get_org_details", return_value=(MagicMock(), MagicMock())
+        )
+        mocker.patch(f"{PATCH_ROOT}.get_org_result", return_value={"Id": "2SR1"})
+        mocker.patch(f"{PATCH_ROOT}.mutate_scratch_org")
+        mocker.patch(f"{PATCH_ROOT}.get_access_token")
+        self.devhub_api = mocker.patch(f"{PATCH_ROOT}.get_devhub_api").return_value
+        self.devhub_api.ScratchOrgInfo.get.return_value = {"ScratchOrg": "00D1"}
+        self.devhub_api.query.return_value = {"records": [{"Id": "2AS1"}]}
+        self.deploy_org_settings = mocker.patch(f"{PATCH_ROOT}.deploy_org_settings")
+
+    def create_org(self):
+        return create_org(
+            repo_owner="owner",
+            repo_name="repo",
+            repo_url="https://github.com/owner/repo",
+            repo_branch="main",
+            user=MagicMock(),
+            project_path="/tmp",
+            scratch_org=MagicMock(),
+            org_name="dev",
+            originating_user_id=None,
+        )
+
+    def test_error(self):
+        self.deploy_org_settings.side_effect = Exception("Oh no!")
+
+        with pytest.raises(Exception, match="Oh no!"):
+            self.create_org()
+
+        self.devhub_api.ScratchOrgInfo.get.assert_called_once_with("2SR1")
+        self.devhub_api.ActiveScratchOrg.delete.assert_called_once_with("2AS1")
+
+    def test_error__not_deleted(self):
+        self.deploy_org_settings.side_effect = Exception("Oh no!")
+        self.devhub_api.ActiveScratchOrg.delete.side_effect = Exception("Oh dear")
+
+        with pytest.raises(Exception, match="Oh no!"):
+            self.create_org()
+
+    def test_error__no_org(self):
+        self.deploy_org_settings.side_effect = Exception("Oh no!")
+        self.devhub_api.ScratchOrgInfo.get.return_value = {"ScratchOrg": None}
+
+        with pytest.raises(Exception, match="Oh no!"):
+            self.create_org()
+
+        assert not self.devhub_api.ActiveScratchOrg.delete.called
+
 
 @pytest.mark.django_db
 def test_delete_org(scratch_org_factory):
@@ -273,6 +556,11 @@ def test_delete_org(scratch_org_factory):
         get_devhub_api.return_value = devhub_api
         devhub_api.query.return_value = {"records": [{"Id": "some-id"}]}
 
+        forget_access_token = stack.enter_context(
+            patch(f"{PATCH_ROOT}.forget_access_token")
+        )
+
         delete_org(scratch_org)
 
         assert devhub_api.ActiveScratchOrg.delete.called
+        forget_access_token.assert_called_once_with(scratch_org)
@@ -5,14 +5,16 @@ from pathlib import Path
 from unittest.mock import MagicMock, patch
 
 import pytest
+from django.core.cache import cache
 from django.core.management import call_command
 from django.urls import reverse
-from github3.exceptions import ResponseError
 from rest_framework import status
 
 from metecho.api.serializers import EpicSerializer, TaskSerializer
 
-from ..models import ScratchOrgType
+from .. import gh_branches
+from ..jobs import process_github_hook_delivery
+from ..models import GitHubHookDelivery, ScratchOrgType
 
 Branch = namedtuple("Branch", ["name"])
 
@@ -233,15 +235,45 @@ class TestProjectViewset:
 
         project.refresh_from_db()
         assert response.status_code == 202
-        assert populate_github_issues_job.delay.called
+        populate_github_issues_job.delay.assert_called_once_with(
+            project, originating_user_id=str(client.user.id), full=False
+        )
         assert project.currently_fetching_issues
 
+    @pytest.mark.parametrize(
+        "full, expected", (("true", True), ("1", True), ("false", False), ("0", False))
+    )
+    def test_refresh_github_issues__full(
+        self,
+        mocker,
+        client,
+        project_factory,
+        git_hub_repository_factory,
+        full,
+        expected,
+    ):
+        git_hub_repository_factory(user=client.user, repo_id=123)
+        project = project_factory(repo_id=123)
+        populate_github_issues_job = mocker.patch(
+            "metecho.api.jobs.refresh_github_issues_job"
+        )
+        response = client.post(
+            reverse("project-refresh-github-issues", args=[str(project.pk)])
+            + f"?full={full}"
+        )
+
+        assert response.status_code == 202
+        populate_github_issues_job.delay.assert_called_once_with(
+            project, originating_user_id=str(client.user.id), full=expected
+        )
+
     def test_feature_branches(
         self, client, project_factory, git_hub_repository_factory
     ):
         git_hub_repository_factory(user=client.user, repo_id=123)
         project = project_factory(repo_id=123)
-        with patch("metecho.api.views.gh.get_repo_info") as get_repo_info:
+        cache.delete(gh_branches.get_cache_key(project))
+        with patch("metecho.api.gh_branches.gh.get_repo_info") as get_repo_info:
             repo = MagicMock(
                 **{
                     "branches.return_value": [
@@ -257,6 +289,34 @@ class TestProjectViewset:
             )
             assert response.json() == ["include_me"], response.json()
 
+    def test_feature_branches__search_and_page(
+        self, client, project_factory, epic_factory, git_hub_repository_factory
+    ):
+        git_hub_repository_factory(user=client.user, repo_id=123)
+        project = project_factory(repo_id=123)
+        epic_factory(project=project, branch_name="feature/taken")
+        # Epics of other projects don't hide this project's branches:
+        epic_factory(branch_name="feature/b")
+        cache.set(
+            gh_branches.get_cache_key(project),
+            {
+                "default_branch": "main",
+                "names": ["feature/a", "feature/b", "feature/taken", "fix", "main"],
+            },
+        )
+
+        response = client.get(
+            reverse("project-feature-branches", kwargs={"pk": str(project.id)}),
+            {"search": "feature/", "page": 1},
+        )
+
+        assert response.json() == {
+            "count": 2,
+            "next": None,
+            "previous": None,
+            "results": ["feature/a", "feature/b"],
+        }
+
     def test_get_queryset(self, client, project_factory, git_hub_repository_factory):
         git_hub_repository_factory(
             user=client.user, repo_id=123, repo_url="https://example.com/test-repo.git"
@@ -264,8 +324,7 @@ class TestProjectViewset:
         project = project_factory(repo_name="repo", repo_id=123)
         project_factory(repo_name="repo2", repo_id=456)
         project_factory(repo_name="repo3", repo_id=None)
-        with patch("metecho.api.model_mixins.get_repo_info") as get_repo_info:
-            get_repo_info.return_value = MagicMock(id=789)
+        with patch("metecho.api.jobs.populate_project_repo_ids_job"):
             response = client.get(reverse("project-list"))
 
         assert response.status_code == 200
@@ -302,52 +361,27 @@ class TestProjectViewset:
             ],
         }, response.json()
 
-    def test_get_queryset__bad(
+    def test_get_queryset__missing_repo_id(
         self, client, project_factory, git_hub_repository_factory
     ):
-        git_hub_repository_factory(
-            user=client.user, repo_id=123, repo_url="https://example.com/test-repo.git"
-        )
-        project = project_factory(repo_name="repo", repo_id=123)
-        project_factory(repo_name="repo2", repo_id=456)
+        """
+        Missing repo IDs are looked up by a job, not while handling the request
+        """
         project_factory(repo_name="repo3", repo_id=None)
-        with patch("metecho.api.model_mixins.get_repo_info") as get_repo_info:
-            get_repo_info.side_effect = ResponseError(MagicMock())
+        cache.delete("populate_project_repo_ids_queued")
+        with ExitStack() as stack:
+            get_repo_info = stack.enter_context(
+                patch("metecho.api.model_mixins.get_repo_info")
+            )
+            job = stack.enter_context(
+                patch("metecho.api.jobs.populate_project_repo_ids_job")
+            )
             response = client.get(reverse("project-list"))
+            client.get(reverse("project-list"))
 
         assert response.status_code == 200
-        assert response.json() == {
-            "count": 1,
-            "previous": None,
-            "next": None,
-            "results": [
-                {
-                    "id": str(project.id),
-                    "name": str(project.name),
-                    "description": "",
-                    "description_rendered": "",
-                    "has_truncated_issues": False,
-                    "is_managed": False,
-                    "slug": str(project.slug),
-                    "old_slugs": [],
-                    "repo_url": (
-                        f"https://github.com/{project.repo_owner}/{project.repo_name}"
-                    ),
-                    "repo_owner": str(project.repo_owner),
-                    "repo_name": str(project.repo_name),
-                    "has_push_permission": False,
-                    "branch_prefix": "",
-                    "github_users": [],
-                    "github_issue_count": 0,
-                    "repo_image_url": "",
-                    "org_config_names": [],
-                    "currently_fetching_org_config_names": False,
-                    "currently_fetching_github_users": False,
-                    "latest_sha": "abcd1234",
-                    "currently_fetching_issues": False,
-                }
-            ],
-        }, response.json()
+        assert not get_repo_info.called
+        job.delay.assert_called_once_with()
 
     def test_get_queryset__superuser(self, admin_client, project_factory):
         """
@@ -365,6 +399,14 @@ class TestProjectViewset:
 
 @pytest.mark.django_db
 class TestHookView:
+    @pytest.fixture(autouse=True)
+    def process_github_hook_delivery_job(self, mocker):
+        """Process deliveries right away instead of on a worker"""
+        return mocker.patch(
+            "metecho.api.jobs.process_github_hook_delivery_job.delay",
+            side_effect=process_github_hook_delivery,
+        )
+
     @pytest.mark.parametrize(
         "_task_factory, task_data",
         (
@@ -405,6 +447,7 @@ class TestHookView:
                 }
             )
             gh.normalize_commit.return_value = "1234abcd"
+            gh.get_ahead_by.return_value = {}
 
             git_hub_repository_factory(repo_id=123)
             task = _task_factory(**task_data, branch_name="test-task")
@@ -599,6 +642,80 @@ class TestHookView:
             assert response.status_code == 202, response.content
             assert refresh_commits_job.delay.called
 
+    def test_202__redelivery(
+        self,
+        settings,
+        client,
+        project_factory,
+        git_hub_repository_factory,
+        process_github_hook_delivery_job,
+    ):
+        settings.GITHUB_HOOK_SECRET = b""
+        project_factory(repo_id=123)
+        git_hub_repository_factory(repo_id=123)
+        with patch("metecho.api.jobs.refresh_commits_job") as refresh_commits_job:
+            for _ in range(2):
+                response = client.post(
+                    reverse("hook"),
+                    json.dumps(
+                        {
+                            "ref": "refs/heads/main",
+                            "forced": True,
+                            "repository": {"id": 123},
+                            "commits": [],
+                            "sender": {},
+                        }
+                    ),
+                    content_type="application/json",
+                    HTTP_X_HUB_SIGNATURE="sha1=7724a4777b8215f158efbe74f05ce6eaa5ec41a8",
+                    HTTP_X_GITHUB_EVENT="push",
+                    HTTP_X_GITHUB_DELIVERY="72d3162e-cc78-11e3-81ab-4c9367dc0958",
+                )
+                assert response.status_code == 202, response.content
+
+        process_github_hook_delivery_job.assert_called_once()
+        refresh_commits_job.delay.assert_called_once()
+
+    def test_202__redelivery_after_error(
+        self,
+        settings,
+        client,
+        project_factory,
+        git_hub_repository_factory,
+        process_github_hook_delivery_job,
+    ):
+        settings.GITHUB_HOOK_SECRET = b""
+        project_factory(repo_id=123)
+        git_hub_repository_factory(repo_id=123)
+        payload = {
+            "ref": "refs/heads/main",
+            "forced": True,
+            "repository": {"id": 123},
+            "commits": [],
+            "sender": {},
+        }
+        # As left by a failed attempt to process it:
+        delivery = GitHubHookDelivery.objects.create(
+            delivery_id="72d3162e-cc78-11e3-81ab-4c9367dc0958",
+            event="push",
+            payload=payload,
+            repo_id=123,
+            ref="refs/heads/main",
+        )
+        process_github_hook_delivery_job.side_effect = None
+
+        response = client.post(
+            reverse("hook"),
+            json.dumps(payload),
+            content_type="application/json",
+            HTTP_X_HUB_SIGNATURE="sha1=7724a4777b8215f158efbe74f05ce6eaa5ec41a8",
+            HTTP_X_GITHUB_EVENT="push",
+            HTTP_X_GITHUB_DELIVERY="72d3162e-cc78-11e3-81ab-4c9367dc0958",
+        )
+
+        assert response.status_code == 202, response.content
+        process_github_hook_delivery_job.assert_called_once_with(delivery)
+
     def test_400__push_error(
         self, settings, client, project_factory, git_hub_repository_factory
     ):
@@ -1,3 +1,5 @@
+from uuid import uuid4
+
 from allauth.socialaccount.models import SocialAccount
 from django.contrib.auth import get_user_model
 from django.db.models import Case, IntegerField, Q, When
@@ -5,17 +7,17 @@ from django.http import HttpResponseRedirect
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
-from drf_spectacular.utils import OpenApiResponse, extend_schema
-from github3.exceptions import ConnectionError, ResponseError
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, OpenApiResponse, extend_schema
 from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
-from . import gh
+from . import gh_branches
 from .authentication import GitHubHookAuthentication
 from .filters import (
     EpicFilter,
@@ -24,14 +26,11 @@ from .filters import (
     ScratchOrgFilter,
     TaskFilter,
 )
-from .hook_serializers import (
-    PrHookSerializer,
-    PrReviewHookSerializer,
-    PushHookSerializer,
-)
+from .hook_serializers import HOOK_SERIALIZERS
 from .models import (
     Epic,
     EpicStatus,
+    GitHubHookDelivery,
     GitHubIssue,
     Project,
     ScratchOrg,
@@ -120,18 +119,28 @@ class HookView(APIView):
     @extend_schema(exclude=True)
     def post(self, request):
         """Intendend to respond to several GitHubs webhooks. Not consumed by the frontend."""
-        serializers = {
-            "push": PushHookSerializer,
-            "pull_request": PrHookSerializer,
-            "pull_request_review": PrReviewHookSerializer,
-        }
-        serializer_class = serializers.get(request.META.get("HTTP_X_GITHUB_EVENT"))
+        event = request.META.get("HTTP_X_GITHUB_EVENT")
+        serializer_class = HOOK_SERIALIZERS.get(event)
         if serializer_class is None:
             return Response(status=status.HTTP_400_BAD_REQUEST)
         serializer = serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-
-        serializer.process_hook()
+        if not serializer.get_matching_project():
+            raise NotFound("No matching project.")
+
+        # The payload is processed by a worker, once per delivery even if GitHub
+        # redelivers it, unless processing it failed before:
+        delivery, created = GitHubHookDelivery.objects.get_or_create(
+            delivery_id=request.META.get("HTTP_X_GITHUB_DELIVERY") or str(uuid4()),
+            defaults={
+                "event": event,
+                "payload": request.data,
+                "repo_id": serializer.validated_data["repository"]["id"],
+                "ref": serializer.validated_data.get("ref", ""),
+            },
+        )
+        if created or delivery.processed_at is None:
+            delivery.queue_process()
         return Response(status=status.HTTP_202_ACCEPTED)
 
 
@@ -185,7 +194,7 @@ class CurrentUserViewSet(GenericViewSet):
     @action(methods=["POST"], detail=False)
     def refresh(self, request):
         """Queue a job to refresh the user's list of GitHub repositories."""
-        request.user.queue_refresh_repositories()
+        request.user.queue_refresh_repositories(force=True)
         return Response(status=status.HTTP_202_ACCEPTED)
 
 
@@ -220,11 +229,7 @@ class ProjectViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericVi
     queryset = Project.objects.filter(repo_id__isnull=False)
 
     def get_queryset(self):
-        for project in Project.objects.filter(repo_id__isnull=True):
-            try:
-                project.get_repo_id()
-            except (ResponseError, ConnectionError):
-                pass
+        Project.queue_populate_repo_ids()
 
         if self.request.user.is_superuser:
             return self.queryset
@@ -240,12 +245,29 @@ class ProjectViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericVi
         project.queue_refresh_github_users(originating_user_id=str(request.user.id))
         return Response(status=status.HTTP_202_ACCEPTED)
 
-    @extend_schema(request=None, responses={202: None})
+    @extend_schema(
+        request=None,
+        responses={202: None},
+        parameters=[
+            OpenApiParameter(
+                "full",
+                OpenApiTypes.BOOL,
+                description="Fetch all issues, not only those updated since the "
+                "last refresh",
+            )
+        ],
+    )
     @action(detail=True, methods=["POST"])
     def refresh_github_issues(self, request, pk=None):
-        """Queue a job to refresh the list of GitHub Issues for a Project"""
+        """
+        Queue a job to refresh the list of GitHub Issues for a Project. Only issues
+        updated since the last refresh are fetched, unless `?full=true` is passed.
+        """
         instance = self.get_object()
-        instance.queue_refresh_github_issues(originating_user_id=str(request.user.id))
+        instance.queue_refresh_github_issues(
+            originating_user_id=str(request.user.id),
+            full=request.query_params.get("full", "").lower() in ("1", "true"),
+        )
         return Response(status=status.HTTP_202_ACCEPTED)
 
     @extend_schema(request=None, responses={202: None})
@@ -266,25 +288,33 @@ class ProjectViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericVi
     )
     @action(detail=True, methods=["GET"], pagination_class=None)
     def feature_branches(self, request, pk=None):
-        """Get a list of feature branch names for a Project."""
+        """
+        Get a list of feature branch names for a Project, optionally only those
+        starting with `?search=`. Pass `?page=` to get them a page at a time.
+        """
         instance = self.get_object()
-        repo = gh.get_repo_info(
-            None, repo_owner=instance.repo_owner, repo_name=instance.repo_name
-        )
+        index = gh_branches.get_branch_index(instance)
         existing_branches = set(
             Epic.objects.active()
+            .filter(project=instance)
             .exclude(branch_name="")
             .values_list("branch_name", flat=True)
         )
         data = [
-            branch.name
-            for branch in repo.branches()
+            name
+            for name in gh_branches.search_branch_names(
+                index["names"], request.query_params.get("search", "")
+            )
             if (
-                "__" not in branch.name
-                and branch.name != repo.default_branch
-                and branch.name not in existing_branches
+                "__" not in name
+                and name != index["default_branch"]
+                and name not in existing_branches
             )
         ]
+        if "page" in request.query_params:
+            paginator = CustomPaginator()
+            page = paginator.paginate_queryset(data, request, view=self)
+            return paginator.get_paginated_response(page)
         return Response(data)
 
 
@@ -424,7 +454,7 @@ class ScratchOrgViewSet(
 
     permission_classes = (IsAuthenticated,)
     serializer_class = ScratchOrgSerializer
-    queryset = ScratchOrg.objects.active()
+    queryset = ScratchOrg.objects.active().filter(pool__isnull=True)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = ScratchOrgFilter
 
@@ -7,7 +7,15 @@ from pytest_factoryboy import register
 from rest_framework.test import APIClient
 from sfdo_template_helpers.crypto import fernet_encrypt
 
-from .api.models import Epic, GitHubIssue, GitHubRepository, Project, ScratchOrg, Task
+from .api.models import (
+    Epic,
+    GitHubIssue,
+    GitHubRepository,
+    Project,
+    ScratchOrg,
+    ScratchOrgPool,
+    Task,
+)
 
 User = get_user_model()
 
@@ -141,6 +149,16 @@ class ScratchOrgFactory(factory.django.DjangoModelFactory):
     valid_target_directories = {"source": []}
 
 
+@register
+class ScratchOrgPoolFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = ScratchOrgPool
+
+    project = factory.SubFactory(ProjectFactory)
+    owner = factory.SubFactory(UserFactory)
+    org_config_name = "dev"
+
+
 @register
 class ShortIssueFactory(factory.StubFactory):
     """
@@ -1,6 +1,8 @@
 from django.db import DatabaseError, InterfaceError, connections
 from rq.worker import HerokuWorker, Worker
 
+from .api.gh_memo import memoize_github
+
 
 class ConnectionClosingWorkerMixin(object):
     """Mixin for rq workers to ensure db connections are closed."""
@@ -19,7 +21,8 @@ class ConnectionClosingWorkerMixin(object):
     def perform_job(self, *args, **kwargs):
         self.close_database()
         try:
-            return super().perform_job(*args, **kwargs)
+            with memoize_github():
+                return super().perform_job(*args, **kwargs)
         finally:
             self.close_database()
 